@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+import http.client
+import subprocess
+import threading
+import argparse
+import tempfile
+import json
+import time
+import sys
+import os
+
+
+# Latências de um tipo de requisição, em segundos.
+class Latencies:
+
+    # Construtor.
+    def __init__(self):
+        self.values = []
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    # Registra a latência de uma requisição respondida.
+    def add(self, seconds):
+        with self.lock:
+            self.values.append(seconds)
+
+    # Registra uma requisição que falhou.
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+    # Retorna o número de requisições, de erros, e os percentis das
+    # latências, em milissegundos.
+    def get_data(self):
+        with self.lock:
+            values = sorted(self.values)
+            errors = self.errors
+        data = {'count': len(values), 'errors': errors}
+        if not values:
+            return data
+
+        def percentile(q):
+            return 1000 * values[min(len(values) - 1, int(q * len(values)))]
+        data.update({'mean': 1000 * sum(values) / len(values),
+                     'p50': percentile(0.5),
+                     'p90': percentile(0.9),
+                     'p99': percentile(0.99),
+                     'max': 1000 * values[-1]})
+        return data
+
+
+# Classe abstrata. Cliente sintético, que faz requisições ao servidor até que
+# o benchmark termine, registrando suas latências.
+class Client(threading.Thread):
+
+    # Construtor. Recebe o benchmark.
+    def __init__(self, bench):
+        threading.Thread.__init__(self, daemon=True)
+        self.bench = bench
+
+    # Faz uma requisição, registrando sua latência no tipo dado. Retorna a
+    # resposta e seu corpo, ou None se a requisição falhar.
+    def request(self, kind, method, uri, body=None, headers={}):
+        start = time.monotonic()
+        try:
+            connection = http.client.HTTPConnection(self.bench.host,
+                                                    timeout=30)
+            connection.request(method, uri, body, headers)
+            response = connection.getresponse()
+            data = response.read()
+            connection.close()
+        except (OSError, http.client.HTTPException):
+            self.bench.latencies(kind).error()
+            return None
+        self.bench.latencies(kind).add(time.monotonic() - start)
+        return response, data
+
+
+# Jogador sintético. Entra no jogo com um script, e então requisita seus
+# próprios dados uma vez por passo, sem esperar por modificações.
+class Player(Client):
+
+    # Construtor. Recebe o benchmark, o nome e o script.
+    def __init__(self, bench, name, script):
+        Client.__init__(self, bench)
+        self.name = name
+        self.script = script
+
+    # Sobrescrito de Thread.
+    def run(self):
+        body = bytes(json.dumps({'name': self.name, 'password': self.name,
+                                 'script': self.script}), 'utf-8')
+        self.request('POST /game', 'POST', '/game', body)
+        while not self.bench.stopped.wait(self.bench.step):
+            self.request('GET /game/[nome]', 'GET', '/game/' + self.name)
+
+
+# Espectador sintético. Acompanha o estado do jogo com requisições que
+# esperam pela próxima modificação, como o cliente no modo "state".
+class Spectator(Client):
+
+    # Sobrescrito de Thread.
+    def run(self):
+        version = None
+        while not self.bench.stopped.is_set():
+            headers = {'If-None-Match': version} if version else {}
+            result = self.request('GET /game/state', 'GET', '/game/state',
+                                  headers=headers)
+            if result is None:
+                self.bench.stopped.wait(self.bench.step)
+            else:
+                version = result[0].getheader('ETag')
+
+
+# Benchmark. Inicia o servidor, como subprocesso ou no próprio processo,
+# adiciona jogadores e espectadores sintéticos, e amostra periodicamente o
+# uso de recursos do processo do servidor e os contadores do relógio do jogo.
+class Bench:
+
+    # Construtor. Recebe os argumentos da linha de comando.
+    def __init__(self, args):
+        self.args = args
+        self.host = 'localhost:%d' % args.port
+        self.step = args.step
+        self.stopped = threading.Event()
+        self.requests = {}
+        self.samples = []
+        self.lock = threading.Lock()
+        self.process = None
+        self.server = None
+        self.board = None
+        self.pid = None
+
+    # Retorna as latências de um tipo de requisição, criando-as se
+    # necessário.
+    def latencies(self, kind):
+        with self.lock:
+            return self.requests.setdefault(kind, Latencies())
+
+    # Inicia o servidor, e espera até que aceite conexões. Como no
+    # subprocesso, o log de requisições é descartado.
+    def start_server(self, database):
+        args = self.args
+        if args.in_process:
+            import server
+            import scores
+            server.Handler.log_message = lambda *args: None
+            self.board = scores.Scores(database)
+            game = server.Game(args.step, scores=self.board)
+            self.server = server.Server('localhost', args.port)
+            self.server.root.add_child(game, 'game')
+            game.add_rocks(args.rocks)
+            self.board.start()
+            game.start()
+            threading.Thread(target=self.server.serve_forever,
+                             daemon=True).start()
+            self.pid = os.getpid()
+        else:
+            directory = os.path.dirname(os.path.abspath(__file__))
+            command = [sys.executable, os.path.join(directory, 'server.py'),
+                       '-p', str(args.port), '-s', str(args.step),
+                       '-r', str(args.rocks), '-d', database]
+            self.process = subprocess.Popen(command + args.server_args,
+                                            stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.DEVNULL)
+            self.pid = self.process.pid
+
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if self.get('/game') is not None:
+                return
+            time.sleep(0.1)
+        raise RuntimeError('o servidor não iniciou')
+
+    # Termina o servidor.
+    def stop_server(self):
+        if self.process:
+            self.process.terminate()
+            self.process.wait()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.board.close()
+
+    # Requisita um recurso sem registrar a latência. Retorna os dados, ou
+    # None se a requisição falhar.
+    def get(self, uri):
+        try:
+            connection = http.client.HTTPConnection(self.host, timeout=5)
+            connection.request('GET', uri)
+            response = connection.getresponse()
+            data = json.loads(response.read().decode('utf-8'))
+            connection.close()
+        except (OSError, http.client.HTTPException, ValueError):
+            return None
+        return data
+
+    # Retorna o número de threads e a memória residente, em kB, do processo
+    # do servidor.
+    def usage(self):
+        usage = {'threads': None, 'rss_kb': None}
+        try:
+            with open('/proc/%d/status' % self.pid) as status:
+                for line in status:
+                    field, _, value = line.partition(':')
+                    if field == 'Threads':
+                        usage['threads'] = int(value)
+                    elif field == 'VmRSS':
+                        usage['rss_kb'] = int(value.split()[0])
+        except OSError:
+            pass
+        return usage
+
+    # Registra uma amostra. A duração média dos passos é a do intervalo desde
+    # a amostra anterior.
+    def sample(self, start, previous):
+        clock = self.get('/game/clock') or {}
+        sample = {'time': time.monotonic() - start}
+        sample.update(self.usage())
+        for i in ['ticks', 'overruns', 'skipped', 'max_duration', 'lag']:
+            sample[i] = clock.get(i)
+
+        total = clock.get('mean_duration', 0) * clock.get('ticks', 0)
+        ticks = clock.get('ticks', 0) - previous[1]
+        sample['duration'] = (total - previous[0]) / ticks if ticks else None
+        self.samples.append(sample)
+        return total, clock.get('ticks', 0)
+
+    # Executa o benchmark, e retorna os resultados.
+    def run(self):
+        args = self.args
+        with open(args.script) as f:
+            script = f.read()
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.start_server(os.path.join(directory, 'bench.db'))
+            try:
+                clients = [Player(self, 'bench%d' % i, script)
+                           for i in range(args.players)]
+                clients += [Spectator(self) for i in range(args.spectators)]
+                for c in clients:
+                    c.start()
+
+                start = time.monotonic()
+                previous = (0, 0)
+                while time.monotonic() - start < args.duration:
+                    time.sleep(args.interval)
+                    previous = self.sample(start, previous)
+                clock = self.get('/game/clock')
+                self.stopped.set()
+                for c in clients:
+                    c.join(1)
+            finally:
+                self.stop_server()
+
+        return {'config': {i: getattr(args, i) for i in
+                           ['players', 'spectators', 'duration', 'step',
+                            'rocks', 'in_process', 'server_args']},
+                'requests': {kind: l.get_data()
+                             for kind, l in sorted(self.requests.items())},
+                'clock': clock,
+                'max_threads': max([s['threads'] or 0 for s in self.samples],
+                                   default=None),
+                'max_rss_kb': max([s['rss_kb'] or 0 for s in self.samples],
+                                  default=None),
+                'samples': self.samples}
+
+
+# Main.
+if __name__ == '__main__':
+    # Cria argumentos de linha de comando.
+    directory = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(
+            description='Benchmark do servidor. Argumentos após "--" são '
+                        'passados ao servidor.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-p', '--port', type=int, default=8100,
+            help='A porta do servidor.')
+    parser.add_argument('-n', '--players', type=int, default=10,
+            help='O número de jogadores sintéticos.')
+    parser.add_argument('-m', '--spectators', type=int, default=10,
+            help='O número de espectadores sintéticos.')
+    parser.add_argument('-t', '--duration', type=float, default=10,
+            help='A duração do benchmark em segundos.')
+    parser.add_argument('-s', '--step', type=float, default=0.1,
+            help='O intervalo de tempo em segundos entre passos do jogo.')
+    parser.add_argument('-r', '--rocks', type=int, default=20,
+            help='O número de pedras no campo.')
+    parser.add_argument('-i', '--interval', type=float, default=1,
+            help='O intervalo de tempo em segundos entre amostras.')
+    parser.add_argument('--script', type=str,
+            default=os.path.join(directory, 'script.py'),
+            help='O script dos jogadores sintéticos.')
+    parser.add_argument('--in-process', action='store_true',
+            help='Executa o servidor no próprio processo, ao invés de um '
+                 'subprocesso. As amostras incluem então os clientes.')
+    parser.add_argument('-o', '--output', type=str, default='-',
+            help='O arquivo de saída, em JSON ("-" para a saída padrão).')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER,
+            help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.server_args[:1] == ['--']:
+        args.server_args = args.server_args[1:]
+    if args.in_process and args.server_args:
+        parser.error('argumentos do servidor requerem um subprocesso.')
+
+    results = Bench(args).run()
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=4)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
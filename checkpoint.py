@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import threading
+import struct
+import queue
+import json
+import mmap
+import time
+import os
+
+import metrics
+import world
+
+
+# Pontos de restauração (checkpoints) de um jogo: o estado completo ao final
+# de um passo, gravado periodicamente em um arquivo de formato fixo, de forma
+# que um servidor reiniciado continua o jogo de onde parou. O arquivo tem um
+# cabeçalho, seguido de um registro de tamanho fixo por objeto, e então das
+# strings de todos os objetos. Cada registro tem o tipo e os atributos
+# numéricos do objeto, o alcance dos projéteis, e a posição e os tamanhos de
+# suas strings: o URN, a senha, em JSON, o script dos jogadores e o URN do
+# dono dos projéteis. O dono de um projétil pode já ter saído do jogo; o
+# projétil continua em voo, e seus kills continuam creditados ao dono. Os
+# objetos ficam na ordem em que o jogo os percorre, de forma que o jogo
+# restaurado continua igual, e os projéteis vêm depois dos jogadores.
+SIGNATURE = b'SBCK'
+VERSION = 2
+HEADER = struct.Struct('<4sHxxqqdII')
+RECORD = struct.Struct('<B?xxIHHIH10q')
+
+# Atributos numéricos, na ordem dos registros, de todos os objetos e somente
+# dos jogadores.
+FIELDS = ['hp', 'posx', 'posy', 'movx', 'movy', 'lookx', 'looky']
+PLAYER = ['shots', 'kills']
+
+
+# Retorna um atributo como inteiro. Os atributos de controle vêm dos scripts,
+# então podem ter outros tipos: números são truncados, e outros valores são
+# gravados como 0.
+def integer(value):
+    return int(value) if isinstance(value, (int, float)) else 0
+
+
+# Grava um ponto de restauração. Recebe os dados retornados por Game.capture.
+# O arquivo é escrito ao lado do anterior e então o substitui, de forma que
+# sempre há um ponto de restauração completo.
+def write(path, capture):
+    objects = capture['objects']
+    projectiles = capture['projectiles']
+
+    rows = []
+    for urn, (password, script) in capture['children'].items():
+        if urn in objects:
+            rows.append((urn, objects[urn], password, script or '', 0, ''))
+    for urn, (distance, owner) in projectiles.items():
+        if urn in objects:
+            rows.append((urn, objects[urn], None, '', distance, owner))
+
+    records = bytearray()
+    strings = bytearray()
+    for urn, a, password, script, distance, owner in rows:
+        name = urn.encode('utf-8')
+        secret = json.dumps(password).encode('utf-8')
+        source = script.encode('utf-8')
+        player = owner.encode('utf-8')
+        values = [integer(a.get(i, 0)) for i in FIELDS + PLAYER]
+        records += RECORD.pack(world.TYPES.index(a['type']),
+                               bool(a.get('shooting')), len(strings),
+                               len(name), len(secret), len(source),
+                               len(player), *values, distance)
+        strings += name + secret + source + player
+
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(HEADER.pack(SIGNATURE, VERSION, capture['sequence'],
+                            capture['shots'], time.time(), len(rows),
+                            len(strings)))
+        f.write(records)
+        f.write(strings)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+# Carrega um ponto de restauração, mapeando o arquivo na memória. Retorna um
+# dicionário com o passo, o número de tiros já disparados e uma lista de
+# tuplas (URN, atributos, senha, script, alcance, URN do dono), uma por
+# objeto, na ordem do arquivo. Levanta ValueError se o arquivo não for um
+# ponto de restauração.
+def load(path):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if len(data) < HEADER.size:
+                raise ValueError('%s não é um checkpoint' % path)
+            signature, version, sequence, shots, created, count, size = \
+                    HEADER.unpack_from(data, 0)
+            start = HEADER.size + count * RECORD.size
+            if (signature != SIGNATURE or version != VERSION or
+                    len(data) != start + size):
+                raise ValueError('%s não é um checkpoint' % path)
+
+            objects = []
+            for i in range(count):
+                kind, shooting, offset, name, secret, source, player, \
+                        *values = RECORD.unpack_from(
+                                data, HEADER.size + i * RECORD.size)
+                offset += start
+                urn = data[offset:offset + name].decode('utf-8')
+                offset += name
+                password = json.loads(data[offset:offset + secret])
+                offset += secret
+                script = data[offset:offset + source].decode('utf-8')
+                offset += source
+                owner = data[offset:offset + player].decode('utf-8') or None
+
+                kind = world.TYPES[kind]
+                attributes = dict(zip(FIELDS, values), type=kind)
+                if kind == 'player':
+                    attributes.update(zip(PLAYER, values[len(FIELDS):]))
+                    attributes['shooting'] = shooting
+                distance = values[-1]
+                objects.append((urn, attributes, password, script, distance,
+                                owner))
+
+    return {'sequence': sequence, 'shots': shots, 'time': created,
+            'objects': objects}
+
+
+# Escritor dos pontos de restauração de um jogo. O jogo chama tick ao final de
+# seus passos, e a cada intervalo copia o seu estado, o que é barato, porque o
+# estado publicado nunca é modificado. A gravação é feita por uma thread
+# própria. Se a gravação anterior ainda não terminou, o ponto é descartado, de
+# forma que o jogo nunca espera pelo disco.
+class Checkpoints(threading.Thread):
+
+    # Construtor. Recebe o caminho do arquivo e o intervalo de tempo em
+    # segundos entre pontos de restauração.
+    def __init__(self, path, interval=10):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.interval = interval
+        self.due = time.monotonic() + interval
+        self.queue = queue.Queue(1)
+        self.closing = False
+        self.captured = threading.Event()
+        self.written = 0
+        self.skipped = 0
+
+    # Chamado pelo jogo ao final de seus passos. Copia o estado do jogo, se
+    # for a hora, e o envia para gravação.
+    def tick(self, game):
+        now = time.monotonic()
+        if now < self.due:
+            return
+        self.due = now + self.interval
+        with metrics.phases.time('checkpoint'):
+            capture = game.capture()
+
+        if self.closing:
+            self.queue.put(capture)
+            self.captured.set()
+            return
+        try:
+            self.queue.put_nowait(capture)
+        except queue.Full:
+            self.skipped += 1
+
+    # Sobrescrito de Thread. Grava os pontos recebidos até receber None.
+    def run(self):
+        while True:
+            capture = self.queue.get()
+            if capture is None:
+                break
+            with metrics.checkpoints.time():
+                write(self.path, capture)
+            self.written += 1
+
+    # Grava um último ponto de restauração, copiado no próximo passo do jogo,
+    # esperando por ele até timeout segundos, e termina a thread.
+    def close(self, timeout=1):
+        self.closing = True
+        self.due = 0
+        self.captured.wait(timeout)
+        self.queue.put(None)
+        self.join()
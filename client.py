@@ -14,31 +14,58 @@ import time
 import sys
 import os
 import Editor
+import websocket
+import codec
 
 # Classe abstrata que requisita repetidamente um recurso e atualiza seus dados.
 class Poller(threading.Thread):
 
+    # Formato pedido ao servidor, e se o pede comprimido com gzip. Podem ser
+    # modificados para todos os objetos antes de se iniciar o jogo.
+    accept = codec.JSON
+    compress = False
+
     # Construtor. Inicializa o timestamp como o menor possível, pois ainda não
-    # há dados recebidos.
+    # há dados recebidos. O recurso requisitado é o próprio URI, a não ser que
+    # uma subclasse defina outro alvo.
     def __init__(self, host, uri):
         threading.Thread.__init__(self)
         self.host = host
         self.uri = uri
+        self.target = uri
         self.timestamp = time.mktime(time.gmtime(0))
+        self.version = None
         self.lock = threading.Lock()
 
-    # Atualiza o timestamp a partir de uma resposta HTTP. Se não contém tal
-    # informação, usa o tempo atual.
+    # Atualiza o timestamp e a versão a partir de uma resposta HTTP. Se não
+    # contém tais informações, usa o tempo atual.
     def stamp(self, response):
         last_modified = response.getheader('Last-Modified',
                 email.utils.formatdate(time.time()))
         self.timestamp = time.mktime(email.utils.parsedate(last_modified))
-
-    # Lê o conteúdo de uma resposta HTTP formatado em JSON, e retorna um
-    # dicionário correspondente.
+        self.version = response.getheader('ETag')
+
+    # Retorna os campos de cabeçalho que identificam a última atualização
+    # recebida e o formato pedido. A versão é preferida, pois o timestamp tem
+    # resolução de segundos.
+    def headers(self):
+        headers = {'Accept': self.accept}
+        if self.compress:
+            headers['Accept-Encoding'] = 'gzip'
+        if self.version:
+            headers['If-None-Match'] = self.version
+        else:
+            headers['If-Modified-Since'] = email.utils.formatdate(
+                    self.timestamp)
+        return headers
+
+    # Lê o conteúdo de uma resposta HTTP, no formato indicado por ela, e
+    # retorna um dicionário correspondente.
     def read(self, response):
         try:
-            return json.loads(response.read().decode('utf-8'))
+            return codec.decode(response.read(),
+                                response.getheader('Content-Type'),
+                                response.getheader('Content-Encoding'))
         except:
             return {}
 
@@ -56,9 +83,7 @@ class Poller(threading.Thread):
     def run(self):
         connection = http.client.HTTPConnection(self.host)
         while True:
-            connection.request('GET', self.uri,
-                               headers={'If-Modified-Since':
-                                   email.utils.formatdate(self.timestamp)})
+            connection.request('GET', self.target, headers=self.headers())
             response = connection.getresponse()
             if response.status == http.client.NOT_FOUND:
                 break
@@ -120,7 +145,8 @@ class Game(Poller):
         p.start()
         return p
 
-    # Cria o próprio jogador.
+    # Cria o próprio jogador. O servidor o cria no início do próximo passo,
+    # então espera até que ele exista.
     def create_self(self):
         data = {'name': self.name, 'password': self.password,
                 'script': self.script}
@@ -132,6 +158,14 @@ class Game(Poller):
         urn = response.getheader('Location') # TODO validar
         response.close()
 
+        for i in range(50):
+            connection.request('HEAD', self.uri + '/' + urn)
+            response = connection.getresponse()
+            response.close()
+            if response.status != http.client.NOT_FOUND:
+                break
+            time.sleep(0.1)
+
         self.player = self.create_object(urn)
 
     #Manda as informações atualizadas 
@@ -156,6 +190,145 @@ class Game(Poller):
             self.objects = objects
 
 
+# Jogo que acompanha todos os objetos com uma única requisição por vez ao
+# recurso de estado do jogo, ao invés de uma conexão e uma thread por objeto.
+# Os objetos não fazem requisições; são atualizados pelo jogo.
+class StateGame(Game):
+
+    # Construtor. O alvo das requisições é o estado do jogo.
+    def __init__(self, host, uri, name, password, script):
+        Game.__init__(self, host, uri, name, password, script)
+        self.target = uri + '/state'
+
+    # Sobrescrito de Game. Cria um objeto sem fazê-lo escutar por
+    # modificações.
+    def create_object(self, name):
+        return Object(self.host, self.uri + '/' + name)
+
+    # Sobrescrito de Game. Dados recebidos mapeiam URNs para os atributos de
+    # cada objeto. Objetos que não estão nos dados recebidos foram removidos.
+    def update(self, data):
+        with self.lock:
+            objects = {}
+            for n, attributes in data.items():
+                if n == self.name:
+                    self.player.update(attributes)
+                    continue
+                objects[n] = self.objects.get(n) or self.create_object(n)
+                objects[n].update(attributes)
+            self.objects = objects
+
+
+# Jogo que recebe somente as modificações desde o último passo recebido, ao
+# invés do estado completo a cada requisição.
+class DeltaGame(StateGame):
+
+    # Construtor. Ainda não há passo recebido.
+    def __init__(self, host, uri, name, password, script):
+        StateGame.__init__(self, host, uri, name, password, script)
+        self.sequence = -1
+        self.state = {}
+        self.target = uri + '/state?since=-1'
+
+    # Sobrescrito de StateGame. Aplica as modificações ao estado conhecido,
+    # e passa a pedir as modificações desde o passo recebido.
+    def update(self, data):
+        if data.get('full', True):
+            self.state = {}
+        for n in data.get('removed', []):
+            self.state.pop(n, None)
+        self.state.update(data.get('added', {}))
+        for n, attributes in data.get('changed', {}).items():
+            self.state[n] = dict(self.state.get(n, {}), **attributes)
+
+        self.sequence = data.get('sequence', -1)
+        self.target = self.uri + '/state?since=' + str(self.sequence)
+        StateGame.update(self, self.state)
+
+
+# Jogo que recebe somente os objetos em volta do próprio jogador, por uma
+# sessão de área de interesse no servidor. A área acompanha o jogador, e
+# objetos que saem dela são removidos.
+class ViewGame(DeltaGame):
+
+    # Metade do lado da área, em posições.
+    radius = 10
+
+    # Construtor. A sessão é criada junto com o jogador.
+    def __init__(self, host, uri, name, password, script):
+        DeltaGame.__init__(self, host, uri, name, password, script)
+        self.session = None
+
+    # Retorna o alvo das requisições, com a área em volta da posição dada.
+    def area(self, x, y):
+        r = self.radius
+        return '%s?x0=%d&y0=%d&x1=%d&y1=%d' % (self.session, x - r, y - r,
+                                               x + r, y + r)
+
+    # Cria uma sessão em volta da posição atual do jogador, ou da última
+    # conhecida, se não existir mais. Retorna se conseguiu.
+    def create_session(self):
+        connection = http.client.HTTPConnection(self.host)
+        connection.request('GET', self.player.uri + '?wait=0')
+        response = connection.getresponse()
+        if response.status == http.client.OK:
+            self.player.update(self.read(response))
+        response.close()
+
+        attributes = self.player.get_data()
+        x, y, r = attributes['posx'], attributes['posy'], self.radius
+        data = {'x0': x - r, 'y0': y - r, 'x1': x + r, 'y1': y + r}
+        connection.request('POST', self.uri + '/views',
+                           bytes(json.dumps(data), 'utf-8'))
+        response = connection.getresponse()
+        response.close()
+        if response.status != http.client.CREATED:
+            return False
+
+        self.session = self.uri + '/views/' + response.getheader('Location')
+        self.version = None
+        self.target = self.area(x, y)
+        return True
+
+    # Sobrescrito de Game. Cria também a sessão.
+    def create_self(self):
+        DeltaGame.create_self(self)
+        self.create_session()
+
+    # Sobrescrito de DeltaGame. Move a área para a posição atual do jogador.
+    def update(self, data):
+        DeltaGame.update(self, data)
+        attributes = self.player.get_data()
+        self.target = self.area(attributes['posx'], attributes['posy'])
+
+    # Sobrescrito de Poller. Se a sessão expirar, cria outra.
+    def run(self):
+        while self.session:
+            Poller.run(self)
+            if not self.create_session():
+                break
+
+
+# Jogo que recebe as modificações por WebSocket, um quadro por passo, sem
+# uma requisição HTTP por atualização.
+class SocketGame(DeltaGame):
+
+    # Sobrescrito de Poller. Abre a conexão e aplica cada quadro recebido.
+    # Quadros de passos já conhecidos são ignorados, a não ser que tragam o
+    # estado completo. Se encontrar erro na conexão, pára.
+    def run(self):
+        connection = websocket.Client(self.host, self.uri + '/state')
+        try:
+            while True:
+                data = json.loads(connection.receive().decode('utf-8'))
+                if data['full'] or data['sequence'] > self.sequence:
+                    self.update(data)
+        except ConnectionError:
+            pass
+        finally:
+            connection.close()
+
+
 # Interface textual.
 class Curses(threading.Thread):
 
@@ -380,10 +553,29 @@ if __name__ == "__main__":
             help='O identificador de recurso do jogo.')
     parser.add_argument('-r', '--refresh', default=0.05,
             help='O tempo entre redesenhos da tela.', type=float)
+    parser.add_argument('-m', '--mode', default='state',
+            choices=['objects', 'state', 'delta', 'socket', 'view'],
+            help='Como acompanhar o jogo: uma requisição por objeto (sem '
+                 'os projéteis, que não são recursos), uma única requisição '
+                 'pelo estado do jogo, somente pelas modificações desde o '
+                 'último passo, recebendo as modificações por WebSocket, ou '
+                 'somente os objetos em volta do jogador.')
+    parser.add_argument('-f', '--format', default='json',
+            choices=sorted(codec.TYPES),
+            help='O formato pedido ao servidor: JSON, MessagePack, ou '
+                 'registros binários de tamanho fixo (somente para o estado '
+                 'do jogo; outros recursos respondem em JSON).')
+    parser.add_argument('-z', '--gzip', action='store_true',
+            help='Pede as respostas em JSON comprimidas com gzip.')
     args = parser.parse_args()
+    Poller.accept = codec.TYPES[args.format]
+    Poller.compress = args.gzip
 
     # Cria o jogo.
-    g = Game(args.path, args.uri, args.name, args.password, args.script)
+    modes = {'objects': Game, 'state': StateGame, 'delta': DeltaGame,
+             'socket': SocketGame, 'view': ViewGame}
+    g = modes[args.mode](args.path, args.uri, args.name, args.password,
+                         args.script)
     g.create_self()
     g.start()
 
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+import threading
+import itertools
+import heapq
+import time
+
+
+# Relógio de passo fixo. Os passos são agendados em prazos absolutos, múltiplos
+# do período a partir do primeiro, de forma que o tempo gasto em cada passo
+# não atrasa os seguintes. Quando um passo termina depois do prazo do próximo,
+# o relógio está atrasado: os passos perdidos são descartados, ou executados
+# em seguida, até um limite. Mantém contadores da duração dos passos, dos
+# passos que excederam o período e do atraso.
+class Clock:
+
+    # Construtor. Recebe o período em segundos, e o número máximo de passos
+    # extras executados em seguida para recuperar o atraso (0 descarta os
+    # passos perdidos).
+    def __init__(self, period, catch_up=0):
+        self.period = period
+        self.catch_up = catch_up
+        self.deadline = None
+        self.lock = threading.Lock()
+
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.duration = 0
+        self.total = 0
+        self.longest = 0
+        self.lag = 0
+        self.max_lag = 0
+
+    # Retorna o prazo do próximo passo, em tempo monotônico. O primeiro prazo
+    # é um período após a primeira chamada.
+    def next_deadline(self):
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.period
+        return self.deadline
+
+    # Espera até o prazo do próximo passo. Retorna o número de passos a
+    # executar, como advance.
+    def wait(self):
+        now = time.monotonic()
+        deadline = self.next_deadline()
+        if now < deadline:
+            time.sleep(deadline - now)
+        return self.advance()
+
+    # Avança o relógio para depois do prazo do próximo passo, que já deve ter
+    # passado. Retorna o número de passos a executar: 1 se o relógio está em
+    # dia, ou mais, se está atrasado e pode recuperar o atraso. Os passos
+    # perdidos além disso são descartados.
+    def advance(self):
+        now = time.monotonic()
+        lag = max(0, now - self.next_deadline())
+        due = 1 + int(lag // self.period)
+        steps = min(due, 1 + self.catch_up)
+        self.deadline += due * self.period
+        with self.lock:
+            self.lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.skipped += due - steps
+        return steps
+
+    # Registra a duração de um passo, em segundos.
+    def record(self, duration):
+        with self.lock:
+            self.ticks += 1
+            self.duration = duration
+            self.total += duration
+            self.longest = max(self.longest, duration)
+            if duration > self.period:
+                self.overruns += 1
+
+    # Retorna os contadores, com tempos em segundos.
+    def get_data(self):
+        with self.lock:
+            return {'period': self.period,
+                    'catch_up': self.catch_up,
+                    'ticks': self.ticks,
+                    'overruns': self.overruns,
+                    'skipped': self.skipped,
+                    'duration': self.duration,
+                    'mean_duration': self.total / max(1, self.ticks),
+                    'max_duration': self.longest,
+                    'lag': self.lag,
+                    'max_lag': self.max_lag}
+
+
+# Agenda os passos de vários jogos, cada um com seu próprio relógio, em um
+# número fixo de threads, ao invés de uma thread por jogo. Os jogos ficam em um
+# heap ordenado pelo prazo do próximo passo. Cada thread retira o jogo de prazo
+# mais próximo, espera até ele, executa seus passos e o devolve ao heap, de
+# forma que um jogo nunca é executado por duas threads ao mesmo tempo. Um jogo
+# deve ter um relógio (clock) e um método tick, que recebe o número de passos
+# a executar.
+class Scheduler:
+
+    # Construtor. Recebe o número de threads.
+    def __init__(self, workers=4):
+        self.heap = []
+        self.entries = {}
+        self.count = itertools.count()
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self.work, daemon=True)
+                        for i in range(workers)]
+
+    # Inicia as threads.
+    def start(self):
+        for t in self.threads:
+            t.start()
+
+    # Insere um jogo no heap, no prazo do seu próximo passo. Deve ser chamado
+    # com a condição adquirida.
+    def push(self, game):
+        entry = next(self.count)
+        self.entries[game] = entry
+        heapq.heappush(self.heap, (game.clock.next_deadline(), entry, game))
+        self.condition.notify()
+
+    # Adiciona um jogo.
+    def add(self, game):
+        with self.condition:
+            self.push(game)
+
+    # Remove um jogo. Se estiver sendo executado, o passo atual termina, mas
+    # não há outro.
+    def remove(self, game):
+        with self.condition:
+            self.entries.pop(game, None)
+
+    # Retorna o número de jogos agendados.
+    def __len__(self):
+        with self.condition:
+            return len(self.entries)
+
+    # Retira do heap o próximo jogo, esperando até o prazo do seu passo.
+    # Entradas de jogos removidos, ou reinseridos, são descartadas.
+    def pop(self):
+        with self.condition:
+            while True:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                deadline, entry, game = self.heap[0]
+                if self.entries.get(game) != entry:
+                    heapq.heappop(self.heap)
+                    continue
+                now = time.monotonic()
+                if now < deadline:
+                    self.condition.wait(deadline - now)
+                    continue
+                heapq.heappop(self.heap)
+                return game, entry
+
+    # Executa os passos dos jogos, indefinidamente.
+    def work(self):
+        while True:
+            game, entry = self.pop()
+            game.tick(game.clock.advance())
+            with self.condition:
+                if self.entries.get(game) == entry:
+                    self.push(game)
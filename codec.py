@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+import struct
+import gzip
+import json
+
+import world
+
+
+# Formatos das respostas, negociados pelos campos Accept e Accept-Encoding do
+# cabeçalho da requisição. Um formato é uma tupla (tipo, gzip). JSON é o
+# padrão, e o único comprimido com gzip, se o cliente aceitar. Os formatos
+# binários são menores e não repetem os nomes dos atributos.
+
+# Tipos suportados.
+JSON = 'text/json'
+MSGPACK = 'application/x-msgpack'
+RECORDS = 'application/x-script-battle-records'
+
+# Nomes dos tipos, para a linha de comando do cliente.
+TYPES = {'json': JSON, 'msgpack': MSGPACK, 'records': RECORDS}
+
+# Sinônimos aceitos no campo Accept.
+ALIASES = {'application/json': JSON, 'application/msgpack': MSGPACK,
+           '*/*': JSON, 'text/*': JSON, 'application/*': JSON}
+
+# Formato usado quando o cliente não pede nenhum.
+DEFAULT = (JSON, False)
+
+# Respostas menores que isso não são comprimidas.
+GZIP_MINIMUM = 256
+
+
+# Separa um campo de cabeçalho em uma lista de valores, em ordem de
+# preferência (parâmetro "q"), descartando os recusados (q=0).
+def preferences(field):
+    values = []
+    for i, item in enumerate(field.split(',')):
+        value, *parameters = [p.strip() for p in item.split(';')]
+        q = 1.0
+        for p in parameters:
+            if p.startswith('q='):
+                try:
+                    q = float(p[2:])
+                except ValueError:
+                    q = 0
+        if value and q > 0:
+            values.append((-q, i, value.lower()))
+    return [v for _, _, v in sorted(values)]
+
+
+# Escolhe o formato de uma resposta a partir dos campos Accept e
+# Accept-Encoding do cabeçalho.
+def negotiate(accept, accept_encoding):
+    media = JSON
+    for value in preferences(accept or ''):
+        value = ALIASES.get(value, value)
+        if value in TYPES.values():
+            media = value
+            break
+    encodings = preferences(accept_encoding or '')
+    return media, 'gzip' in encodings or '*' in encodings
+
+
+# Codifica um valor no formato dado. Retorna o corpo e os campos de cabeçalho
+# que o descrevem. Valores que não podem ser representados como registros são
+# codificados em JSON.
+def encode(value, form):
+    media, compress = form
+    body = None
+    if media == RECORDS:
+        try:
+            body = Records.encode(value)
+        except (ValueError, TypeError, KeyError, struct.error):
+            media = JSON
+    if media == MSGPACK:
+        body = pack(value)
+    elif media == JSON:
+        body = bytes(json.dumps(value), 'utf-8')
+
+    headers = [('Content-Type', media),
+               ('Vary', 'Accept, Accept-Encoding')]
+    if compress and media == JSON and len(body) >= GZIP_MINIMUM:
+        body = gzip.compress(body, 6)
+        headers.append(('Content-Encoding', 'gzip'))
+    return body, headers
+
+
+# Decodifica um corpo a partir dos campos Content-Type e Content-Encoding do
+# cabeçalho da resposta.
+def decode(body, content_type, content_encoding=None):
+    if content_encoding == 'gzip':
+        body = gzip.decompress(body)
+    media = (content_type or JSON).split(';')[0].strip().lower()
+    if media == MSGPACK:
+        return unpack(body)
+    if media == RECORDS:
+        return Records.decode(body)
+    return json.loads(body.decode('utf-8'))
+
+
+# Codificação no estilo do MessagePack (https://msgpack.org), suficiente para
+# os valores da API: None, booleanos, inteiros, números reais, strings, bytes,
+# listas e dicionários.
+def pack(value, out=None):
+    if out is None:
+        out = bytearray()
+        pack(value, out)
+        return bytes(out)
+
+    if value is None:
+        out.append(0xc0)
+    elif value is True:
+        out.append(0xc3)
+    elif value is False:
+        out.append(0xc2)
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            out.append(value)
+        elif -0x20 <= value < 0:
+            out.append(value & 0xff)
+        elif 0 <= value < 1 << 64:
+            for code, fmt in [(0xcc, '>B'), (0xcd, '>H'), (0xce, '>I'),
+                              (0xcf, '>Q')]:
+                if value < 1 << (8 * struct.calcsize(fmt)):
+                    out.append(code)
+                    out += struct.pack(fmt, value)
+                    break
+        elif -(1 << 63) <= value < 0:
+            for code, fmt in [(0xd0, '>b'), (0xd1, '>h'), (0xd2, '>i'),
+                              (0xd3, '>q')]:
+                if value >= -(1 << (8 * struct.calcsize(fmt) - 1)):
+                    out.append(code)
+                    out += struct.pack(fmt, value)
+                    break
+        else:
+            raise ValueError('inteiro grande demais: %d' % value)
+    elif isinstance(value, float):
+        out.append(0xcb)
+        out += struct.pack('>d', value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        n = len(data)
+        if n < 32:
+            out.append(0xa0 | n)
+        elif n < 1 << 8:
+            out += struct.pack('>BB', 0xd9, n)
+        elif n < 1 << 16:
+            out += struct.pack('>BH', 0xda, n)
+        else:
+            out += struct.pack('>BI', 0xdb, n)
+        out += data
+    elif isinstance(value, (bytes, bytearray)):
+        n = len(value)
+        if n < 1 << 8:
+            out += struct.pack('>BB', 0xc4, n)
+        elif n < 1 << 16:
+            out += struct.pack('>BH', 0xc5, n)
+        else:
+            out += struct.pack('>BI', 0xc6, n)
+        out += value
+    elif isinstance(value, (list, tuple)):
+        n = len(value)
+        if n < 16:
+            out.append(0x90 | n)
+        elif n < 1 << 16:
+            out += struct.pack('>BH', 0xdc, n)
+        else:
+            out += struct.pack('>BI', 0xdd, n)
+        for v in value:
+            pack(v, out)
+    elif isinstance(value, dict):
+        n = len(value)
+        if n < 16:
+            out.append(0x80 | n)
+        elif n < 1 << 16:
+            out += struct.pack('>BH', 0xde, n)
+        else:
+            out += struct.pack('>BI', 0xdf, n)
+        for k, v in value.items():
+            pack(k, out)
+            pack(v, out)
+    else:
+        raise TypeError('tipo não suportado: %s' % type(value).__name__)
+    return out
+
+
+# Formatos dos valores de tamanho fixo do MessagePack, por código.
+FIXED = {0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q',
+         0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q',
+         0xca: '>f', 0xcb: '>d'}
+
+# Formatos dos tamanhos de strings, bytes, listas e dicionários, por código.
+SIZES = {0xd9: ('>B', str), 0xda: ('>H', str), 0xdb: ('>I', str),
+         0xc4: ('>B', bytes), 0xc5: ('>H', bytes), 0xc6: ('>I', bytes),
+         0xdc: ('>H', list), 0xdd: ('>I', list),
+         0xde: ('>H', dict), 0xdf: ('>I', dict)}
+
+
+# Decodifica um valor codificado por pack.
+def unpack(data):
+    value, offset = unpack_from(memoryview(data), 0)
+    return value
+
+
+# Decodifica um valor a partir de uma posição. Retorna o valor e a posição
+# seguinte a ele.
+def unpack_from(data, offset):
+    code = data[offset]
+    offset += 1
+    if code < 0x80:
+        return code, offset
+    if code >= 0xe0:
+        return code - 0x100, offset
+    if code == 0xc0:
+        return None, offset
+    if code in [0xc2, 0xc3]:
+        return code == 0xc3, offset
+    if code in FIXED:
+        fmt = FIXED[code]
+        return (struct.unpack_from(fmt, data, offset)[0],
+                offset + struct.calcsize(fmt))
+
+    if 0xa0 <= code < 0xc0:
+        kind, n = str, code & 0x1f
+    elif 0x90 <= code < 0xa0:
+        kind, n = list, code & 0x0f
+    elif 0x80 <= code < 0x90:
+        kind, n = dict, code & 0x0f
+    elif code in SIZES:
+        fmt, kind = SIZES[code]
+        n = struct.unpack_from(fmt, data, offset)[0]
+        offset += struct.calcsize(fmt)
+    else:
+        raise ValueError('código não suportado: 0x%02x' % code)
+
+    if kind is str:
+        return str(data[offset:offset + n], 'utf-8'), offset + n
+    if kind is bytes:
+        return bytes(data[offset:offset + n]), offset + n
+    if kind is list:
+        value = []
+        for i in range(n):
+            v, offset = unpack_from(data, offset)
+            value.append(v)
+        return value, offset
+    value = {}
+    for i in range(n):
+        k, offset = unpack_from(data, offset)
+        value[k], offset = unpack_from(data, offset)
+    return value, offset
+
+
+# Formato binário de registros de tamanho fixo, um por objeto, para o estado
+# do jogo e suas modificações. Cada registro tem o URN do objeto, uma máscara
+# dos atributos presentes e os valores de todos os atributos, em ordem fixa,
+# de forma que objetos com somente alguns atributos modificados também são
+# representados. O conteúdo começa com uma assinatura, a versão do formato e o
+# tipo: um mapa de objetos, como em GET /game/state, ou as modificações desde
+# um passo, como em GET /game/state?since=[passo].
+class Records:
+
+    SIGNATURE = b'SB'
+    VERSION = 1
+    OBJECTS = 0
+    DELTA = 1
+
+    HEADER = struct.Struct('<2sBB')
+    FIELDS = ['hp', 'type', 'posx', 'posy', 'movx', 'movy', 'lookx', 'looky',
+              'shots', 'shooting', 'kills']
+    RECORD = struct.Struct('<Hi B 6i i ? i')
+    COUNT = struct.Struct('<I')
+    SEQUENCE = struct.Struct('<q?')
+    NAME = struct.Struct('<H')
+
+    # Codifica um mapa de objetos ou as modificações desde um passo. Levanta
+    # ValueError se o valor não for um deles.
+    @classmethod
+    def encode(cls, value):
+        if not isinstance(value, dict):
+            raise ValueError('não é um mapa de objetos')
+        out = bytearray()
+        if 'sequence' in value and 'full' in value:
+            out += cls.HEADER.pack(cls.SIGNATURE, cls.VERSION, cls.DELTA)
+            out += cls.SEQUENCE.pack(value['sequence'], value['full'])
+            cls.encode_objects(value['added'], out)
+            out += cls.COUNT.pack(len(value['removed']))
+            for urn in value['removed']:
+                cls.encode_name(urn, out)
+            cls.encode_objects(value['changed'], out)
+        else:
+            out += cls.HEADER.pack(cls.SIGNATURE, cls.VERSION, cls.OBJECTS)
+            cls.encode_objects(value, out)
+        return bytes(out)
+
+    # Codifica um URN.
+    @classmethod
+    def encode_name(cls, urn, out):
+        data = urn.encode('utf-8')
+        out += cls.NAME.pack(len(data))
+        out += data
+
+    # Codifica um mapa de URNs para atributos.
+    @classmethod
+    def encode_objects(cls, objects, out):
+        out += cls.COUNT.pack(len(objects))
+        for urn, attributes in objects.items():
+            if not isinstance(attributes, dict):
+                raise ValueError('não é um mapa de objetos')
+            if attributes.keys() - cls.FIELDS:
+                raise ValueError('atributos desconhecidos')
+            mask = 0
+            values = []
+            for i, name in enumerate(cls.FIELDS):
+                value = attributes.get(name)
+                if value is not None:
+                    mask |= 1 << i
+                if name == 'type':
+                    value = world.TYPES.index(value)
+                values.append(value or 0)
+            cls.encode_name(urn, out)
+            out += cls.RECORD.pack(mask, *values)
+
+    # Decodifica o conteúdo codificado por encode.
+    @classmethod
+    def decode(cls, data):
+        data = memoryview(data)
+        signature, version, kind = cls.HEADER.unpack_from(data, 0)
+        if signature != cls.SIGNATURE or version != cls.VERSION:
+            raise ValueError('formato desconhecido')
+        offset = cls.HEADER.size
+        if kind == cls.OBJECTS:
+            return cls.decode_objects(data, offset)[0]
+
+        sequence, full = cls.SEQUENCE.unpack_from(data, offset)
+        added, offset = cls.decode_objects(data,
+                                           offset + cls.SEQUENCE.size)
+        n = cls.COUNT.unpack_from(data, offset)[0]
+        offset += cls.COUNT.size
+        removed = []
+        for i in range(n):
+            urn, offset = cls.decode_name(data, offset)
+            removed.append(urn)
+        changed, offset = cls.decode_objects(data, offset)
+        return {'sequence': sequence, 'full': full, 'added': added,
+                'removed': removed, 'changed': changed}
+
+    # Decodifica um URN. Retorna o URN e a posição seguinte a ele.
+    @classmethod
+    def decode_name(cls, data, offset):
+        n = cls.NAME.unpack_from(data, offset)[0]
+        offset += cls.NAME.size
+        return str(data[offset:offset + n], 'utf-8'), offset + n
+
+    # Decodifica um mapa de URNs para atributos. Retorna o mapa e a posição
+    # seguinte a ele.
+    @classmethod
+    def decode_objects(cls, data, offset):
+        n = cls.COUNT.unpack_from(data, offset)[0]
+        offset += cls.COUNT.size
+        objects = {}
+        for i in range(n):
+            urn, offset = cls.decode_name(data, offset)
+            mask, *values = cls.RECORD.unpack_from(data, offset)
+            offset += cls.RECORD.size
+            attributes = {}
+            for j, name in enumerate(cls.FIELDS):
+                if mask & 1 << j:
+                    attributes[name] = values[j]
+            if 'type' in attributes:
+                attributes['type'] = world.TYPES[attributes['type']]
+            objects[urn] = attributes
+        return objects, offset
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import itertools
+import argparse
+import hashlib
+import base64
+import timeit
+import sys
+import os
+
+
+# Geradores de identificadores (URNs) para recursos criados sem um nome. Os
+# identificadores são internados, de forma que comparações nas buscas por
+# recursos são feitas por referência sempre que possível.
+
+# Alfabeto da codificação base32 (RFC 4648), em minúsculas.
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz234567'
+
+
+# Retorna um prefixo aleatório, diferente a cada execução do servidor, de
+# forma que identificadores de execuções diferentes não coincidem.
+def random_prefix():
+    return base64.b32encode(os.urandom(5)).decode('ascii').lower()
+
+
+# Contador monotônico com o prefixo do servidor. Exemplo: "mfrggzdf-42".
+class Counter:
+
+    # Construtor. Recebe o prefixo; se não dado, usa um aleatório.
+    def __init__(self, prefix=None):
+        self.prefix = (prefix or random_prefix()) + '-'
+        self.count = itertools.count(1)
+
+    # Retorna o próximo identificador.
+    def __call__(self):
+        return sys.intern(self.prefix + str(next(self.count)))
+
+
+# Contador monotônico codificado em base32, mais compacto que o decimal para
+# contagens grandes. Exemplo: "mfrggzdf-bk".
+class Base32(Counter):
+
+    # Sobrescrito de Counter.
+    def __call__(self):
+        n = next(self.count)
+        digits = []
+        while n:
+            n, digit = divmod(n, 32)
+            digits.append(ALPHABET[digit])
+        return sys.intern(self.prefix + ''.join(reversed(digits)))
+
+
+# Identificadores aleatórios, como MD5 de 4 KB aleatórios, compatível com as
+# versões anteriores do servidor. Requer uma chamada de sistema e um hash por
+# identificador.
+class Random:
+
+    # Construtor. Não há prefixo.
+    def __init__(self, prefix=None):
+        pass
+
+    # Retorna um identificador.
+    def __call__(self):
+        return sys.intern(hashlib.md5(os.urandom(4096)).hexdigest())
+
+
+# Estratégias disponíveis, por nome.
+GENERATORS = {'counter': Counter, 'base32': Base32, 'random': Random}
+
+# Gerador usado pelo servidor.
+generator = Counter()
+
+
+# Troca o gerador usado pelo servidor pela estratégia de nome dado.
+def use(name, prefix=None):
+    global generator
+    generator = GENERATORS[name](prefix)
+
+
+# Retorna um novo identificador do gerador usado pelo servidor.
+def generate():
+    return generator()
+
+
+# Main. Compara o custo de cada estratégia, para gerar um identificador e
+# para buscá-lo em um dicionário com uma cópia não internada da chave, como
+# na busca de um recurso a partir do caminho da requisição.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Microbenchmark dos geradores de identificadores.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--number', type=int, default=100000,
+            help='O número de identificadores gerados por estratégia.')
+    args = parser.parse_args()
+
+    print('%-8s %12s %12s %8s' % ('', 'gerar (us)', 'buscar (us)', 'tamanho'))
+    for name, cls in GENERATORS.items():
+        new = cls()
+        seconds = timeit.timeit(new, number=args.number)
+        table = {new(): None for i in range(args.number)}
+        keys = [''.join(list(k)) for k in table]
+        lookup = timeit.timeit(lambda: [table[k] for k in keys], number=1)
+        print('%-8s %12.3f %12.3f %8d' % (
+                name, 1e6 * seconds / args.number, 1e6 * lookup / len(keys),
+                len(keys[-1])))
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import threading
+import weakref
+import struct
+import queue
+import time
+
+import workers
+import metrics
+import codec
+
+
+# Diário de um jogo: um registro binário, somente de acréscimos, de tudo que
+# entra no jogo de fora da simulação, suficiente para reproduzi-lo (veja
+# replay.py). O arquivo começa com uma assinatura, seguida de registros no
+# formato do MessagePack (codec.pack), cada um uma lista cujo primeiro item é
+# o tipo do registro:
+#
+# * ["start", semente, intervalo, vetorizado]: início de um jogo. Um arquivo
+#   pode ter vários jogos, um por execução do servidor.
+# * ["add", id, URN, atributos, script]: objeto adicionado (jogador ou pedra).
+#   O script é None para pedras. As senhas não são registradas.
+# * ["script", id, script]: script de um jogador alterado.
+# * ["delete", id]: jogador removido por um cliente.
+# * ["restore", passo, tiros, projéteis]: jogo restaurado de um ponto de
+#   restauração (veja checkpoint.py), após a adição de seus objetos: o passo e
+#   o número de tiros a partir dos quais o jogo continua, e uma lista dos
+#   projéteis em voo, cada um uma lista com o URN, os atributos, o id do
+#   jogador que o disparou (ou seu URN, se ele já tinha saído do jogo) e o
+#   alcance restante.
+# * ["tick", passo, controles]: scripts executados em um passo. Os controles
+#   são uma lista, na ordem de execução, com um item por objeto cujo script
+#   teve efeito: o id, se os atributos de controle (workers.CONTROLS) não
+#   mudaram desde seu último registro, ou uma lista com o id e um dicionário
+#   que mapeia o índice de cada atributo de controle modificado para o valor.
+#
+# As alterações dos clientes são aplicadas pelo jogo no início de cada passo
+# (veja server.Commands), então seus registros ficam sempre entre os registros
+# de dois passos. Os objetos são identificados por ids sequenciais, na ordem
+# de adição, e esquecidos quando deixam de existir. Os registros são
+# acumulados em memória e gravados em lotes por uma thread própria, para que o
+# jogo não espere pelo disco.
+SIGNATURE = b'SBJ\x01'
+
+
+# Escritor do diário.
+class Journal(threading.Thread):
+
+    # Construtor. Recebe o caminho do arquivo, o tamanho em bytes a partir do
+    # qual os registros acumulados são enviados para gravação, e o intervalo
+    # de tempo máximo em segundos entre gravações.
+    def __init__(self, path, size=65536, interval=1):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.size = size
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.buffer = bytearray()
+        self.sent = time.monotonic()
+        self.ids = weakref.WeakKeyDictionary()
+        self.controls = weakref.WeakKeyDictionary()
+        self.count = 0
+        self.lock = threading.Lock()
+
+    # Acrescenta um registro aos acumulados. Deve ser chamado com o lock
+    # adquirido. Um registro que não pode ser codificado não é acrescentado
+    # pela metade.
+    def append(self, record):
+        self.buffer += codec.pack(record)
+
+    # Envia os registros acumulados para gravação se forem muitos, ou se o
+    # intervalo tiver passado. Deve ser chamado com o lock adquirido.
+    def send(self, force=False):
+        now = time.monotonic()
+        if self.buffer and (force or len(self.buffer) >= self.size or
+                            now - self.sent >= self.interval):
+            self.queue.put(bytes(self.buffer))
+            self.buffer.clear()
+            self.sent = now
+
+    # Registra o início de um jogo.
+    def start_game(self, game):
+        with self.lock:
+            self.ids.clear()
+            self.controls.clear()
+            self.append(['start', game.seed, game.time_step,
+                         game.world is not None])
+
+    # Registra a adição de um objeto, já com seu URN.
+    def add(self, obj):
+        with self.lock:
+            self.count += 1
+            self.ids[obj] = self.count
+            self.append(['add', self.count, obj.urn, obj.copy(),
+                         getattr(obj, 'script', None)])
+
+    # Registra a alteração do script de um jogador.
+    def script(self, player):
+        with self.lock:
+            if player in self.ids:
+                self.append(['script', self.ids[player], player.script])
+
+    # Registra a remoção de um jogador por um cliente.
+    def delete(self, player):
+        with self.lock:
+            if player in self.ids:
+                self.controls.pop(player, None)
+                self.append(['delete', self.ids.pop(player)])
+
+    # Registra a restauração de um jogo, com seus projéteis.
+    def restore(self, game):
+        projectiles = list(game.projectiles.values())
+        ranges = game.ranges(projectiles)
+        with self.lock:
+            self.append(['restore', game.sequence, game.shots, [
+                    [p.urn, p.copy(), self.ids.get(p.player, p.player.urn), r]
+                    for p, r in zip(projectiles, ranges)]])
+
+    # Registra os atributos de controle dos objetos dados, cujos scripts
+    # tiveram efeito no passo dado, em ordem.
+    def tick(self, sequence, players):
+        controls = [[p.attributes[i] for i in workers.CONTROLS]
+                    for p in players]
+
+        with self.lock:
+            entries = []
+            for p, values in zip(players, controls):
+                if p not in self.ids:
+                    continue
+                previous = self.controls.get(p)
+                self.controls[p] = values
+                if previous == values:
+                    entries.append(self.ids[p])
+                    continue
+                entries.append([self.ids[p], {
+                        i: v for i, v in enumerate(values)
+                        if previous is None or previous[i] != v}])
+            self.append(['tick', sequence, entries])
+            self.send()
+
+    # Sobrescrito de Thread. Grava os lotes recebidos, em ordem, até receber
+    # None.
+    def run(self):
+        with open(self.path, 'ab') as f:
+            if f.tell() == 0:
+                f.write(SIGNATURE)
+            while True:
+                data = self.queue.get()
+                if data is None:
+                    break
+                with metrics.journals.time():
+                    f.write(data)
+                    f.flush()
+
+    # Grava os registros pendentes e termina a thread.
+    def close(self):
+        with self.lock:
+            self.send(True)
+        self.queue.put(None)
+        self.join()
+
+
+# Lê os registros de um diário. Retorna um iterador sobre eles, em ordem.
+# Levanta ValueError se o arquivo não for um diário.
+def read(path):
+    with open(path, 'rb') as f:
+        data = memoryview(f.read())
+    if data[:len(SIGNATURE)] != SIGNATURE:
+        raise ValueError('%s não é um diário' % path)
+    return records(data, len(SIGNATURE))
+
+
+# Gera os registros de um diário a partir de uma posição. Um registro
+# incompleto no final, de um servidor interrompido durante a gravação, é
+# ignorado.
+def records(data, offset):
+    while offset < len(data):
+        try:
+            record, offset = codec.unpack_from(data, offset)
+        except (IndexError, ValueError, UnicodeDecodeError, struct.error):
+            return
+        if offset > len(data):
+            return
+        yield record
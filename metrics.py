@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+import bisect
+import time
+import sys
+import os
+
+
+# Limites superiores dos intervalos dos histogramas, em segundos.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# Mede o tempo de um bloco "with", registrando-o em um histograma.
+class Timer:
+
+    __slots__ = ('histogram', 'labels', 'start')
+
+    # Construtor. Recebe o histograma e os valores dos rótulos.
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+# Histograma de durações, mantido em memória. Cada combinação de valores dos
+# rótulos tem suas próprias contagens por intervalo, soma e total.
+class Histogram:
+
+    # Construtor. Recebe o nome, a descrição, os nomes dos rótulos e os
+    # limites dos intervalos.
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    # Registra uma duração, em segundos, com os valores dados dos rótulos.
+    def observe(self, seconds, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0, 0]
+            i = bisect.bisect_left(self.buckets, seconds)
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    # Retorna um Timer que registra neste histograma a duração de um bloco
+    # "with".
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    # Retorna as linhas do histograma no formato de texto do Prometheus.
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s histogram' % self.name]
+        with self.lock:
+            series = [(k, list(v[0]), v[1], v[2])
+                      for k, v in sorted(self.series.items())]
+        for values, counts, total, count in series:
+            labels = ['%s="%s"' % l for l in zip(self.labels, values)]
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append('%s_bucket{%s} %d' % (
+                        self.name, ','.join(labels + ['le="%g"' % bound]),
+                        cumulative))
+            lines.append('%s_bucket{%s} %d' % (
+                    self.name, ','.join(labels + ['le="+Inf"']), count))
+            suffix = '{%s}' % ','.join(labels) if labels else ''
+            lines.append('%s_sum%s %.9f' % (self.name, suffix, total))
+            lines.append('%s_count%s %d' % (self.name, suffix, count))
+        return lines
+
+
+# Contador, mantido em memória. Cada combinação de valores dos rótulos tem
+# seu próprio total.
+class Counter:
+
+    # Construtor. Recebe o nome, a descrição e os nomes dos rótulos.
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.series = collections.Counter()
+        self.lock = threading.Lock()
+
+    # Soma um valor ao total com os valores dados dos rótulos.
+    def add(self, value, *labels):
+        with self.lock:
+            self.series[labels] += value
+
+    # Retorna as linhas do contador no formato de texto do Prometheus.
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s counter' % self.name]
+        with self.lock:
+            series = sorted(self.series.items())
+        for values, total in series:
+            labels = ['%s="%s"' % l for l in zip(self.labels, values)]
+            suffix = '{%s}' % ','.join(labels) if labels else ''
+            lines.append('%s%s %d' % (self.name, suffix, total))
+        return lines
+
+
+# Conjunto de histogramas e contadores de um processo.
+class Registry:
+
+    # Construtor.
+    def __init__(self):
+        self.metrics = []
+
+    # Cria e registra um histograma.
+    def histogram(self, name, description, labels=()):
+        histogram = Histogram(name, description, labels)
+        self.metrics.append(histogram)
+        return histogram
+
+    # Cria e registra um contador.
+    def counter(self, name, description, labels=()):
+        counter = Counter(name, description, labels)
+        self.metrics.append(counter)
+        return counter
+
+    # Retorna todos os histogramas e contadores no formato de texto do
+    # Prometheus.
+    def render(self):
+        lines = []
+        for m in self.metrics:
+            lines += m.render()
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# Durações medidas pelo servidor.
+ticks = registry.histogram('game_tick_seconds',
+                           'Duração de um passo do jogo.')
+phases = registry.histogram('game_tick_phase_seconds',
+                            'Duração de cada fase de um passo do jogo.',
+                            ('phase',))
+requests = registry.histogram('http_request_seconds',
+                              'Duração das requisições, incluindo a espera '
+                              'de GET por modificações.',
+                              ('method', 'resource'))
+flushes = registry.histogram('scores_flush_seconds',
+                             'Duração da gravação de um lote de kills.')
+journals = registry.histogram('journal_write_seconds',
+                              'Duração da gravação de um lote do diário.')
+checkpoints = registry.histogram('checkpoint_write_seconds',
+                                 'Duração da gravação de um ponto de '
+                                 'restauração.')
+
+# Contagens do servidor.
+commands = registry.counter('game_commands_total',
+                            'Comandos dos clientes aplicados pelos jogos, '
+                            'ou recusados com a fila cheia.',
+                            ('command', 'result'))
+
+
+# Profiler por amostragem. Uma thread copia periodicamente as pilhas de
+# chamadas de todas as outras threads, e conta quantas vezes cada pilha foi
+# vista. O resultado é gravado no formato "collapsed" (uma pilha por linha,
+# da raíz à folha, separada por ';', seguida da contagem), usado para gerar
+# flamegraphs.
+class Profiler(threading.Thread):
+
+    # Construtor. Recebe o arquivo de saída e o intervalo entre amostras, em
+    # segundos.
+    def __init__(self, path, interval=0.005):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+
+    # Retorna o nome de uma função em uma pilha, precedido pelo nome do
+    # módulo, ou do arquivo, para o programa principal. O nome qualificado,
+    # com a classe, só existe a partir do Python 3.11.
+    def label(self, frame):
+        code = frame.f_code
+        module = frame.f_globals.get('__name__')
+        if module in [None, '__main__']:
+            module = os.path.basename(code.co_filename)
+        name = getattr(code, 'co_qualname', code.co_name)
+        return '%s:%s' % (module, name)
+
+    # Registra as pilhas de todas as threads, exceto a própria.
+    def sample(self):
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self.label(frame))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    # Sobrescrito de Thread.
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    # Pára de amostrar e grava as pilhas.
+    def close(self):
+        self.stopped.set()
+        self.join()
+        with open(self.path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
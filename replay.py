@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import time
+import sys
+
+import workers
+import journal
+import metrics
+import server
+import world
+
+
+# Jogo reproduzido a partir de um diário (veja journal.py), sem HTTP e sem
+# esperar pelo relógio: cada registro de passo executa um passo em seguida. Os
+# scripts não são executados; os controles registrados são aplicados no lugar
+# deles, na mesma ordem, de forma que o resultado não depende do tempo que os
+# scripts levaram. Alterações dos clientes são aplicadas antes do passo
+# seguinte, como o jogo as aplica.
+class Replay(server.Game):
+
+    # Construtor. Recebe os dados do registro de início do jogo. Se scripts
+    # for verdadeiro, executa os scripts como o jogo, ao invés de aplicar os
+    # controles registrados, para medir também o seu custo.
+    def __init__(self, seed, time_step, vectorized, scripts=False):
+        server.Game.__init__(self, time_step, vectorized=vectorized,
+                             seed=seed)
+        self.scripts = scripts
+        self.objects = {}
+        self.controls = {}
+        self.entries = []
+        self.last = 0
+        self.ticks = 0
+
+    # Aplica um registro do diário.
+    def apply(self, record):
+        getattr(self, 'apply_' + record[0])(*record[1:])
+
+    # Adiciona um objeto, com os atributos registrados.
+    def apply_add(self, id, urn, attributes, script):
+        if script is None:
+            obj = server.Rock(attributes['posx'], attributes['posy'])
+        else:
+            code, error = server.compile_script(script)
+            obj = server.Player(urn, None, script, code)
+        obj.attributes.update(attributes)
+        self.objects[id] = obj
+        self.add_child(obj, urn)
+
+    # Altera o script de um jogador.
+    def apply_script(self, id, script):
+        player = self.objects.get(id)
+        if player is not None:
+            player.script = script
+            player.code, error = server.compile_script(script)
+            player.key = server.scripts.key(script)
+
+    # Remove um jogador.
+    def apply_delete(self, id):
+        obj = self.objects.pop(id, None)
+        self.controls.pop(id, None)
+        if obj is not None and not obj.removed:
+            obj.delete()
+
+    # Continua de um ponto de restauração, com os projéteis em voo. Os donos
+    # que já tinham saído do jogo são identificados pelo URN.
+    def apply_restore(self, sequence, shots, projectiles):
+        detached = {}
+        for urn, attributes, owner, distance in projectiles:
+            if isinstance(owner, str):
+                if owner not in detached:
+                    detached[owner] = self.detached(owner)
+                player = detached[owner]
+            else:
+                player = self.objects[owner]
+            self.add_projectile(server.Projectile(
+                    player, attributes, urn, distance))
+        self.shots = shots
+        self.sequence = self.modified = self.horizon = self.last = sequence
+
+    # Executa um passo com os controles registrados. Ao final, esquece os
+    # objetos removidos durante o passo.
+    def apply_tick(self, sequence, entries):
+        self.entries = entries
+        self.step()
+        self.last = sequence
+        self.ticks += 1
+        for id in [i for i, o in self.objects.items() if o.removed]:
+            del self.objects[id]
+            self.controls.pop(id, None)
+
+    # Sobrescrito de Game. Aplica os controles registrados para o passo, como
+    # se os scripts os tivessem retornado. Objetos removidos no próprio passo
+    # ainda os aplicam, como no jogo.
+    def execute(self, players):
+        if self.scripts:
+            return server.Game.execute(self, players)
+        for entry in self.entries:
+            id, changes = (entry, {}) if isinstance(entry, int) else entry
+            controls = self.controls.setdefault(id, {})
+            for i, value in changes.items():
+                controls[workers.CONTROLS[i]] = value
+            obj = self.objects.get(id)
+            if obj is not None:
+                obj.apply(controls)
+        return [p for p in players if p.dirty]
+
+    # Retorna um resumo do estado publicado ao final do último passo. O
+    # resumo é o mesmo em toda reprodução do mesmo diário.
+    def digest(self):
+        data = json.dumps(self.published, sort_keys=True)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+# Retorna a duração média de cada fase dos passos, em milissegundos.
+def phases():
+    with metrics.phases.lock:
+        series = dict(metrics.phases.series)
+    return {labels[0]: 1000 * total / count
+            for labels, (_, total, count) in sorted(series.items())}
+
+
+# Main. Reproduz um jogo de um diário o mais rápido possível, e escreve o
+# tempo gasto e o estado final. Serve tanto para depurar um jogo, parando
+# antes de um passo, quanto como um benchmark repetível da simulação.
+if __name__ == '__main__':
+    # Cria argumentos de linha de comando.
+    parser = argparse.ArgumentParser(
+            description='Reproduz um jogo a partir de um diário gravado com '
+                        'server.py --journal.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('journal', type=str,
+            help='O arquivo do diário.')
+    parser.add_argument('-g', '--game', type=int, default=0,
+            help='O índice do jogo no diário, que tem um jogo por execução '
+                 'do servidor.')
+    parser.add_argument('-u', '--until', type=int, default=0,
+            help='O último passo reproduzido (0 reproduz todos).')
+    parser.add_argument('--scripts', action='store_true',
+            help='Executa os scripts, ao invés de aplicar os controles '
+                 'registrados.')
+    parser.add_argument('-o', '--output', type=str,
+            help='Grava o estado final do jogo neste arquivo, em JSON.')
+    parser.add_argument('-c', '--compare', action='store_true',
+            help='Reproduz o jogo também no outro modo (com ou sem --numpy), '
+                 'e termina com erro no primeiro passo em que os estados '
+                 'publicados diferem. Requer NumPy.')
+    args = parser.parse_args()
+
+    try:
+        records = journal.read(args.journal)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    if args.compare and not world.available():
+        parser.error('--compare requer NumPy.')
+
+    # Reproduz os registros do jogo escolhido, e no outro modo, se pedido.
+    game = None
+    other = None
+    index = -1
+    start = time.perf_counter()
+    for record in records:
+        if record[0] == 'start':
+            index += 1
+            if index > args.game:
+                break
+            if index == args.game:
+                seed, time_step, vectorized = record[1:]
+                if vectorized and not world.available():
+                    parser.error('o jogo foi gravado com --numpy, que '
+                                 'requer NumPy.')
+                game = Replay(seed, time_step, vectorized, args.scripts)
+                if args.compare:
+                    other = Replay(seed, time_step, not vectorized,
+                                   args.scripts)
+            continue
+        if game is None:
+            continue
+        if record[0] == 'tick' and args.until and record[1] > args.until:
+            break
+        game.apply(record)
+        if other:
+            other.apply(record)
+            if record[0] == 'tick' and other.published != game.published:
+                parser.exit(1, 'replay.py: o estado publicado difere entre '
+                               'os modos no passo %d.\n' % record[1])
+    seconds = time.perf_counter() - start
+    if game is None:
+        parser.error('o diário não tem o jogo %d.' % args.game)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(game.published, f, indent=4, sort_keys=True)
+    json.dump({'ticks': game.ticks, 'last': game.last, 'seconds': seconds,
+               'ticks_per_second': game.ticks / seconds if seconds else None,
+               'objects': len(game.children), 'shots': game.shots,
+               'projectiles': len(game.projectiles),
+               'digest': game.digest(), 'phases_ms': phases()},
+              sys.stdout, indent=4)
+    print()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import collections
+import threading
+import sqlite3
+import queue
+import time
+
+import metrics
+
+
+# Escritor do placar. Mantém uma única conexão com o banco de dados, e grava
+# os kills recebidos em lotes, em uma thread própria, para que o jogo não
+# espere pelo disco. Cada lote é gravado em uma única transação.
+class Scores(threading.Thread):
+
+    # Construtor. Recebe o caminho do banco de dados e o intervalo de tempo em
+    # segundos durante o qual os kills são acumulados antes de serem gravados.
+    def __init__(self, path='script_battle.db', interval=0.1):
+        threading.Thread.__init__(self)
+        self.path = path
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.connection = None
+
+    # Abre a conexão e cria a tabela, caso não exista.
+    def open(self):
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('pragma journal_mode=wal')
+        self.connection.execute('pragma synchronous=normal')
+        self.connection.execute('create table if not exists score ('
+                                'name text not null unique, '
+                                'kills int not null default 0, '
+                                'primary key (name))')
+        self.connection.commit()
+
+    # Adiciona 1 aos kills de um jogador. Não bloqueia.
+    def add_kill(self, name):
+        self.queue.put(name)
+
+    # Grava um lote de kills em uma transação.
+    def flush(self, names):
+        counts = collections.Counter(names)
+        with metrics.flushes.time(), self.connection:
+            self.connection.executemany(
+                    'insert or ignore into score (name) values (?)',
+                    [(name,) for name in counts])
+            self.connection.executemany(
+                    'update score set kills=kills+? where name=?',
+                    [(kills, name) for name, kills in counts.items()])
+
+    # Sobrescrito de Thread. Espera pelo primeiro kill de um lote, acumula os
+    # que chegarem durante o intervalo, e grava todos. None na fila indica
+    # que o escritor deve gravar o que restou e terminar.
+    def run(self):
+        self.open()
+        running = True
+        while running:
+            names = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while names[-1] is not None:
+                try:
+                    timeout = max(0, deadline - time.monotonic())
+                    names.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            if names[-1] is None:
+                names.pop()
+                running = False
+            if names:
+                self.flush(names)
+        self.connection.close()
+
+    # Grava os kills pendentes e termina a thread.
+    def close(self):
+        self.queue.put(None)
+        self.join()
@@ -1,56 +1,102 @@
 #!/usr/bin/env python3
 
 import socketserver
+import urllib.parse
 import http.server
 import http.client
 import email.utils
 import collections
 import threading
 import argparse
-import sqlite3
+import asyncio
 import hashlib
 import random
+import signal
+import select
 import json
+import re
 import time
 import sys
-import os
+import io
 
+import websocket
+import workers
+import journal
+import checkpoint
+import codec
+import metrics
+import ids
+import clock
+import scores
+import world
 
-# O servidor. Contém o recurso raíz, e um método para encontrar recursos a
-# partir daquele.
-class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+# A árvore de recursos de um servidor. Contém o recurso raíz, e um método para
+# encontrar recursos a partir daquele.
+class Tree:
 
     # Construtor. Cria um recurso raíz e um recurso simbolizando "não
-    # encontrado".
-    def __init__(self, address, port):
-        socketserver.ThreadingMixIn.__init__(self)
-        http.server.HTTPServer.__init__(self, (address, port), Handler)
+    # encontrado". O recurso raíz tem a rota fixa "metrics". Os caminhos já
+    # encontrados ficam em uma tabela, de tamanho máximo cache_size.
+    def __init__(self, cache_size=4096):
         self.root = Resource()
+        self.root.routes['metrics'] = Metrics()
         self.not_found = Resource({'code': http.client.NOT_FOUND})
+        self.cache = {}
+        self.cache_size = cache_size
 
     # Método para encontrar um recurso dado um identificador (URI), separado
     # por '/'. Se não encontrá-lo, devolve o recurso "não encontrado". Por
     # exemplo, para encontrar o recurso identificado por "/game/abc123",
     # procura-se o recurso "game" no recurso raíz, e nele o recurso "abc123".
+    # Rotas fixas de um recurso têm prioridade sobre seus recursos filhos.
+    # Um caminho já encontrado é buscado na tabela, com os recursos ao longo
+    # dele, e vale enquanto nenhum deles tiver sido removido.
     def find_resource(self, uri):
-        path = uri.split('/')
-        path.pop(0)
+        path = self.cache.get(uri)
+        if path is not None:
+            for res in path:
+                if res.removed:
+                    break
+            else:
+                return res
 
         res = self.root
-        for urn in path:
+        path = [res]
+        for urn in uri.split('/')[1:]:
             try:
-                res = res.children[urn]
+                res = res.routes[urn] if urn in res.routes \
+                        else res.children[urn]
             except KeyError:
                 return self.not_found
+            path.append(res)
+
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[uri] = path
         return res
 
 
-# Esta classe é instanciada para cada requisição feita ao servidor, e é
-# responsável por ler os dados de entrada, tratá-los e enviar a resposta.
-# Neste programa, cada recurso é responsável por tratar requisições feitas a si
-# mesmo, então o tratamento consiste em chamar o método correspondente no
-# recurso e enviar como resposta o retorno.
-class Handler(http.server.BaseHTTPRequestHandler):
+# O servidor. Atende cada requisição em uma thread. Threads bloqueadas
+# esperando modificações não impedem o servidor de terminar.
+class Server(Tree, socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+    daemon_threads = True
+
+    # Construtor.
+    def __init__(self, address, port):
+        Tree.__init__(self)
+        socketserver.ThreadingMixIn.__init__(self)
+        http.server.HTTPServer.__init__(self, (address, port), Handler)
+
+
+# Classe abstrata que lê os dados de entrada de uma requisição e formata a
+# resposta, independente de como são transmitidas. Subclasses devem definir o
+# caminho (path), o cabeçalho (headers) e o corpo da mensagem (rfile).
+class Request:
+
+    # A menor data possível, usada quando o cliente não tem nenhum dado.
+    epoch = time.mktime(time.gmtime(0))
 
     # Lê e retorna o tamanho da mensagem no cabeçalho. Se não estiver nele,
     # retorna zero.
@@ -64,34 +110,87 @@ class Handler(http.server.BaseHTTPRequestHandler):
     def read_timestamp(self):
         field = 'If-Modified-Since'
         if field not in self.headers:
-            return time.mktime(time.gmtime(0))
+            return self.epoch
         return time.mktime(email.utils.parsedate((self.headers[field])))
 
+    # Obtém a versão dos dados que o cliente já tem, do campo If-None-Match
+    # do cabeçalho. Se não estiver nele, retorna None.
+    def read_version(self):
+        try:
+            return int(self.headers['If-None-Match'].strip('"'))
+        except (AttributeError, ValueError):
+            return None
+
+    # Separa o caminho da requisição de seus parâmetros. Retorna o caminho e
+    # um dicionário com os parâmetros.
+    def read_query(self):
+        path, _, query = self.path.partition('?')
+        return path, dict(urllib.parse.parse_qsl(query))
+
+    # Escolhe o formato da resposta a partir dos campos Accept e
+    # Accept-Encoding do cabeçalho.
+    def read_format(self):
+        return codec.negotiate(self.headers.get('Accept'),
+                               self.headers.get('Accept-Encoding'))
+
     # Lê o corpo da mensagem formatado como JSON e retorna um dicionário
-    # correspondente. Adiciona um campo timestamp correspondente à última
-    # atualização do cliente. Recursos podem ou não fazer uso dele.
+    # correspondente. Adiciona campos com a última atualização do cliente, por
+    # timestamp e por versão, os parâmetros da requisição e o formato da
+    # resposta. Recursos podem ou não fazer uso deles. Uma mensagem sem corpo
+    # não é lida.
     def read(self):
         length = self.read_length()
-        data = {'timestamp': self.read_timestamp()}
-        try:
-            text = self.rfile.read(length).decode('utf-8')
-            data.update(json.loads(text))
-        except:
-            pass
-        finally:
-            return data
+        data = {'timestamp': self.read_timestamp(),
+                'version': self.read_version(),
+                'query': self.read_query()[1]}
+        if length:
+            try:
+                text = self.rfile.read(length).decode('utf-8')
+                data.update(json.loads(text))
+            except:
+                pass
+        data['format'] = self.read_format()
+        return data
 
-    # Responde a requisição com um código de status, campos de cabeçalho e
+    # Formata uma resposta com um código de status, campos de cabeçalho e
     # corpo da mensagem, todos opcionais. O corpo da mensagem deve ser um
-    # dicionário, a ser formatado como JSON para transmissão.
-    def reply(self, args={}):
+    # dicionário, a ser codificado no formato negociado com o cliente (JSON,
+    # por padrão), ou, no campo "text", texto puro. O campo "encoded" contém um
+    # corpo já codificado, possivelmente compartilhado com outras respostas,
+    # que não deve ser modificado; os campos de cabeçalho que o descrevem
+    # devem estar na resposta. Respostas com o campo "empty" não têm corpo nem
+    # os campos de cabeçalho que o descrevem. Retorna o código, os campos de
+    # cabeçalho e o corpo formatado.
+    def format(self, args):
         response = {'code': http.client.OK, 'data': None, 'headers': []}
         response.update(args)
 
-        code = response['code']
-        headers = response['headers'] + [('Content-Type', 'text/json')]
-        text = json.dumps(response['data'])
+        if response.get('empty'):
+            return response['code'], list(response['headers']), b''
+        if 'encoded' in response:
+            body, content = response['encoded'], []
+        elif 'text' in response:
+            body = bytes(response['text'], 'utf-8')
+            content = [('Content-Type',
+                        'text/plain; version=0.0.4; charset=utf-8')]
+        else:
+            body, content = codec.encode(response['data'], self.read_format())
+        headers = response['headers'] + content + [
+                ('Content-Length', str(len(body)))]
+        return response['code'], headers, body
+
+
+# Esta classe é instanciada para cada requisição feita ao servidor, e é
+# responsável por ler os dados de entrada, tratá-los e enviar a resposta.
+# Neste programa, cada recurso é responsável por tratar requisições feitas a si
+# mesmo, então o tratamento consiste em chamar o método correspondente no
+# recurso e enviar como resposta o retorno.
+class Handler(Request, http.server.BaseHTTPRequestHandler):
 
+    # Responde a requisição com um código de status, campos de cabeçalho e
+    # corpo da mensagem, todos opcionais.
+    def reply(self, args={}):
+        code, headers, body = self.format(args)
         try:
             self.send_response(code)
 
@@ -99,31 +198,269 @@ class Handler(http.server.BaseHTTPRequestHandler):
                 self.send_header(h[0], h[1])
             self.end_headers()
 
-            self.wfile.write(bytes(text, 'utf-8'))
+            if self.command != 'HEAD':
+                self.connection.sendall(memoryview(body))
         except:
             pass
 
+    # Chama o método correspondente à requisição no recurso e envia a
+    # resposta, registrando a duração por método e tipo de recurso.
+    def call(self, method, resource):
+        with metrics.requests.time(method, type(resource).__name__):
+            self.reply(getattr(resource, 'do_' + method)(self.read()))
+
     # Trata uma requisição GET.
     def do_GET(self):
-        self.reply(self.server.find_resource(self.path).do_GET(self.read()))
+        path = self.read_query()[0]
+        resource = self.server.find_resource(path)
+        if isinstance(resource, State) and websocket.requested(self.headers):
+            self.stream(resource.game)
+            return
+        self.call('GET', resource)
+
+    # Muda a conexão para WebSocket e envia o estado do jogo a cada passo,
+    # até que o cliente feche a conexão. Responde a pings do cliente.
+    def stream(self, game):
+        self.close_connection = True
+        update = threading.Event()
+        subscriber = Subscriber(game, update.set)
+        decoder = websocket.Decoder()
+        try:
+            self.wfile.write(websocket.handshake(
+                    self.headers['Sec-WebSocket-Key']))
+            game.subscribe(subscriber)
+            while True:
+                update.wait(1)
+                update.clear()
+                for frame in subscriber.pop_all():
+                    self.connection.sendall(frame)
+                if subscriber.closed:
+                    return
+
+                if not select.select([self.connection], [], [], 0)[0]:
+                    continue
+                data = self.connection.recv(1 << 16)
+                if not data:
+                    break
+                for opcode, payload in decoder.feed(data):
+                    if opcode == websocket.PING:
+                        self.connection.sendall(
+                                websocket.encode(payload, websocket.PONG))
+                    elif opcode == websocket.CLOSE:
+                        self.connection.sendall(
+                                websocket.encode(b'', websocket.CLOSE))
+                        return
+        except OSError:
+            pass
+        finally:
+            game.unsubscribe(subscriber)
+
+    # Trata uma requisição HEAD. O corpo da resposta não é enviado.
+    def do_HEAD(self):
+        path = self.read_query()[0]
+        self.call('HEAD', self.server.find_resource(path))
 
     # Trata uma requisição POST.
     def do_POST(self):
-        self.reply(self.server.find_resource(self.path).do_POST(self.read()))
+        path = self.read_query()[0]
+        self.call('POST', self.server.find_resource(path))
 
     # Trata uma requisição PUT.
     def do_PUT(self):
-        self.reply(self.server.find_resource(self.path).do_PUT(self.read()))
+        path = self.read_query()[0]
+        self.call('PUT', self.server.find_resource(path))
 
     # Trata uma requisição DELETE.
     def do_DELETE(self):
-        self.reply(self.server.find_resource(self.path).do_DELETE(self.read()))
+        path = self.read_query()[0]
+        self.call('DELETE', self.server.find_resource(path))
 
     # Descomentar para suprimir logging de requisições respondidas.
     #def log_message(self, format, *args):
         #return
 
 
+# Uma requisição recebida pelo servidor assíncrono, cujos dados já foram lidos
+# da conexão.
+class AsyncRequest(Request):
+
+    # Construtor. Recebe o caminho, o cabeçalho e o corpo da mensagem.
+    def __init__(self, path, headers, body):
+        self.path = path
+        self.headers = headers
+        self.rfile = io.BytesIO(body)
+
+
+# Servidor alternativo, baseado em asyncio. Atende a mesma árvore de recursos
+# em uma única thread, mantendo as conexões abertas entre requisições
+# (HTTP/1.1 keep-alive). Uma requisição GET bloqueada em um monitor não ocupa
+# uma thread, mas espera por um future resolvido quando o monitor é
+# modificado, de forma que muitos clientes podem acompanhar o jogo com pouca
+# memória.
+class AsyncServer(Tree):
+
+    # Construtor. Recebe o endereço e a porta.
+    def __init__(self, address, port):
+        Tree.__init__(self)
+        self.address = address
+        self.port = port
+        self.loop = None
+
+    # Atende requisições até ser interrompido. SIGTERM encerra o laço de
+    # eventos de forma ordenada.
+    def serve_forever(self):
+        try:
+            asyncio.run(self.serve())
+        except asyncio.CancelledError:
+            pass
+
+    # Nada a fazer; as conexões são fechadas ao fim do laço de eventos.
+    def server_close(self):
+        pass
+
+    # Abre o socket e atende conexões.
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_signal_handler(signal.SIGTERM,
+                                     asyncio.current_task().cancel)
+        server = await asyncio.start_server(self.handle, self.address,
+                                            self.port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+    # Espera, sem bloquear o laço de eventos, até que o cliente não esteja
+    # mais atualizado em relação ao monitor. A modificação é sinalizada por
+    # outra thread, então o future é resolvido pelo laço de eventos. Retorna
+    # falso, sem esperar, se o cliente está atualizado e não quer esperar.
+    async def wait(self, monitor, data):
+        def resolve(future):
+            if not future.done():
+                future.set_result(None)
+
+        while True:
+            future = self.loop.create_future()
+            with monitor.lock:
+                if not monitor.waiting(data):
+                    return True
+                if not monitor.blocking(data):
+                    return False
+                monitor.watch(lambda: self.loop.call_soon_threadsafe(
+                        resolve, future))
+            await future
+
+    # Trata uma requisição, chamando o método correspondente no recurso.
+    # Requisições GET a monitores esperam de forma assíncrona. Registra a
+    # duração por método e tipo de recurso.
+    async def dispatch(self, method, request):
+        resource = self.find_resource(request.read_query()[0])
+        data = request.read()
+        if method not in ['GET', 'HEAD', 'POST', 'PUT', 'DELETE']:
+            return {'code': http.client.NOT_IMPLEMENTED}
+        with metrics.requests.time(method, type(resource).__name__):
+            if method == 'GET' and isinstance(resource, Monitor):
+                if not await self.wait(resource, data):
+                    return resource.not_modified()
+                return resource.respond(data)
+            return getattr(resource, 'do_' + method)(data)
+
+    # Muda a conexão para WebSocket e envia o estado do jogo a cada passo,
+    # até que o cliente feche a conexão. Responde a pings do cliente.
+    async def stream(self, game, headers, reader, writer):
+        update = asyncio.Event()
+        subscriber = Subscriber(
+                game, lambda: self.loop.call_soon_threadsafe(update.set))
+        decoder = websocket.Decoder()
+        writer.write(websocket.handshake(headers['Sec-WebSocket-Key']))
+        game.subscribe(subscriber)
+
+        receiving = asyncio.ensure_future(reader.read(1 << 16))
+        waiting = asyncio.ensure_future(update.wait())
+        try:
+            while True:
+                await asyncio.wait([receiving, waiting],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if waiting.done():
+                    update.clear()
+                    for frame in subscriber.pop_all():
+                        writer.write(frame)
+                    await writer.drain()
+                    if subscriber.closed:
+                        return
+                    waiting = asyncio.ensure_future(update.wait())
+
+                if not receiving.done():
+                    continue
+                data = receiving.result()
+                if not data:
+                    break
+                for opcode, payload in decoder.feed(data):
+                    if opcode == websocket.PING:
+                        writer.write(websocket.encode(payload, websocket.PONG))
+                    elif opcode == websocket.CLOSE:
+                        writer.write(websocket.encode(b'', websocket.CLOSE))
+                        return
+                receiving = asyncio.ensure_future(reader.read(1 << 16))
+        finally:
+            game.unsubscribe(subscriber)
+            receiving.cancel()
+            waiting.cancel()
+
+    # Atende uma conexão, lendo e respondendo requisições até que o cliente
+    # a feche ou peça para fechá-la.
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                except ValueError:
+                    break
+
+                lines = []
+                while True:
+                    lines.append(await reader.readline())
+                    if lines[-1] in [b'\r\n', b'\n', b'']:
+                        break
+                headers = http.client.parse_headers(io.BytesIO(b''.join(lines)))
+                body = await reader.readexactly(
+                        int(headers.get('Content-Length', 0)))
+
+                request = AsyncRequest(target, headers, body)
+                if method == 'GET' and websocket.requested(headers):
+                    resource = self.find_resource(request.read_query()[0])
+                    if isinstance(resource, State):
+                        await self.stream(resource.game, headers, reader,
+                                          writer)
+                        break
+
+                code, fields, body = request.format(
+                        await self.dispatch(method, request))
+
+                connection = headers.get('Connection', '').lower()
+                if version == 'HTTP/1.1':
+                    keep_alive = connection != 'close'
+                else:
+                    keep_alive = connection == 'keep-alive'
+                fields.append(('Connection',
+                               'keep-alive' if keep_alive else 'close'))
+
+                head = ['HTTP/1.1 %d %s' % (code,
+                                            http.client.responses.get(code, ''))]
+                head += ['%s: %s' % f for f in fields]
+                writer.write(bytes('\r\n'.join(head) + '\r\n\r\n',
+                                   'latin-1'))
+                if method != 'HEAD' and body:
+                    writer.write(memoryview(body))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError,
+                asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
 # Classe abstrata. Cada recurso tem um dicionário de recursos filhos, mapeados
 # por um nome único (URN, Universal Resource Name, exemplo: "abc123").
 # A concatenação dos URNs desde um recurso raíz até outro compõe o
@@ -137,35 +474,57 @@ class Resource:
 
     # Construtor. Define o código de retorno padrão como "método não
     # permitido". É esperado que subclasses sobrescrevam este comportamento.
+    # Além dos recursos filhos, um recurso pode ter rotas fixas, recursos que
+    # não fazem parte de seus dados (por exemplo, "/game/state").
     def __init__(self, default_reply={'code': http.client.METHOD_NOT_ALLOWED}):
         self.children = {}
+        self.routes = {}
+        self.urn = None
+        self.removed = False
         self.on_delete = None
         self.on_add_sibling = None
         self.default_reply = default_reply
         self.lock = threading.Lock()
 
+    # Retorna um URN do gerador de identificadores que não está em uso por
+    # nenhum recurso filho ou rota fixa. Os URNs gerados são previsíveis, e um
+    # cliente pode ter escolhido o próximo como nome.
+    def generate_urn(self):
+        urn = ids.generate()
+        while urn in self.children or urn in self.routes:
+            urn = ids.generate()
+        return urn
+
     # Adiciona um recurso filho. Se não especificado o URN desejado para o
-    # recurso, usa-se um aleatório. Também modifica o recurso para que seu
-    # ponteiro-para-função on_delete aponte para o método delete_child deste
-    # objeto (com o argumento apropriado), e on_add_sibling para add_child.
-    # Assim, o recurso chamar delete fará com que este objeto o remova dos
-    # recursos filhos, e chamar add_sibling fará com que este adicione um
-    # recurso filho.
+    # recurso, usa-se um livre do gerador de identificadores (veja
+    # generate_urn), escolhido com o lock adquirido. O URN é internado,
+    # para que buscas no dicionário sejam baratas. Também modifica o recurso
+    # para que seu ponteiro-para-função on_delete aponte para o método
+    # delete_child deste objeto (com o argumento apropriado), e
+    # on_add_sibling para add_child. Assim, o recurso chamar delete fará com
+    # que este objeto o remova dos recursos filhos, e chamar add_sibling fará
+    # com que este adicione um recurso filho. Um recurso substituído é
+    # marcado como removido.
     def add_child(self, resource, urn=None):
-        if not urn:
-            urn = hashlib.md5(os.urandom(4096)).hexdigest()
         with self.lock:
+            urn = sys.intern(urn) if urn else self.generate_urn()
+            previous = self.children.get(urn)
+            if previous is not None and previous is not resource:
+                previous.removed = True
             self.children[urn] = resource
         with resource.lock:
+            resource.urn = urn
+            resource.removed = False
             resource.on_add_sibling = self.add_child
             resource.on_delete = lambda: self.delete_child(urn)
 
-    # Deleta um recurso filho. Recursos filhos deste objeto adicionados com
+    # Deleta um recurso filho, marcando-o como removido, para que caminhos
+    # até ele deixem de valer. Recursos filhos deste objeto adicionados com
     # add_child chamarão este método ao chamar delete.
     def delete_child(self, urn):
         with self.lock:
             if urn in self.children:
-                self.children.pop(urn)
+                self.children.pop(urn).removed = True
 
     # Chama o ponteiro-para-função on_add_sibling, setado por add_child no
     # recurso pai.
@@ -183,6 +542,11 @@ class Resource:
     def do_GET(self, data):
         return self.default_reply
 
+    # Trata uma requisição HEAD, como GET. O corpo da resposta é descartado
+    # ao enviá-la.
+    def do_HEAD(self, data):
+        return self.do_GET(data)
+
     # Trata uma requisição POST.
     def do_POST(self, data):
         return self.default_reply
@@ -196,52 +560,323 @@ class Resource:
         return self.default_reply
 
 
-# Recurso que monitora sua data de atualização, mantendo um timestamp.
-# Requisições GET de clientes que já tenham o recurso atualizado serão
-# bloqueadas até que o evento sinalizando atualização seja disparado.
+# Recurso que monitora sua data de atualização, mantendo um timestamp e um
+# número de versão. Requisições GET de clientes que já tenham o recurso
+# atualizado serão bloqueadas até que a condição sinalizando atualização seja
+# disparada.
 class Monitor(Resource):
 
     # Construtor. Define a última data de atualização como "agora". Cria uma
     # variável para indicar se o objeto foi modificado, para que múltiplas
-    # modificações possam ser feitas antes de se disparar o evento de
-    # atualização.
+    # modificações possam ser feitas antes de se disparar a condição de
+    # atualização. Os dados da versão atual, e suas codificações em cada
+    # formato, são guardados para serem compartilhados por todos os clientes
+    # que os requisitarem.
     def __init__(self):
         Resource.__init__(self)
         self.dirty = False
         self.timestamp = time.time()
-        self.update_event = threading.Event()
+        self.version = 0
+        self.updated = threading.Condition(self.lock)
+        self.watchers = []
+        self.encoded = None
+        self.encoding = threading.Lock()
 
     # Método abstrato que obtém os dados do recurso.
     def get_data(self):
         return None
 
     # Se a variável que define se o objeto foi modificado for True, atualiza o
-    # timestamp e dispara o evento de atualização, desbloqueando threads que
-    # estejam esperando por ele.
+    # timestamp e a versão e dispara a condição de atualização, desbloqueando
+    # threads que estejam esperando por ela. Retorna se o objeto havia sido
+    # modificado. Um objeto não modificado não adquire o lock: a variável só
+    # passa a True com o lock adquirido, ou pela thread que chama este método.
     def notify(self):
+        if not self.dirty:
+            return False
         with self.lock:
-            if self.dirty:
+            dirty = self.dirty
+            if dirty:
                 self.timestamp = time.time()
-                self.update_event.set()
-                self.update_event.clear()
+                self.version += 1
+                self.encoded = None
+                self.updated.notify_all()
+                watchers, self.watchers = self.watchers, []
+                for callback in watchers:
+                    callback()
             self.dirty = False
+        return dirty
+
+    # Registra uma função a ser chamada uma única vez, na próxima
+    # modificação. Deve ser chamado com o lock adquirido.
+    def watch(self, callback):
+        self.watchers.append(callback)
+
+    # Verifica se o cliente já tem os dados atualizados. A versão é preferida,
+    # pois o timestamp do cabeçalho tem resolução de segundos. Deve ser chamado
+    # com o lock adquirido.
+    def fresh(self, data):
+        if data.get('version') is not None:
+            return data['version'] == self.version
+        return data['timestamp'] >= self.timestamp
+
+    # Retorna os campos de cabeçalho que identificam a versão atual.
+    def stamp(self):
+        return [('Last-Modified', email.utils.formatdate(self.timestamp)),
+                ('ETag', '"%d"' % self.version)]
+
+    # Verifica se uma requisição GET deve esperar pela próxima modificação.
+    # Deve ser chamado com o lock adquirido.
+    def waiting(self, data):
+        return self.fresh(data)
+
+    # Verifica se uma requisição GET de um cliente atualizado deve esperar
+    # pela próxima modificação. Com o parâmetro "wait=0", não espera.
+    def blocking(self, data):
+        return data['query'].get('wait') != '0'
+
+    # Retorna a resposta de uma requisição GET, sem bloquear. A versão é lida
+    # antes dos dados, de forma que nunca é mais nova que eles. Os dados são
+    # obtidos uma única vez por versão, e codificados uma única vez por versão
+    # e formato, pelo primeiro cliente; os outros esperam por ele, e recebem
+    # os mesmos bytes.
+    def respond(self, data):
+        form = data.get('format', codec.DEFAULT)
+        with self.encoding:
+            encoded = self.encoded
+            if encoded is None or encoded[0] != self.version:
+                version, headers = self.version, self.stamp()
+                encoded = (version, headers, self.get_data(), {})
+                with self.lock:
+                    if self.version == version:
+                        self.encoded = encoded
+            if form not in encoded[3]:
+                encoded[3][form] = codec.encode(encoded[2], form)
+            body, content = encoded[3][form]
+        return {'encoded': body, 'headers': encoded[1] + content}
+
+    # Retorna a resposta a um cliente atualizado que não quer esperar: "não
+    # modificado", sem obter os dados.
+    def not_modified(self):
+        return {'code': http.client.NOT_MODIFIED, 'headers': self.stamp(),
+                'empty': True}
 
     # Trata uma requisição GET, bloqueando se for necessário. Após a liberação,
-    # retorna os dados do recurso. É thread-safe pois acessa o timestamp dentro
+    # retorna os dados do recurso. É thread-safe pois acessa a versão dentro
     # de um bloco de exclusão mútua. get_data() deve ser thread-safe.
     def do_GET(self, data):
         with self.lock:
-            timestamp = self.timestamp
-        if data['timestamp'] >= self.timestamp:
-            self.update_event.wait()
-        return {'data': self.get_data(),
-                'headers': [('Last-Modified',
-                             email.utils.formatdate(self.timestamp))]}
+            while self.waiting(data):
+                if not self.blocking(data):
+                    return self.not_modified()
+                self.updated.wait()
+        return self.respond(data)
+
+    # Trata uma requisição HEAD. Retorna somente os campos de cabeçalho que
+    # identificam a versão atual, sem obter os dados nem bloquear.
+    def do_HEAD(self, data):
+        return {'headers': self.stamp(), 'empty': True}
+
+
+# Índice espacial. Divide o campo em células quadradas de tamanho fixo, e cada
+# célula mapeia posições para os objetos nelas. É atualizado incrementalmente a
+# cada movimento, de forma que consultar se uma posição está ocupada, ou quais
+# objetos estão em uma região, não exige percorrer todos os objetos do jogo.
+# O lock é reentrante: a thread do jogo o mantém durante toda a fase de
+# movimento, e os métodos chamados nela o readquirem sem esperar.
+class Grid:
+
+    # Construtor. Recebe o tamanho do lado de cada célula.
+    def __init__(self, size=16):
+        self.size = size
+        self.cells = collections.defaultdict(dict)
+        self.positions = {}
+        self.trails = {}
+        self.lock = threading.RLock()
+
+    # Retorna a célula que contém uma posição.
+    def cell(self, x, y):
+        return (x // self.size, y // self.size)
+
+    # Insere um objeto em uma posição. Deve ser chamado com o lock adquirido.
+    def insert(self, obj, x, y):
+        self.positions[obj] = (x, y)
+        self.cells[self.cell(x, y)].setdefault((x, y), []).append(obj)
+
+    # Retira um objeto do índice. Deve ser chamado com o lock adquirido.
+    # Retorna False se o objeto não estava no índice.
+    def discard(self, obj):
+        position = self.positions.pop(obj, None)
+        if position is None:
+            return False
+        c = self.cell(*position)
+        cell = self.cells[c]
+        cell[position].remove(obj)
+        if not cell[position]:
+            cell.pop(position)
+        if not cell:
+            self.cells.pop(c)
+        return True
+
+    # Adiciona um objeto ao índice.
+    def add(self, obj, x, y):
+        with self.lock:
+            self.discard(obj)
+            self.insert(obj, x, y)
+
+    # Remove um objeto do índice.
+    def remove(self, obj):
+        with self.lock:
+            self.discard(obj)
+
+    # Move um objeto para outra posição. Objetos que não estão no índice (por
+    # exemplo, removidos durante o passo atual) não são reinseridos.
+    def move(self, obj, x, y):
+        with self.lock:
+            if self.discard(obj):
+                self.insert(obj, x, y)
+
+    # Move vários objetos de uma vez. Recebe uma lista de tuplas (objeto, x,
+    # y).
+    def move_all(self, moves):
+        with self.lock:
+            for obj, x, y in moves:
+                if self.discard(obj):
+                    self.insert(obj, x, y)
+
+    # Retorna um objeto na posição dada, diferente de exclude, ou None se não
+    # houver.
+    def at(self, x, y, exclude=None):
+        with self.lock:
+            cell = self.cells.get(self.cell(x, y))
+            if cell:
+                for obj in cell.get((x, y), ()):
+                    if obj is not exclude:
+                        return obj
+        return None
+
+    # Registra que um objeto atravessou uma posição, sem parar nela, no passo
+    # atual. Deve ser chamado com o lock adquirido.
+    def cross(self, obj, x, y):
+        self.trails.setdefault((x, y), []).append(obj)
+
+    # Retorna o primeiro objeto, diferente de exclude e ainda no índice, que
+    # atravessou a posição dada no passo atual, ou None se não houver. Deve
+    # ser chamado com o lock adquirido.
+    def crossed(self, x, y, exclude=None):
+        for obj in self.trails.get((x, y), ()):
+            if obj is not exclude and obj in self.positions:
+                return obj
+        return None
+
+    # Esquece as posições atravessadas no passo anterior. Deve ser chamado
+    # com o lock adquirido.
+    def clear_trails(self):
+        self.trails.clear()
+
+    # Retorna uma lista dos objetos no retângulo de (x0, y0) a (x1, y1),
+    # inclusive, visitando somente as células que o interceptam.
+    def query(self, x0, y0, x1, y1):
+        (cx0, cy0), (cx1, cy1) = self.cell(x0, y0), self.cell(x1, y1)
+        found = []
+        with self.lock:
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    cell = self.cells.get((cx, cy))
+                    if not cell:
+                        continue
+                    for (x, y), objs in cell.items():
+                        if x0 <= x <= x1 and y0 <= y <= y1:
+                            found.extend(objs)
+        return found
+
+    # Retorna o número de objetos no índice.
+    def __len__(self):
+        return len(self.positions)
+
+    # Verifica se um objeto está no índice.
+    def __contains__(self, obj):
+        return obj in self.positions
+
+
+# Cache de scripts compilados. Mapeia o hash do código-fonte para o objeto de
+# código correspondente, de forma que jogadores com scripts idênticos
+# compartilhem a mesma compilação. Mantém no máximo size entradas, descartando
+# as usadas há mais tempo.
+class ScriptCache:
+
+    # Construtor. Recebe o número máximo de scripts mantidos.
+    def __init__(self, size=256):
+        self.size = size
+        self.codes = collections.OrderedDict()
+        self.lock = threading.Lock()
 
+    # Retorna a chave de um código-fonte no cache.
+    def key(self, source):
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
 
-# Um objeto monitora um conjunto de atributos.
+    # Retorna o objeto de código de um script, compilando-o se não estiver no
+    # cache. Levanta SyntaxError, ValueError ou TypeError se o script for
+    # inválido.
+    def compile(self, source):
+        key = self.key(source)
+        with self.lock:
+            if key in self.codes:
+                self.codes.move_to_end(key)
+                return self.codes[key]
+
+        code = compile(source, '<script>', 'exec')
+        with self.lock:
+            self.codes[key] = code
+            while len(self.codes) > self.size:
+                self.codes.popitem(last=False)
+        return code
+
+
+# Scripts compilados, compartilhados por todos os jogos.
+scripts = ScriptCache()
+
+
+# Compila um script recebido em uma requisição. Retorna uma tupla com o objeto
+# de código e None, ou com None e a resposta de erro a ser enviada. Scripts
+# que não são strings são recusados antes de chegar ao cache.
+def compile_script(source):
+    if not isinstance(source, str):
+        return None, {'code': http.client.BAD_REQUEST,
+                      'data': {'error': 'o script deve ser uma string'}}
+    try:
+        return scripts.compile(source), None
+    except (SyntaxError, ValueError, TypeError) as e:
+        return None, {'code': http.client.BAD_REQUEST,
+                      'data': {'error': str(e)}}
+
+
+# Valida um atributo de controle retornado por um script. Direções de
+# movimento e de visão devem ser inteiros entre -1 e 1, e "shooting" é
+# convertido em booleano, se for de um tipo simples. Retorna o valor a
+# aplicar, ou None se o atributo não for de controle ou o valor for inválido.
+def control(name, value):
+    if name == 'shooting':
+        if isinstance(value, (bool, int, float, str, type(None))):
+            return bool(value)
+        return None
+    if name in workers.CONTROLS and type(value) in (int, bool) and \
+            -1 <= value <= 1:
+        return int(value)
+    return None
+
+
+# Um objeto monitora um conjunto de atributos. Os atributos pertencem à thread
+# do jogo, que é a única a lê-los e modificá-los durante os passos, sem locks.
+# As requisições leem os atributos publicados pelo jogo ao final de cada
+# passo, em um dicionário que nunca é modificado, somente substituído, e as
+# alterações pedidas pelos clientes são comandos na fila do jogo. Se o jogo
+# tiver um diário, o objeto registra nele as alterações aplicadas.
 class Object(Monitor):
 
+    game = None
+    journal = None
+
     # Construtor.
     def __init__(self):
         Monitor.__init__(self)
@@ -249,61 +884,83 @@ class Object(Monitor):
                            'posx': 0, 'posy': 0,
                            'movx': 0, 'movy': 0,
                            'lookx': 1, 'looky': 1}
+        self.published = None
 
-    # Implementado de Monitor. Uma requisição GET retorna uma cópia dos
-    # atributos do objeto em formato dicionário.
+    # Implementado de Monitor. Uma requisição GET retorna os atributos
+    # publicados ao final do último passo. Um objeto ainda não publicado
+    # retorna uma cópia dos atributos iniciais.
     def get_data(self):
-        with self.lock:
-            return self.attributes.copy()
+        published = self.published
+        if published is None:
+            return self.copy()
+        return published
+
+    # Retorna uma cópia dos atributos atuais em formato dicionário. Durante os
+    # passos, somente a thread do jogo pode chamá-lo.
+    def copy(self):
+        return self.attributes.copy()
 
     # Computa dano ao objeto. Se chegar a 0, é deletado.
     def add_damage(self, source):
         if self is source:
             return
-        with self.lock:
-            self.dirty = True
-            self.attributes['hp'] -= 1
-            if self.attributes['hp'] < 1:
-                self.delete()
+        self.dirty = True
+        self.attributes['hp'] -= 1
+        if self.attributes['hp'] < 1:
+            self.delete()
 
     # Método que trata colisão com outro objeto. Em princípio, o objeto pára de
     # se mover.
     def collide(self, player):
-        with self.lock:
-            for i in ['movx', 'movy']:
-                self.dirty = True
-                self.attributes[i] = 0
-
-    # Método que move o objeto. Recebe um dicionário que mapeia cada X para um
-    # dicionário que mapeia para cada Y um objeto para verificar se já existem
-    # objetos no destino. Se houver, chama o método de tratamento de colisão.
-    # Se não houver, atualiza o dicionário.
-    def move(self, occupied):
-        with self.lock:
-            x, y = self.attributes['posx'], self.attributes['posy']
-            mx, my = self.attributes['movx'], self.attributes['movy']
-            lx, ly = self.attributes['lookx'], self.attributes['looky']
-        if mx == 0 and my == 0:
+        self.dirty = True
+        self.attributes['movx'] = 0
+        self.attributes['movy'] = 0
+
+    # Método que move o objeto. Recebe o índice espacial do jogo para verificar
+    # se já existem objetos no caminho: na posição intermediária, em um
+    # movimento de duas posições em um eixo, e no destino. Objetos que
+    # atravessaram uma dessas posições no mesmo passo também estão no
+    # caminho, de forma que dois objetos nunca atravessam um ao outro. Se
+    # houver, chama o método de tratamento de colisão com o primeiro. Se não
+    # houver, atualiza o índice. Deve ser chamado com o lock do índice
+    # adquirido. Com NumPy, World.resolve segue as mesmas regras, na mesma
+    # ordem.
+    def move(self, grid):
+        a = self.attributes
+        mx, my = a['movx'], a['movy']
+        if mx == 0 and my == 0 or self not in grid:
             return
 
         # Se está olhando para onde está se movendo, ganha bônus.
-        x += mx + (1 if lx == mx else 0)
-        y += my + (1 if ly == my else 0)
+        x0, y0 = a['posx'], a['posy']
+        dx = mx + (1 if a['lookx'] == mx else 0)
+        dy = my + (1 if a['looky'] == my else 0)
+        x, y = x0 + dx, y0 + dy
+        path = [(x, y)]
+        if abs(dx) == 2 or abs(dy) == 2:
+            middle = (x0 + (dx + (dx < 0)) // 2, y0 + (dy + (dy < 0)) // 2)
+            path.insert(0, middle)
 
         # Tratamento de colisão.
-        if x in occupied and y in occupied[x] and occupied[x][y] is not self:
-            self.collide(occupied[x][y])
-            occupied[x][y].collide(self)
-            return
+        for px, py in path:
+            other = grid.at(px, py, self)
+            if other is None:
+                other = grid.crossed(px, py, self)
+            if other is not None:
+                self.collide(other)
+                other.collide(self)
+                return
 
         # Movido com sucesso.
-        occupied[x][y] = self
-        with self.lock:
-            self.dirty = True
-            self.attributes['posx'] = x
-            self.attributes['posy'] = y
-
-    # Método abstrato que executa o script do objeto a partir dos outros objetos.
+        grid.move(self, x, y)
+        if len(path) > 1:
+            grid.cross(self, *middle)
+        self.dirty = True
+        a['posx'] = x
+        a['posy'] = y
+
+    # Método abstrato que executa o script do objeto a partir dos dados dos
+    # outros objetos.
     def execute(self, others):
         pass
 
@@ -321,92 +978,79 @@ class Rock(Object):
 # Um jogador é um objeto com atributos adicionais.
 class Player(Object):
 
-    # Construtor. Recebe o script, e uma senha para que o cliente possa fazer
-    # modificações.
-    def __init__(self, name, password, script):
+    # Construtor. Recebe o script, seu objeto de código compilado, uma senha
+    # para que o cliente possa fazer modificações, e o escritor do placar.
+    def __init__(self, name, password, script, code, scores=None):
         Object.__init__(self)
         self.name = name
         self.password = password
         self.script = script
+        self.code = code
+        self.scores = scores
+        self.key = scripts.key(script)
         self.attributes.update({'hp': 10, 'type': 'player',
                                 'shots': 0, 'shooting': False, 'kills': 0})
 
-    # Atira, criando um recurso irmão da classe Projectile. Máximo 5 tiros por
-    # vez.
+    # Atira, criando um projétil, que o jogo adiciona junto aos irmãos.
+    # Máximo 5 tiros por vez.
     def add_shot(self):
-        with self.lock:
-            if self.attributes['shots'] >= 5:
-                return
-            self.attributes['shots'] += 1
-            self.dirty = True
-        urn = hashlib.md5(os.urandom(4096)).hexdigest()
-        self.add_sibling(Projectile(self), urn)
+        if self.attributes['shots'] >= 5:
+            return
+        self.attributes['shots'] += 1
+        self.dirty = True
+        self.add_sibling(Projectile(self))
 
     # Indica que um tiro foi removido.
     def remove_shot(self):
-        with self.lock:
-            self.attributes['shots'] -= 1
-            self.dirty = True
+        self.attributes['shots'] -= 1
+        self.dirty = True
 
-    # Adiciona 1 aos kills do jogador.
+    # Adiciona 1 aos kills do jogador, e o envia para o placar.
     def add_kill(self):
-        with self.lock:
-            self.dirty = True
-            self.attributes['kills'] += 1
-
-            # Banco de dados.
-            try:
-                c = sqlite3.connect("script_battle.db")
-                cc = c.cursor()
-            except:
-                pass
-            try:
-                cc.execute('create table score (name text not null unique, kills int not null default 0, primary key (name))')
-            except:
-                pass
-            try:
-                cc.execute('insert into score (name) values (?)', (self.name,))
-            except:
-                pass
-            try:
-                cc.execute('update score set kills=kills+1 where name=?', (self.name,))
-            except:
-                pass
-            try:
-                c.commit()
-                c.close()
-            except:
-                pass
-
+        self.dirty = True
+        self.attributes['kills'] += 1
+        if self.scores:
+            self.scores.add_kill(self.name)
 
     # Sobrescrito de Object. Se o jogador morrer, cede um kill para o jogador
     # que o matou.
     def add_damage(self, source):
         Object.add_damage(self, source)
-        with self.lock:
-            if self.attributes['hp'] < 1:
-                source.add_kill()
+        if self.attributes['hp'] < 1:
+            source.add_kill()
 
     # Sobrescrito de Object. Expõe uma cópia de alguns atributos do jogador e
     # dos outros jogadores. Ao final, atualiza os dados, e atira se for
-    # necessário.
+    # necessário. Um script que levanta uma exceção não tem efeito no passo.
+    # Retorna se o script teve efeito.
     def execute(self, others):
-        attributes = self.get_data()
-        players = [p.get_data() for p in others]
-        exec(self.script, {'attributes': attributes, 'players': players})
-
-        # Verifica diferenças nos atributos e na cópia passada. TODO validar.
-        with self.lock:
-            for i in ['movx', 'movy', 'lookx', 'looky', 'shooting']:
-                if self.attributes[i] != attributes[i]:
-                    self.attributes[i] = attributes[i]
-                    self.dirty = True
+        attributes = self.copy()
+        players = [dict(p) for p in others]
+        try:
+            exec(self.code, {'attributes': attributes, 'players': players})
+        except Exception:
+            return False
+        self.apply({i: attributes[i] for i in workers.CONTROLS
+                    if i in attributes})
+        return True
+
+    # Aplica os atributos de controle resultantes da execução do script, e
+    # atira se for necessário. Valores inválidos são ignorados (veja
+    # control), de forma que um script não interrompe o jogo.
+    def apply(self, controls):
+        # Verifica diferenças nos atributos e na cópia passada.
+        for i, value in controls.items():
+            value = control(i, value)
+            if value is not None and self.attributes[i] != value:
+                self.attributes[i] = value
+                self.dirty = True
 
         # Verifica se o jogador está atirando.
-        if attributes['shooting']:
+        if self.attributes['shooting']:
             self.add_shot()
 
-    # Sobrescrito de Resource. Altera o script.
+    # Sobrescrito de Resource. Altera o script no início do próximo passo. O
+    # script é compilado na própria requisição.
     def do_PUT(self, data):
         for i in['password', 'script']:
             if i not in data:
@@ -414,62 +1058,123 @@ class Player(Object):
         if data['password'] != self.password:
             return {'code': http.client.FORBIDDEN}
 
-        with self.lock:
-            self.script = data['script']
+        code, error = compile_script(data['script'])
+        if error:
+            return error
 
+        if not self.game.pending.put('script', self.replace, data['script'],
+                                     code):
+            return self.game.unavailable()
         return {'code': http.client.ACCEPTED}
 
-    # Sobrescrito de Resource. Deleta o jogador.
+    # Sobrescrito de Resource. Deleta o jogador no início do próximo passo.
     def do_DELETE(self, data):
         if 'password' not in data:
             return {'code': http.client.EXPECTATION_FAILED}
         if data['password'] != self.password:
             return {'code': http.client.FORBIDDEN}
 
-        self.delete()
+        if not self.game.pending.put('delete', self.remove):
+            return self.game.unavailable()
+        return {'code': http.client.ACCEPTED}
 
-        return {'code': http.client.NO_CONTENT}
+    # Comando que altera o script, já compilado.
+    def replace(self, script, code):
+        self.script = script
+        self.code = code
+        self.key = scripts.key(script)
+        if self.journal:
+            self.journal.script(self)
+
+    # Comando que deleta o jogador, se ainda não foi removido.
+    def remove(self):
+        if self.removed:
+            return
+        self.delete()
+        if self.journal:
+            self.journal.delete(self)
 
 
 # Um projétil é um objeto que move em uma direção até colidir com outro
-# jogador, ou até passar do seu alcance.
-class Projectile(Object):
+# jogador, ou até passar do seu alcance. Projéteis são criados e destruídos a
+# todo momento, então não são recursos: são registros compactos, mantidos
+# pelo jogo, e aparecem na API somente no estado agregado do jogo. Como os
+# atributos dos objetos, são modificados somente pela thread do jogo, e
+# reaproveitam os métodos de Object.
+class Projectile:
+
+    __slots__ = ('urn', 'game', 'player', 'range', 'deleted', 'dirty',
+                 'attributes', 'published')
+
+    # Formato dos URNs dos projéteis, que não podem ser usados como nomes de
+    # jogadores.
+    pattern = re.compile(r'projectile[0-9]+')
 
     # Construtor. Recebe o jogador de origem para determinar a direção de
     # movimento, e é posicionado um passo à frente para não coincidir com ele.
-    def __init__(self, player):
-        Object.__init__(self)
+    # Um projétil transferido de outro jogo é recriado com seus atributos, URN
+    # e alcance restante.
+    def __init__(self, player, attributes=None, urn=None, range=20):
+        self.urn = urn
+        self.game = None
         self.player = player
-        self.range = 20
+        self.range = range
+        self.deleted = False
+        self.dirty = False
+        self.published = None
+        if attributes is not None:
+            self.attributes = dict(attributes)
+            return
 
-        a = player.get_data()
+        a = player.attributes
         x, y = a['posx'], a['posy']
         lx, ly = a['lookx'], a['looky']
 
-        self.attributes.update({'hp': 1, 'type': 'projectile',
-                                'posx': x + 2 * lx, 'posy': y + 2 * ly,
-                                'movx': lx, 'movy': ly})
+        self.attributes = {'hp': 1, 'type': 'projectile',
+                           'posx': x + 2 * lx, 'posy': y + 2 * ly,
+                           'movx': lx, 'movy': ly,
+                           'lookx': 1, 'looky': 1}
+
+    # Retorna uma cópia dos atributos do projétil em formato dicionário.
+    def copy(self):
+        return self.attributes.copy()
+
+    # Retorna se o projétil foi modificado desde a última chamada.
+    def notify(self):
+        dirty, self.dirty = self.dirty, False
+        return dirty
 
-    # Sobrescrito de Resource. Reduz a contagem de tiros no jogador de origem.
+    # Remove o projétil do jogo, e reduz a contagem de tiros no jogador de
+    # origem. Um projétil pode colidir e esgotar seu alcance no mesmo passo,
+    # então só a primeira remoção tem efeito.
     def delete(self):
-        Resource.delete(self)
+        if self.deleted:
+            return
+        self.deleted = True
+        if self.game:
+            self.game.delete_projectile(self)
         self.player.remove_shot()
 
-    # Sobrescrito de Object. Um projétil que colide com outro objeto reduz o HP
-    # daquele, e se deleta.
+    # Computa dano ao projétil, que é deletado.
+    def add_damage(self, source):
+        Object.add_damage(self, source)
+
+    # Um projétil que colide com outro objeto reduz o HP daquele, e se deleta.
     def collide(self, other):
-        a = other.get_data()
         other.add_damage(self.player)
         self.delete()
 
-    # Sobrescrito de Object. Cada movimento reduz o alcance do projétil, e se
-    # chegar a zero, é deletado.
-    def move(self, occupied):
-        Object.move(self, occupied)
-        with self.lock:
-            self.range -= 1
-            if self.range < 1:
-                self.delete()
+    # Move o projétil como um objeto. Cada movimento reduz o alcance do
+    # projétil, e se chegar a zero, é deletado.
+    def move(self, grid):
+        Object.move(self, grid)
+        self.range -= 1
+        if self.range < 1:
+            self.delete()
+
+    # Projéteis não têm script.
+    def execute(self, others):
+        pass
 
 
 # Monitor cujos dados são os recursos filhos. Adição ou remoção marcará este
@@ -496,20 +1201,445 @@ class Container(Monitor):
             self.dirty = True
 
 
+# Monitor cujos dados são os atributos de todos os objetos de um jogo, em uma
+# única resposta, mapeados por URN. É modificado a cada passo em que algum
+# objeto do jogo é modificado, de forma que um cliente pode acompanhar o jogo
+# inteiro com uma única requisição por vez. Um cliente também pode pedir
+# somente as modificações desde um passo, com o parâmetro "since".
+class State(Monitor):
+
+    # Construtor. Recebe o jogo.
+    def __init__(self, game):
+        Monitor.__init__(self)
+        self.game = game
+
+    # Implementado de Monitor. Retorna os atributos de todos os objetos,
+    # publicados ao final do último passo.
+    def get_data(self):
+        return self.game.published
+
+    # Sobrescrito de Monitor. Acrescenta o passo atual ao cabeçalho.
+    def stamp(self):
+        return Monitor.stamp(self) + [('X-Sequence', str(self.game.sequence))]
+
+    # Sobrescrito de Monitor. Com o parâmetro "since", espera até que haja
+    # modificações depois daquele passo. Um passo posterior ao atual indica um
+    # cliente de outra execução do servidor, que não espera. Ninguém espera
+    # por um jogo encerrado.
+    def waiting(self, data):
+        if self.game.closed:
+            return False
+        if 'since' not in data['query']:
+            return Monitor.waiting(self, data)
+        try:
+            since = int(data['query']['since'])
+        except ValueError:
+            return False
+        return self.game.modified <= since <= self.game.sequence
+
+    # Sobrescrito de Monitor. Com o parâmetro "since", retorna as modificações
+    # depois daquele passo. Um jogo encerrado responde "Gone".
+    def respond(self, data):
+        if self.game.closed:
+            return {'code': http.client.GONE}
+        if 'since' not in data['query']:
+            return Monitor.respond(self, data)
+        try:
+            since = int(data['query']['since'])
+        except ValueError:
+            return {'code': http.client.BAD_REQUEST}
+        headers = self.stamp()
+        return {'data': self.game.delta(since), 'headers': headers}
+
+
+# Lê uma área do jogo dos parâmetros x0, y0, x1 e y1 da requisição, ou, se
+# não estiverem nela, do corpo da mensagem. Retorna uma tupla (x0, y0, x1, y1),
+# com os cantos inclusive, ou None se não houver área. Levanta ValueError se a
+# área for inválida ou maior que o limite de View.
+def read_area(data):
+    fields = ['x0', 'y0', 'x1', 'y1']
+    source = data['query'] if 'x0' in data['query'] else data
+    if not any(i in source for i in fields):
+        return None
+    try:
+        x0, y0, x1, y1 = [int(source[i]) for i in fields]
+    except (KeyError, TypeError):
+        raise ValueError('área incompleta')
+    if not (0 <= x1 - x0 <= View.limit and 0 <= y1 - y0 <= View.limit):
+        raise ValueError('área inválida')
+    return x0, y0, x1, y1
+
+
+# Sessão de um cliente que acompanha somente os objetos em uma área do jogo
+# (área de interesse), como a janela que os clientes desenham em volta do
+# jogador. A sessão guarda os atributos já enviados ao cliente, e cada
+# resposta traz somente as diferenças: objetos que entraram na área, com
+# todos os atributos, objetos que saíram dela, e os atributos modificados dos
+# que continuam nela, no mesmo formato de GET /game/state?since=[passo]. Os
+# objetos na área são obtidos do índice espacial, então o custo de uma
+# resposta depende do número de objetos em volta do cliente, e não do tamanho
+# do jogo. É modificada a cada passo em que o jogo é modificado.
+class View(Monitor):
+
+    # Margem, em posições, acrescentada em volta da área, de forma que
+    # objetos que estão para entrar nela já sejam conhecidos; e o maior lado
+    # aceito para uma área.
+    margin = 2
+    limit = 256
+
+    # Construtor. Recebe o jogo e a área.
+    def __init__(self, game, area):
+        Monitor.__init__(self)
+        self.game = game
+        self.area = area
+        self.known = {}
+        self.accessed = time.monotonic()
+
+    # Implementado de Monitor. Retorna os atributos dos objetos na área, com
+    # a margem, publicados ao final do último passo. As posições no índice
+    # podem estar um passo adiante das publicadas, o que a margem compensa.
+    def get_data(self):
+        x0, y0, x1, y1 = self.area
+        m = self.margin
+        published = self.game.published
+        return {o.urn: published[o.urn]
+                for o in self.game.grid.query(x0 - m, y0 - m, x1 + m, y1 + m)
+                if o.urn in published}
+
+    # Sobrescrito de Monitor. Um cliente que muda a área não espera, nem um
+    # cliente de um jogo encerrado.
+    def waiting(self, data):
+        self.accessed = time.monotonic()
+        if self.game.closed:
+            return False
+        try:
+            area = read_area(data)
+        except ValueError:
+            return False
+        if area is not None and area != self.area:
+            return False
+        return Monitor.waiting(self, data)
+
+    # Sobrescrito de Monitor. Muda a área, se dada, e retorna as diferenças
+    # em relação aos atributos já enviados. Um cliente sem versão (a primeira
+    # requisição, ou após perder uma resposta) recebe todos os objetos na
+    # área. Um jogo encerrado responde "Gone".
+    def respond(self, data):
+        if self.game.closed:
+            return {'code': http.client.GONE}
+        try:
+            area = read_area(data)
+        except ValueError:
+            return {'code': http.client.BAD_REQUEST}
+        with self.encoding:
+            self.accessed = time.monotonic()
+            if area is not None:
+                self.area = area
+            full = data.get('version') is None
+            known = {} if full else self.known
+            headers, sequence = self.stamp(), self.game.sequence
+            current = self.get_data()
+
+            changed = {}
+            for urn, attributes in current.items():
+                old = known.get(urn)
+                if old is not None and old is not attributes:
+                    diff = {i: v for i, v in attributes.items()
+                            if old.get(i) != v}
+                    if diff:
+                        changed[urn] = diff
+            added = {u: a for u, a in current.items() if u not in known}
+            removed = sorted(known.keys() - current.keys())
+            self.known = current
+        return {'data': {'sequence': sequence, 'full': full, 'added': added,
+                         'removed': removed, 'changed': changed},
+                'headers': headers}
+
+    # Sobrescrito de Resource. Encerra a sessão.
+    def do_DELETE(self, data):
+        self.delete()
+        return {'code': http.client.NO_CONTENT, 'empty': True}
+
+
+# Sessões de área de interesse de um jogo. Uma requisição POST cria uma
+# sessão. Sessões sem requisições por mais de timeout segundos são removidas.
+class Views(Resource):
+
+    # Construtor. Recebe o jogo e o tempo limite das sessões, em segundos.
+    def __init__(self, game, timeout=300):
+        Resource.__init__(self)
+        self.game = game
+        self.timeout = timeout
+        self.expired = time.monotonic()
+
+    # Sobrescrito de Resource. Cria uma sessão com a área dada. Retorna uma
+    # resposta com o campo Location do cabeçalho contendo o URN da sessão.
+    def do_POST(self, data):
+        try:
+            area = read_area(data)
+        except ValueError:
+            return {'code': http.client.BAD_REQUEST}
+        if area is None:
+            return {'code': http.client.EXPECTATION_FAILED}
+        view = View(self.game, area)
+        self.add_child(view)
+        return {'code': http.client.CREATED,
+                'headers': [('Location', view.urn)]}
+
+    # Marca todas as sessões como modificadas.
+    def notify(self):
+        with self.lock:
+            views = list(self.children.values())
+        for v in views:
+            with v.lock:
+                v.dirty = True
+            v.notify()
+
+    # Remove as sessões abandonadas. Chamado a cada passo, mesmo sem
+    # modificações, mas verifica as sessões no máximo uma vez por segundo.
+    # Clientes esperando por uma sessão removida recebem uma última resposta.
+    def expire(self):
+        now = time.monotonic()
+        if now - self.expired < 1:
+            return
+        self.expired = now
+        with self.lock:
+            views = list(self.children.values())
+        for v in views:
+            if now - v.accessed > self.timeout:
+                v.delete()
+                with v.lock:
+                    v.dirty = True
+                v.notify()
+
+
+# Assinante do estado de um jogo por WebSocket. O jogo entrega a ele um quadro
+# por passo com as modificações, codificado uma única vez para todos os
+# assinantes, e a conexão os envia. Se o cliente não consome os quadros a
+# tempo, os pendentes são descartados e o próximo quadro enviado é o estado
+# completo, assim como o primeiro.
+class Subscriber:
+
+    # Construtor. Recebe o jogo, e uma função chamada, de outra thread,
+    # quando há quadros a enviar.
+    def __init__(self, game, wake, limit=64):
+        self.game = game
+        self.wake = wake
+        self.limit = limit
+        self.frames = collections.deque()
+        self.stale = True
+        self.closed = False
+        self.lock = threading.Lock()
+
+    # Recebe o quadro de um passo.
+    def push(self, frame):
+        with self.lock:
+            if len(self.frames) >= self.limit:
+                self.frames.clear()
+                self.stale = True
+            else:
+                self.frames.append(frame)
+        self.wake()
+
+    # Descarta os quadros pendentes. O próximo quadro enviado é o estado
+    # completo.
+    def invalidate(self):
+        with self.lock:
+            self.frames.clear()
+            self.stale = True
+        self.wake()
+
+    # Encerra a assinatura, quando o jogo é removido. A conexão envia os
+    # quadros pendentes e então a fecha.
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.wake()
+
+    # Retorna os quadros a enviar, em ordem. Se a assinatura foi encerrada,
+    # termina com um quadro de fechamento.
+    def pop_all(self):
+        with self.lock:
+            frames = list(self.frames)
+            self.frames.clear()
+            stale, self.stale = self.stale, False
+        if stale:
+            frames = [self.game.frame()]
+        if self.closed:
+            frames.append(websocket.encode(
+                    websocket.GOING_AWAY.to_bytes(2, 'big'), websocket.CLOSE))
+        return frames
+
+
+# Fila de comandos dos clientes de um jogo. Requisições que modificam o jogo
+# não o modificam diretamente: validam os dados e acrescentam um comando à
+# fila, que a thread do jogo aplica em lote no início do passo seguinte, de
+# forma que os objetos e o índice espacial só mudam entre passos. A fila tem
+# um tamanho máximo, e um comando que não cabe nela é recusado. No máximo
+# batch comandos são aplicados por passo; os restantes ficam para o passo
+# seguinte, de forma que rajadas de escritas não atrasam os passos.
+class Commands:
+
+    # Construtor. Recebe o tamanho máximo da fila e o número máximo de
+    # comandos aplicados por passo.
+    def __init__(self, limit=1024, batch=256):
+        self.limit = limit
+        self.batch = batch
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.applied = 0
+        self.max_applied = 0
+        self.total = 0
+        self.rejected = 0
+
+    # Acrescenta um comando: o nome, usado nas métricas, uma função chamada
+    # pela thread do jogo e seus argumentos. Retorna falso, sem acrescentá-lo,
+    # se a fila estiver cheia.
+    def put(self, name, function, *args):
+        with self.lock:
+            full = len(self.queue) >= self.limit
+            if full:
+                self.rejected += 1
+            else:
+                self.queue.append((name, function, args))
+        if full:
+            metrics.commands.add(1, name, 'rejected')
+        return not full
+
+    # Aplica os próximos comandos, em ordem, até batch. Chamado pela thread
+    # do jogo no início de cada passo.
+    def apply(self):
+        with self.lock:
+            commands = [self.queue.popleft()
+                        for i in range(min(self.batch, len(self.queue)))]
+        for name, function, args in commands:
+            function(*args)
+
+        counts = collections.Counter(name for name, _, _ in commands)
+        for name, count in counts.items():
+            metrics.commands.add(count, name, 'applied')
+        with self.lock:
+            self.applied = len(commands)
+            self.max_applied = max(self.max_applied, self.applied)
+            self.total += self.applied
+
+    # Retorna os contadores da fila: comandos pendentes, aplicados no último
+    # passo, o máximo em um passo, o total e os recusados.
+    def get_data(self):
+        with self.lock:
+            return {'limit': self.limit,
+                    'batch': self.batch,
+                    'pending': len(self.queue),
+                    'applied': self.applied,
+                    'max_applied': self.max_applied,
+                    'total': self.total,
+                    'rejected': self.rejected}
+
+
+# Recurso somente de leitura com os histogramas e contadores do servidor, no
+# formato de texto do Prometheus.
+class Metrics(Resource):
+
+    # Trata uma requisição GET.
+    def do_GET(self, data):
+        return {'text': metrics.registry.render()}
+
+
+# Recurso somente de leitura com os contadores do relógio e da fila de
+# comandos de um jogo.
+class Timing(Resource):
+
+    # Construtor. Recebe o relógio e a fila de comandos.
+    def __init__(self, clock, commands):
+        Resource.__init__(self)
+        self.clock = clock
+        self.commands = commands
+
+    # Trata uma requisição GET.
+    def do_GET(self, data):
+        return {'data': dict(self.clock.get_data(),
+                             commands=self.commands.get_data())}
+
+
 # O jogo é um Container cujo recursos filhos monitorados são os jogadores.
 # Ainda, a cada intervalo de tempo, chama os métodos dos jogadores que definem
 # a lógica do jogo.
 class Game(Container, threading.Thread):
 
-    # Construtor. Recebe o intervalo de tempo entre cada passo do jogo.
-    def __init__(self, time_step):
-        threading.Thread.__init__(self)
+    # Construtor. Recebe o intervalo de tempo entre cada passo do jogo. Cria o
+    # índice espacial dos objetos. Se for dado um número de processos, os
+    # scripts são executados em paralelo, cada um limitado a budget segundos
+    # de CPU por passo. Se vectorized for verdadeiro, os atributos dos objetos
+    # ficam em um mundo em colunas, e o passo é computado sobre todos eles de
+    # uma vez. Os kills dos jogadores são enviados para o escritor do placar
+    # dado, se houver. Se o jogo atrasar, até catch_up passos extras são
+    # executados em seguida. Um jogo criado como sala tem uma senha, para ser
+    # removido. As posições aleatórias do jogo são geradas a partir da semente
+    # dada, ou de uma aleatória. Se for dado um diário, o jogo registra nele
+    # tudo que recebe dos clientes e dos scripts, para ser reproduzido. Se for
+    # dado um escritor de pontos de restauração, o estado do jogo é gravado
+    # periodicamente por ele. As modificações pedidas pelos clientes esperam
+    # em uma fila de tamanho queue_size, e no máximo batch delas são
+    # aplicadas no início de cada passo.
+    def __init__(self, time_step, processes=0, budget=0.02, vectorized=False,
+                 scores=None, history=64, catch_up=0, password=None,
+                 seed=None, journal=None, checkpoints=None, queue_size=1024,
+                 batch=256):
+        threading.Thread.__init__(self, daemon=True)
         Container.__init__(self)
         self.time_step = time_step
+        self.password = password
+        self.clock = clock.Clock(time_step, catch_up)
+        self.pending = Commands(queue_size, batch)
+        self.routes['clock'] = Timing(self.clock, self.pending)
+        self.scores = scores
+        self.grid = Grid()
+        self.pool = None
+        if processes > 0:
+            self.pool = workers.Pool(processes, budget, time_step)
+        self.world = world.World() if vectorized else None
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.random = random.Random(self.seed)
+        self.journal = journal
+        if journal:
+            journal.start_game(self)
+        self.checkpoints = checkpoints
+        self.state = State(self)
+        self.routes['state'] = self.state
+        self.views = Views(self)
+        self.routes['views'] = self.views
+
+        # Cada passo tem um número de sequência. O estado ao final do último
+        # passo é publicado, e as modificações dos últimos passos com alguma
+        # modificação ficam em um buffer circular de tamanho history. As
+        # modificações posteriores ao passo horizon estão todas no buffer.
+        self.sequence = 0
+        self.modified = 0
+        self.horizon = 0
+        self.deltas = collections.deque(maxlen=history)
+        self.published = {}
+        self.subscribers = []
+        self.closed = False
+
+        # Projéteis, mapeados por URN, e o número de tiros já disparados.
+        # Acessados somente pela thread do jogo.
+        self.projectiles = {}
+        self.shots = 0
+
+        # Nomes dos jogadores ainda na fila de comandos.
+        self.reserved = set()
+
+    # Retorna a resposta a uma modificação recusada porque a fila de comandos
+    # está cheia, com o tempo em segundos até uma nova tentativa.
+    def unavailable(self):
+        return {'code': http.client.SERVICE_UNAVAILABLE,
+                'headers': [('Retry-After',
+                             str(max(1, round(self.time_step))))]}
 
     # Uma requisição POST cria um recurso filho (um jogador), validando dados
-    # de entrada. Retorna uma resposta com o campo Location do cabeçalho
-    # contendo a URN do jogador criado.
+    # de entrada, no início do próximo passo. Retorna uma resposta com o campo
+    # Location do cabeçalho contendo a URN do jogador. O nome fica reservado
+    # desde a requisição.
     def do_POST(self, data):
         for i in['name', 'password', 'script']:
             if i not in data:
@@ -519,46 +1649,469 @@ class Game(Container, threading.Thread):
         password = data['password']
         script = data['script']
 
-        # O nome deve ser único.
-        with self.lock:
-            if name in self.children:
-                return {'code': http.client.EXPECTATION_FAILED} # TODO outro código
+        # O nome deve ser uma string única, e diferente das rotas fixas e dos
+        # URNs dos projéteis.
+        if not isinstance(name, str):
+            return {'code': http.client.BAD_REQUEST}
+        if Projectile.pattern.fullmatch(name):
+            return {'code': http.client.CONFLICT}
 
-        self.add_child(Player(name, password, script), name)
-        return {'code': http.client.CREATED,
+        # O script é compilado uma única vez, no envio.
+        code, error = compile_script(script)
+        if error:
+            return error
+
+        player = Player(name, password, script, code, self.scores)
+        with self.lock:
+            if (name in self.children or name in self.routes or
+                    name in self.reserved):
+                return {'code': http.client.CONFLICT}
+            if not self.pending.put('add', self.add_player, player):
+                return self.unavailable()
+            self.reserved.add(name)
+        return {'code': http.client.ACCEPTED,
                 'headers': [('Location', name)]}
 
-    # Retorna um dicionário que mapeia para cada X um dicionário que mapeia,
-    # para cada Y, um jogador, assim substituindo uma matriz.
-    def get_occupied(self):
-        d = collections.defaultdict(dict)
+    # Sobrescrito de Resource. Remove o jogo, se for uma sala.
+    def do_DELETE(self, data):
+        if self.password is None:
+            return self.default_reply
+        if 'password' not in data:
+            return {'code': http.client.EXPECTATION_FAILED}
+        if data['password'] != self.password:
+            return {'code': http.client.FORBIDDEN}
+
+        self.delete()
+
+        return {'code': http.client.NO_CONTENT, 'empty': True}
+
+    # Comando que adiciona um jogador criado por um cliente.
+    def add_player(self, player):
+        with self.lock:
+            self.reserved.discard(player.name)
+        self.add_child(player, player.name)
+
+    # Adiciona pedras em posições aleatórias, no quadrado de lado igual ao
+    # número de pedras.
+    def add_rocks(self, n):
+        for i in range(n):
+            self.add_child(Rock(self.random.randrange(n),
+                                self.random.randrange(n)))
+
+    # Sobrescrito de Container. Insere o objeto no índice espacial, e no mundo
+    # em colunas, se houver, e o registra no diário. Projéteis, adicionados
+    # pelos jogadores como irmãos, não são recursos filhos, e são mantidos à
+    # parte.
+    def add_child(self, resource, urn=None):
+        if isinstance(resource, Projectile):
+            self.add_projectile(resource)
+            return
+        Container.add_child(self, resource, urn)
+        resource.game = self
+        if self.journal:
+            resource.journal = self.journal
+            self.journal.add(resource)
+        if self.world:
+            self.world.attach(resource)
+        a = resource.attributes
+        self.grid.add(resource, a['posx'], a['posy'])
+
+    # Retorna o URN de um novo projétil, sequencial.
+    def projectile_urn(self):
+        self.shots += 1
+        return sys.intern('projectile%d' % self.shots)
+
+    # Adiciona um projétil. Um projétil novo recebe um URN sequencial.
+    def add_projectile(self, projectile):
+        if projectile.urn is None:
+            projectile.urn = self.projectile_urn()
+        projectile.game = self
+        self.projectiles[projectile.urn] = projectile
+        if self.world:
+            self.world.attach(projectile)
+        a = projectile.attributes
+        self.grid.add(projectile, a['posx'], a['posy'])
+
+    # Remove um projétil.
+    def delete_projectile(self, projectile):
+        if self.projectiles.pop(projectile.urn, None) is projectile:
+            self.grid.remove(projectile)
+            if self.world:
+                self.world.detach(projectile)
+
+    # Sobrescrito de Container. Retira o objeto do índice espacial, e do
+    # mundo em colunas, se houver.
+    def delete_child(self, urn):
+        with self.lock:
+            resource = self.children.get(urn)
+        Container.delete_child(self, urn)
+        if resource is not None:
+            self.grid.remove(resource)
+            if self.world:
+                self.world.detach(resource)
+
+    # Retorna uma cópia dos dados dos objetos dados, na mesma ordem.
+    def snapshot(self, players):
+        if self.world:
+            return self.world.snapshot(players)
+        return [p.copy() for p in players]
+
+    # Executa os scripts dos jogadores. Os
+    # scripts recebem uma cópia dos dados de todos os objetos tirada uma única
+    # vez. Com processos, as modificações são aplicadas na ordem dos objetos,
+    # independente da ordem em que terminaram. Os controles resultantes dos
+    # scripts que tiveram efeito são registrados no diário. Retorna a lista
+    # dos objetos modificados.
+    def execute(self, players):
+        data = self.snapshot(players)
+        if not self.pool:
+            applied = [p for p in players if p.execute(data)]
+        else:
+            tasks = [(i, p.key, p.script) for i, p in enumerate(players)
+                     if isinstance(p, Player)]
+            results = self.pool.execute(data, tasks)
+            applied = []
+            for i, p in enumerate(players):
+                if results.get(i) is not None:
+                    p.apply(results[i])
+                    applied.append(p)
+        if self.journal:
+            self.journal.tick(self.sequence + 1, applied)
+        return [p for p in players if p.dirty]
+
+    # Publica o estado ao final de um passo, e guarda as modificações em
+    # relação ao passo anterior: objetos adicionados, com todos os atributos,
+    # objetos removidos, e somente os atributos modificados dos objetos dados.
+    # O estado publicado nunca é modificado, somente substituído. Inclui os
+    # projéteis. Os atributos publicados de cada objeto também ficam nele,
+    # para as requisições ao objeto. Retorna se houve alguma modificação.
+    def publish(self, changed):
         with self.lock:
-            d.update({p.get_data()['posx']: {p.get_data()['posy']: p}
-                      for p in self.children.copy().values()})
-        return d
+            children = dict(self.children)
+        children.update(self.projectiles)
+        previous = self.published
+        removed = previous.keys() - children.keys()
+        added = children.keys() - previous.keys()
+        changed = [p for p in changed
+                   if p.urn not in added and children.get(p.urn) is p]
+
+        current = dict(previous)
+        for urn in removed:
+            current.pop(urn)
+        objects = [children[u] for u in added]
+        added = dict(zip(added, self.snapshot(objects)))
+        current.update(added)
+        for obj, a in zip(objects, added.values()):
+            obj.published = a
+        modified = {}
+        for p, a in zip(changed, self.snapshot(changed)):
+            old = current[p.urn]
+            diff = {i: v for i, v in a.items() if old.get(i) != v}
+            if diff:
+                modified[p.urn] = diff
+                current[p.urn] = a
+            p.published = current[p.urn]
 
-    # Sobrescrito de Thread. Executa operações pendentes e chama o método move
-    # de cada jogador, fornecendo um dicionário de posições ocupadas por outros
-    # jogadores. O próprio jogador então trata colisões com outros.
+        with self.lock:
+            self.sequence += 1
+            if added or removed or modified:
+                if len(self.deltas) == self.deltas.maxlen:
+                    self.horizon = self.deltas[0][0]
+                self.deltas.append((self.sequence, added, removed, modified))
+                self.modified = self.sequence
+            self.published = current
+        return self.modified == self.sequence
+
+    # Retorna as modificações desde o passo since, combinando as do buffer. Se
+    # since for anterior ao horizonte do buffer, ou posterior ao passo atual,
+    # retorna o estado completo. Clientes devem remover os objetos em
+    # "removed", e então aplicar "added" e "changed".
+    def delta(self, since):
+        with self.lock:
+            sequence = self.sequence
+            if not self.horizon <= since <= sequence:
+                return {'sequence': sequence, 'full': True,
+                        'added': self.published, 'removed': [], 'changed': {}}
+            deltas = [d for d in self.deltas if d[0] > since]
+
+        added, removed, changed = {}, set(), {}
+        for _, a, r, c in deltas:
+            for urn in r:
+                removed.add(urn)
+                added.pop(urn, None)
+                changed.pop(urn, None)
+            for urn, attributes in a.items():
+                added[urn] = dict(attributes)
+                changed.pop(urn, None)
+            for urn, attributes in c.items():
+                if urn in added:
+                    added[urn].update(attributes)
+                else:
+                    changed.setdefault(urn, {}).update(attributes)
+        return {'sequence': sequence, 'full': False, 'added': added,
+                'removed': sorted(removed), 'changed': changed}
+
+    # Adiciona um assinante, que passa a receber as modificações a cada passo.
+    # A assinatura de um jogo encerrado é encerrada em seguida.
+    def subscribe(self, subscriber):
+        with self.lock:
+            if not self.closed:
+                self.subscribers.append(subscriber)
+        if self.closed:
+            subscriber.close()
+        else:
+            subscriber.wake()
+
+    # Remove um assinante.
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    # Retorna um quadro WebSocket com o estado completo do jogo.
+    def frame(self):
+        return websocket.encode(bytes(json.dumps(self.delta(-1)), 'utf-8'))
+
+    # Envia aos assinantes um quadro com as modificações do último passo,
+    # codificado uma única vez. Se as modificações não puderem ser
+    # codificadas, os assinantes recebem o estado completo na próxima vez, e
+    # o erro fica com a conexão de cada um, não com o jogo.
+    def push(self):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        if not subscribers:
+            return
+        delta = self.delta(self.sequence - 1)
+        try:
+            frame = websocket.encode(bytes(json.dumps(delta), 'utf-8'))
+        except (TypeError, ValueError):
+            for s in subscribers:
+                s.invalidate()
+            return
+        for s in subscribers:
+            s.push(frame)
+
+    # Executa um passo do jogo. Aplica os comandos dos clientes, e então
+    # chama o método move de cada jogador, fornecendo o índice espacial com
+    # as posições ocupadas por outros objetos. O próprio jogador então trata
+    # colisões com outros. Registra a duração de cada fase. O índice espacial
+    # fica com o lock adquirido durante toda a movimentação, de forma que as
+    # consultas das requisições nunca o veem pela metade.
+    def step(self):
+        with metrics.phases.time('commands'):
+            self.pending.apply()
+
+        # Movimenta jogadores e projéteis.
+        with metrics.phases.time('move'):
+            with self.lock:
+                players = list(self.children.values())
+            players += list(self.projectiles.values())
+            with self.grid.lock:
+                if self.world:
+                    self.world.step(self.grid, players)
+                else:
+                    self.grid.clear_trails()
+                    for p in players:
+                        p.move(self.grid)
+
+        # Executa os scripts.
+        with metrics.phases.time('scripts'):
+            changed = self.execute(players)
+
+        self.finish(players, changed)
+
+    # Termina um passo. Publica o estado do jogo inteiro, incluindo os objetos
+    # dados e os modificados dentre os jogadores, e só então notifica os
+    # clientes que esperam por eles, de forma que sempre recebem os atributos
+    # publicados. Envia as modificações aos assinantes.
+    def finish(self, players, changed):
+        changed = list(dict.fromkeys(changed + [p for p in players
+                                                if p.dirty]))
+        with metrics.phases.time('publish'):
+            modified = self.publish(changed)
+        with metrics.phases.time('notify'):
+            self.notify()
+            for p in changed:
+                p.notify()
+            with self.state.lock:
+                self.state.dirty = modified
+            self.state.notify()
+            if modified:
+                self.views.notify()
+            self.views.expire()
+        if modified:
+            with metrics.phases.time('push'):
+                self.push()
+
+    # Executa um número de passos, registrando a duração de cada um. Ao
+    # final, avisa o escritor de pontos de restauração, se houver.
+    def tick(self, steps):
+        for i in range(steps):
+            start = time.monotonic()
+            self.step()
+            duration = time.monotonic() - start
+            self.clock.record(duration)
+            metrics.ticks.observe(duration)
+        if self.checkpoints:
+            self.checkpoints.tick(self)
+
+    # Retorna o alcance restante dos projéteis dados, na mesma ordem.
+    def ranges(self, projectiles):
+        if self.world:
+            return self.world.ranges(projectiles)
+        return [p.range for p in projectiles]
+
+    # Retorna uma cópia do estado do jogo ao final do último passo, para um
+    # ponto de restauração: o passo, o número de tiros, o estado publicado,
+    # que nunca é modificado, a senha e o script de cada objeto (None para
+    # pedras), e o alcance e o dono de cada projétil. Objetos e projéteis
+    # ficam na ordem em que o jogo os percorre. Deve ser chamado pela thread
+    # do jogo, entre passos.
+    def capture(self):
+        with self.lock:
+            children = list(self.children.items())
+        projectiles = list(self.projectiles.values())
+        ranges = self.ranges(projectiles)
+        return {'sequence': self.sequence, 'shots': self.shots,
+                'objects': self.published,
+                'children': {urn: (getattr(p, 'password', None),
+                                   getattr(p, 'script', None))
+                             for urn, p in children},
+                'projectiles': {p.urn: (r, p.player.urn)
+                                for p, r in zip(projectiles, ranges)}}
+
+    # Retorna um jogador fora do jogo, de URN dado, para os projéteis
+    # restaurados cujo dono já tinha saído do jogo, como o jogador removido
+    # que eles referenciavam. Os kills dos projéteis continuam creditados a
+    # ele no placar.
+    def detached(self, urn):
+        player = Player(urn, None, '', None, self.scores)
+        player.urn = urn
+        player.removed = True
+        return player
+
+    # Restaura o estado de um ponto de restauração carregado por
+    # checkpoint.load, em um jogo ainda sem objetos. A numeração dos passos e
+    # dos projéteis continua a partir dele, e clientes com modificações de
+    # passos anteriores recebem o estado completo. Projéteis cujo dono já
+    # tinha saído do jogo recebem um dono fora do jogo (veja detached).
+    def restore(self, checkpoint):
+        players = {}
+        for urn, attributes, password, script, distance, owner in \
+                checkpoint['objects']:
+            kind = attributes['type']
+            if kind == 'projectile':
+                if owner not in players:
+                    players[owner] = self.detached(owner)
+                self.add_projectile(Projectile(players[owner], attributes,
+                                               urn, distance))
+                continue
+            if kind == 'player':
+                code, error = compile_script(script)
+                if error:
+                    continue
+                obj = players[urn] = Player(urn, password, script, code,
+                                            self.scores)
+            else:
+                obj = Rock(attributes['posx'], attributes['posy'])
+            obj.attributes.update(attributes)
+            self.add_child(obj, urn)
+
+        self.shots = checkpoint['shots']
+        with self.lock:
+            self.sequence = checkpoint['sequence']
+            self.modified = self.horizon = self.sequence
+        if self.journal:
+            self.journal.restore(self)
+
+    # Sobrescrito de Thread. Executa os passos nos prazos do relógio. Salas
+    # não são threads: seus passos são executados pelo agendador das salas.
     def run(self):
         while True:
-            time.sleep(self.time_step)
+            self.tick(self.clock.wait())
 
-            # Movimenta jogadores.
-            with self.lock:
-                players = self.children.copy().values()
-            for p in players:
-                p.move(self.get_occupied())
+    # Encerra o jogo, desbloqueando os clientes que esperam por qualquer
+    # monitor dele, e encerrando as assinaturas. Os clientes do estado e das
+    # sessões recebem "Gone", os outros recebem os últimos dados, e as
+    # requisições seguintes não encontram mais o jogo.
+    def close(self):
+        with self.lock:
+            self.closed = True
+            monitors = [self, self.state] + list(self.children.values())
+            subscribers, self.subscribers = self.subscribers, []
+        with self.views.lock:
+            monitors += list(self.views.children.values())
+        for m in monitors:
+            with m.lock:
+                m.dirty = True
+            m.notify()
+        for s in subscribers:
+            s.close()
+
+
+# Salas: jogos independentes, criados e removidos pelos clientes, cada um com
+# seu próprio intervalo entre passos e pedras. Os passos de todas as salas são
+# executados por um agendador com um número fixo de threads, de forma que um
+# servidor pode hospedar muitas salas pequenas sem uma thread por sala.
+class Rooms(Container):
+
+    # Construtor. Recebe o agendador, o escritor do placar, o intervalo entre
+    # passos e o número de pedras padrão, e o número máximo de salas.
+    def __init__(self, scheduler, scores=None, time_step=0.1, rocks=20,
+                 limit=256):
+        Container.__init__(self)
+        self.scheduler = scheduler
+        self.scores = scores
+        self.time_step = time_step
+        self.rocks = rocks
+        self.limit = limit
+        self.creating = threading.Lock()
 
-            # Executa os scripts e notifica caso hajam modificações.
-            for p in players:
-                p.execute(players)
-                p.notify()
+    # Uma requisição POST cria uma sala, validando dados de entrada. Retorna
+    # uma resposta com o campo Location do cabeçalho contendo a URN da sala.
+    def do_POST(self, data):
+        if 'password' not in data:
+            return {'code': http.client.EXPECTATION_FAILED}
+        try:
+            time_step = float(data.get('step', self.time_step))
+            rocks = int(data.get('rocks', self.rocks))
+        except (TypeError, ValueError):
+            return {'code': http.client.BAD_REQUEST}
+        if not (0.01 <= time_step <= 10 and 0 <= rocks <= 1000):
+            return {'code': http.client.BAD_REQUEST}
+        name = data.get('name')
+        if name is not None and not isinstance(name, str):
+            return {'code': http.client.BAD_REQUEST}
+
+        # O nome, se dado, deve ser único. A verificação e a criação são
+        # feitas por uma requisição de cada vez, para que uma sala nunca seja
+        # substituída.
+        with self.creating:
+            with self.lock:
+                if len(self.children) >= self.limit:
+                    return {'code': http.client.SERVICE_UNAVAILABLE}
+                if name in self.children or name in self.routes:
+                    return {'code': http.client.CONFLICT}
+            game = Game(time_step, scores=self.scores,
+                        password=data['password'])
+            game.add_rocks(rocks)
+            self.add_child(game, name)
+        self.notify()
+        self.scheduler.add(game)
+        return {'code': http.client.CREATED,
+                'headers': [('Location', game.urn)]}
 
-            # Notifica clientes caso hajam modificações.
-            self.notify()
-            for p in players:
-                p.notify()
+    # Sobrescrito de Container. Pára os passos da sala e a encerra. Salas não
+    # têm passos próprios, então clientes são notificados imediatamente da
+    # criação e da remoção.
+    def delete_child(self, urn):
+        with self.lock:
+            game = self.children.get(urn)
+        Container.delete_child(self, urn)
+        self.notify()
+        if game is not None:
+            self.scheduler.remove(game)
+            game.close()
 
 
 # Main.
@@ -570,21 +2123,125 @@ if __name__ == '__main__':
             help='A porta para hospedar o servidor.')
     parser.add_argument('-s', '--step', type=float, default=0.1,
             help='O intervalo de tempo em segundos entre atualizações.')
+    parser.add_argument('-c', '--catch-up', type=int, default=0,
+            help='O número máximo de passos extras executados em seguida '
+                 'quando o jogo atrasa (0 descarta os passos perdidos).')
     parser.add_argument('-r', '--rocks', type=int, default=20,
             help='O número de pedras no campo, assim como a distância máxima.')
+    parser.add_argument('-j', '--workers', type=int, default=0,
+            help='O número de processos que executam os scripts (0 executa '
+                 'no próprio jogo).')
+    parser.add_argument('-b', '--budget', type=float, default=0.02,
+            help='O tempo de CPU em segundos de cada script por passo, com '
+                 'processos.')
+    parser.add_argument('-n', '--numpy', action='store_true',
+            help='Mantém os objetos em um mundo em colunas, com o passo '
+                 'vetorizado (requer NumPy).')
+    parser.add_argument('-d', '--database', type=str,
+            default='script_battle.db', help='O banco de dados do placar.')
+    parser.add_argument('-a', '--asyncio', action='store_true',
+            help='Usa o servidor assíncrono, com keep-alive, ao invés de uma '
+                 'thread por requisição.')
+    parser.add_argument('--ids', choices=sorted(ids.GENERATORS),
+            default='counter',
+            help='A estratégia de geração dos URNs de recursos criados sem '
+                 'nome, como as pedras.')
+    parser.add_argument('--rooms', type=int, default=256,
+            help='O número máximo de salas (0 desabilita as salas).')
+    parser.add_argument('--room-workers', type=int, default=4,
+            help='O número de threads que executam os passos das salas.')
+    parser.add_argument('--journal', type=str,
+            help='Acrescenta a este arquivo um diário do jogo, para ser '
+                 'reproduzido com replay.py.')
+    parser.add_argument('--seed', type=int,
+            help='A semente das posições aleatórias do jogo.')
+    parser.add_argument('--checkpoint', type=str,
+            help='Grava periodicamente o estado do jogo neste arquivo, e o '
+                 'restaura dele ao iniciar, se existir.')
+    parser.add_argument('--checkpoint-interval', type=float, default=10,
+            help='O intervalo de tempo em segundos entre gravações do '
+                 'estado do jogo.')
+    parser.add_argument('--queue-size', type=int, default=1024,
+            help='O número máximo de modificações dos clientes esperando '
+                 'pelo próximo passo; as seguintes são recusadas.')
+    parser.add_argument('--batch', type=int, default=256,
+            help='O número máximo de modificações dos clientes aplicadas '
+                 'por passo.')
+    parser.add_argument('--profile', type=str,
+            help='Amostra as pilhas de chamadas de todas as threads, e as '
+                 'grava neste arquivo ao terminar, para gerar flamegraphs.')
     args = parser.parse_args()
+    if args.numpy and not world.available():
+        parser.error('--numpy requer NumPy.')
+    if args.queue_size < 1 or args.batch < 1:
+        parser.error('--queue-size e --batch devem ser positivos.')
 
     # Cria o servidor.
-    server = Server('localhost', args.port)
-
-    # Cria o jogo e adiciona pedras.
-    game = Game(args.step)
+    ids.use(args.ids)
+    if args.asyncio:
+        server = AsyncServer('localhost', args.port)
+    else:
+        server = Server('localhost', args.port)
+
+    # Cria o jogo e adiciona pedras, ou restaura o último ponto de
+    # restauração. Os processos são criados antes de qualquer thread, e antes
+    # da conexão com o banco de dados.
+    board = scores.Scores(args.database)
+    diary = journal.Journal(args.journal) if args.journal else None
+    checkpoints = None
+    if args.checkpoint:
+        checkpoints = checkpoint.Checkpoints(args.checkpoint,
+                                       args.checkpoint_interval)
+    game = Game(args.step, args.workers, args.budget, args.numpy, board,
+                catch_up=args.catch_up, seed=args.seed, journal=diary,
+                checkpoints=checkpoints, queue_size=args.queue_size,
+                batch=args.batch)
     server.root.add_child(game, 'game')
-    for i in range(args.rocks):
-        game.add_child(Rock(random.randrange(args.rocks),
-                            random.randrange(args.rocks)))
-
-    # Inicia o jogo e o servidor.
+    restored = None
+    if args.checkpoint:
+        try:
+            restored = checkpoint.load(args.checkpoint)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            parser.error('checkpoint inválido: %s' % e)
+    if restored:
+        game.restore(restored)
+    else:
+        game.add_rocks(args.rocks)
+
+    # Cria as salas, com os mesmos padrões do jogo.
+    scheduler = clock.Scheduler(args.room_workers)
+    if args.rooms > 0:
+        server.root.add_child(Rooms(scheduler, board, args.step, args.rocks,
+                                    args.rooms), 'games')
+
+    # Inicia o placar, o jogo e o servidor. Ao terminar, por interrupção ou
+    # SIGTERM, grava os kills pendentes no placar, o diário, um último ponto
+    # de restauração e as pilhas amostradas.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    profiler = metrics.Profiler(args.profile) if args.profile else None
+    board.start()
+    if diary:
+        diary.start()
+    if checkpoints:
+        checkpoints.start()
     game.start()
-    server.serve_forever()
+    if args.rooms > 0:
+        scheduler.start()
+    if profiler:
+        profiler.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if checkpoints:
+            checkpoints.close()
+        board.close()
+        if diary:
+            diary.close()
+        if profiler:
+            profiler.close()
 
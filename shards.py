@@ -0,0 +1,632 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import http.client
+import argparse
+import signal
+import sys
+import os
+
+import server
+import metrics
+import scores
+import ids
+
+
+# Jogo dividido em faixas verticais do campo (shards), cada uma simulada por
+# um processo próprio, de forma que os passos de um campo grande usam vários
+# núcleos. A faixa i contém as abscissas de i * width a (i + 1) * width; a
+# primeira e a última se estendem até o infinito. Um front-end atende os
+# clientes com a mesma API do servidor, e a cada passo envia a cada shard os
+# comandos recebidos, espera que todos executem o passo em paralelo, e junta
+# as modificações publicadas por eles em um único estado.
+#
+# Objetos que atravessam uma fronteira são transferidos para o shard vizinho
+# no passo seguinte. Objetos a até margin posições de uma fronteira são
+# copiados, como fantasmas, para o shard vizinho, de forma que colisões perto
+# das fronteiras são detectadas, com um passo de atraso. Danos, kills e tiros
+# removidos de objetos de outro shard viram eventos, entregues pelo front-end
+# ao shard em que o objeto está. Os scripts veem somente os objetos do
+# próprio shard.
+
+
+# Retorna o índice do shard que contém uma abscissa.
+def owner(x, count, width):
+    return min(count - 1, max(0, x // width))
+
+
+# Jogador de outro shard, referenciado por projéteis disparados por ele e por
+# danos causados por ele. Seus kills e tiros removidos viram eventos.
+class Proxy:
+
+    __slots__ = ('urn', 'shard')
+
+    # Construtor. Recebe o shard e o URN do jogador.
+    def __init__(self, shard, urn):
+        self.shard = shard
+        self.urn = urn
+
+    # Adiciona 1 aos kills do jogador, no shard em que ele está.
+    def add_kill(self):
+        self.shard.events.append(('kill', self.urn))
+
+    # Indica que um tiro do jogador foi removido, no shard em que ele está.
+    def remove_shot(self):
+        self.shard.events.append(('unshot', self.urn))
+
+
+# Cópia de um objeto de um shard vizinho perto da fronteira. Fica somente no
+# índice espacial, onde bloqueia movimentos, e danos a ela viram eventos. Um
+# fantasma de projétil atinge objetos que se movem para a sua posição, e é
+# removido no seu shard.
+class Ghost:
+
+    __slots__ = ('urn', 'shard', 'attributes', 'player')
+
+    # Construtor. Recebe o shard, o URN, os atributos e, se for um projétil, o
+    # URN do jogador que o disparou.
+    def __init__(self, shard, urn, attributes, player):
+        self.shard = shard
+        self.urn = urn
+        self.attributes = attributes
+        self.player = player
+
+    # Computa dano ao objeto, no shard em que ele está.
+    def add_damage(self, source):
+        self.shard.events.append(('damage', self.urn, source.urn))
+
+    # Trata colisão com um objeto do shard.
+    def collide(self, other):
+        if self.attributes['type'] == 'projectile':
+            other.add_damage(self.shard.player(self.player))
+            self.shard.events.append(('delete', self.urn))
+
+
+# Jogo de um shard, executado em um processo próprio. Recebe os comandos do
+# front-end no início de cada passo, e ao final, retorna as modificações
+# publicadas, os objetos que saíram da faixa, os objetos perto das fronteiras
+# e os eventos para outros shards.
+class Shard(server.Game):
+
+    # Construtor. Recebe o índice do shard, o número de shards, a largura das
+    # faixas e a margem dos fantasmas.
+    def __init__(self, index, count, width, margin):
+        server.Game.__init__(self, 1)
+        self.index = index
+        self.count = count
+        self.width = width
+        self.margin = margin
+        self.ghosts = []
+        self.events = []
+        self.leaving = []
+
+    # Sobrescrito de Game. Os URNs dos projéteis são únicos entre os shards.
+    def projectile_urn(self):
+        self.shots += 1
+        return sys.intern('projectile%d' % (self.shots * self.count +
+                                            self.index))
+
+    # Retorna o jogador de URN dado, se estiver neste shard, ou um Proxy.
+    def player(self, urn):
+        with self.lock:
+            player = self.children.get(urn)
+        if isinstance(player, server.Player):
+            return player
+        return Proxy(self, urn)
+
+    # Retorna o objeto ou projétil de URN dado, ou None.
+    def find(self, urn):
+        with self.lock:
+            obj = self.children.get(urn)
+        return obj if obj is not None else self.projectiles.get(urn)
+
+    # Aplica os comandos do front-end, em ordem. Os fantasmas do passo
+    # anterior são descartados.
+    def apply(self, commands):
+        for g in self.ghosts:
+            self.grid.remove(g)
+        self.ghosts = []
+        for command in commands:
+            getattr(self, 'apply_' + command[0])(*command[1:])
+
+    # Adiciona um objeto novo, ou transferido de outro shard.
+    def apply_add(self, urn, attributes, extra):
+        kind = attributes['type']
+        if kind == 'projectile':
+            self.add_projectile(server.Projectile(
+                    self.player(extra['player']), attributes, urn,
+                    extra['range']))
+            return
+
+        if kind == 'player':
+            code = server.scripts.compile(extra['script'])
+            obj = server.Player(urn, extra['password'], extra['script'], code)
+        else:
+            obj = server.Rock(attributes['posx'], attributes['posy'])
+        obj.attributes.update(attributes)
+        self.add_child(obj, urn)
+
+        # Projéteis do jogador que chegaram antes dele passam a referenciá-lo.
+        if kind == 'player':
+            for p in self.projectiles.values():
+                if isinstance(p.player, Proxy) and p.player.urn == urn:
+                    p.player = obj
+
+    # Adiciona um fantasma de um objeto de um shard vizinho.
+    def apply_ghost(self, urn, attributes, player):
+        ghost = Ghost(self, urn, attributes, player)
+        self.grid.add(ghost, attributes['posx'], attributes['posy'])
+        self.ghosts.append(ghost)
+
+    # Remove um jogador, a pedido de um cliente.
+    def apply_remove(self, urn):
+        obj = self.find(urn)
+        if obj is not None:
+            obj.delete()
+
+    # Altera o script de um jogador.
+    def apply_script(self, urn, script):
+        player = self.find(urn)
+        if isinstance(player, server.Player):
+            player.replace(script, server.scripts.compile(script))
+
+    # Computa dano causado por um objeto de outro shard.
+    def apply_damage(self, urn, source):
+        obj = self.find(urn)
+        if obj is not None:
+            obj.add_damage(self.player(source))
+
+    # Adiciona 1 aos kills de um jogador.
+    def apply_kill(self, urn):
+        player = self.find(urn)
+        if isinstance(player, server.Player):
+            player.add_kill()
+
+    # Indica que um tiro de um jogador, em outro shard, foi removido.
+    def apply_unshot(self, urn):
+        player = self.find(urn)
+        if isinstance(player, server.Player):
+            player.remove_shot()
+
+    # Remove um projétil que atingiu um objeto de outro shard.
+    def apply_delete(self, urn):
+        projectile = self.projectiles.get(urn)
+        if projectile is not None:
+            projectile.delete()
+
+    # Retira os objetos que saíram da faixa, para serem transferidos. Os
+    # projéteis deste shard disparados por um jogador que saiu passam a
+    # referenciar um Proxy.
+    def hand_off(self):
+        with self.lock:
+            children = list(self.children.items())
+        for urn, obj in children:
+            if owner(obj.attributes['posx'], self.count,
+                     self.width) == self.index:
+                continue
+            extra = {}
+            if isinstance(obj, server.Player):
+                extra = {'password': obj.password, 'script': obj.script}
+                proxy = Proxy(self, urn)
+                for p in self.projectiles.values():
+                    if p.player is obj:
+                        p.player = proxy
+            self.delete_child(urn)
+            self.leaving.append((urn, obj.copy(), extra))
+
+        for p in list(self.projectiles.values()):
+            if owner(p.attributes['posx'], self.count,
+                     self.width) != self.index:
+                self.delete_projectile(p)
+                self.leaving.append((p.urn, p.copy(),
+                                     {'player': p.player.urn,
+                                      'range': p.range}))
+
+    # Retorna os objetos a até margin posições das fronteiras com os shards
+    # à esquerda e à direita, como tuplas (URN, atributos, jogador).
+    def borders(self):
+        lo = self.index * self.width
+        hi = lo + self.width
+        left, right = [], []
+        with self.lock:
+            objects = list(self.children.values())
+        objects += list(self.projectiles.values())
+        for obj in objects:
+            x = obj.attributes['posx']
+            near_left = self.index > 0 and x < lo + self.margin
+            near_right = self.index < self.count - 1 and x >= hi - self.margin
+            if not (near_left or near_right):
+                continue
+            player = None
+            if isinstance(obj, server.Projectile):
+                player = obj.player.urn
+            item = (obj.urn, obj.copy(), player)
+            if near_left:
+                left.append(item)
+            if near_right:
+                right.append(item)
+        return left, right
+
+    # Executa um passo com os comandos dados, e retorna o resultado para o
+    # front-end.
+    def run_step(self, commands):
+        self.apply(commands)
+        self.step()
+        delta = self.delta(self.sequence - 1)
+        self.hand_off()
+        left, right = self.borders()
+        result = {'delta': delta, 'leaving': self.leaving, 'left': left,
+                  'right': right, 'events': self.events}
+        self.leaving = []
+        self.events = []
+        return result
+
+
+# Executa um shard, em um processo próprio, até que o front-end envie None ou
+# feche a conexão. Interrupções do teclado são tratadas pelo front-end.
+def serve(index, count, width, margin, connection):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    shard = Shard(index, count, width, margin)
+    while True:
+        try:
+            commands = connection.recv()
+        except EOFError:
+            break
+        if commands is None:
+            break
+        connection.send(shard.run_step(commands))
+
+
+# Conjunto dos processos dos shards, cada um conectado ao front-end por um
+# pipe.
+class Cluster:
+
+    # Construtor. Cria os processos. Deve ser chamado antes de qualquer
+    # thread.
+    def __init__(self, count, width, margin):
+        context = multiprocessing.get_context('fork')
+        self.count = count
+        self.width = width
+        self.connections = []
+        self.processes = []
+        for i in range(count):
+            parent, child = context.Pipe()
+            process = context.Process(target=serve, daemon=True,
+                                      args=(i, count, width, margin, child))
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    # Retorna o índice do shard que contém uma abscissa.
+    def owner(self, x):
+        return owner(x, self.count, self.width)
+
+    # Envia a cada shard sua lista de comandos, e retorna os resultados do
+    # passo, na ordem dos shards. Os shards executam o passo em paralelo.
+    def exchange(self, commands):
+        for connection, batch in zip(self.connections, commands):
+            connection.send(batch)
+        return [connection.recv() for connection in self.connections]
+
+    # Encerra os processos.
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+
+
+# Objeto de um shard, espelhado no front-end com os atributos publicados pelo
+# shard. Requisições GET são atendidas como em um objeto local; PUT e DELETE
+# de um jogador entram na fila de comandos do front-end, e no passo seguinte
+# viram comandos para o shard.
+class RemoteObject(server.Object):
+
+    # Construtor. Recebe o jogo, os atributos e, se for um jogador, a senha.
+    def __init__(self, game, attributes, password=None):
+        server.Object.__init__(self)
+        self.game = game
+        self.attributes = dict(attributes)
+        self.password = password
+
+    # Atualiza atributos publicados pelo shard.
+    def update(self, attributes):
+        self.attributes.update(attributes)
+        self.dirty = True
+
+    # Sobrescrito de Resource. Altera o script de um jogador.
+    def do_PUT(self, data):
+        if self.password is None:
+            return self.default_reply
+        for i in ['password', 'script']:
+            if i not in data:
+                return {'code': http.client.EXPECTATION_FAILED}
+        if data['password'] != self.password:
+            return {'code': http.client.FORBIDDEN}
+
+        code, error = server.compile_script(data['script'])
+        if error:
+            return error
+
+        if not self.game.pending.put('script', self.game.send, self.urn,
+                                     ('script', self.urn, data['script'])):
+            return self.game.unavailable()
+        return {'code': http.client.ACCEPTED}
+
+    # Sobrescrito de Resource. Deleta um jogador.
+    def do_DELETE(self, data):
+        if self.password is None:
+            return self.default_reply
+        if 'password' not in data:
+            return {'code': http.client.EXPECTATION_FAILED}
+        if data['password'] != self.password:
+            return {'code': http.client.FORBIDDEN}
+
+        if not self.game.pending.put('delete', self.remove):
+            return self.game.unavailable()
+        return {'code': http.client.ACCEPTED}
+
+    # Comando que deleta o jogador no shard e o seu espelho, se ainda não foi
+    # removido.
+    def remove(self):
+        if self.removed:
+            return
+        self.game.send(self.urn, ('remove', self.urn))
+        self.delete()
+
+
+# Projétil de um shard, espelhado no front-end. Como os projéteis locais, não
+# é um recurso.
+class RemoteProjectile:
+
+    __slots__ = ('urn', 'attributes', 'dirty', 'published')
+
+    # Construtor. Recebe o URN e os atributos.
+    def __init__(self, urn, attributes):
+        self.urn = urn
+        self.attributes = dict(attributes)
+        self.dirty = True
+        self.published = None
+
+    # Retorna uma cópia dos atributos.
+    def copy(self):
+        return self.attributes.copy()
+
+    # Atualiza atributos publicados pelo shard.
+    def update(self, attributes):
+        self.attributes.update(attributes)
+        self.dirty = True
+
+    # Retorna se o projétil foi modificado desde a última chamada.
+    def notify(self):
+        dirty, self.dirty = self.dirty, False
+        return dirty
+
+
+# Front-end de um jogo dividido em shards. É um Game, com os mesmos recursos
+# (estado, modificações, áreas de interesse, WebSocket, relógio), cujos
+# objetos espelham os dos shards. Cada passo troca comandos e resultados com
+# os shards, e junta as modificações.
+class ShardedGame(server.Game):
+
+    # Construtor. Recebe o intervalo entre passos, o número de shards, a
+    # largura das faixas, a margem dos fantasmas, o escritor do placar e o
+    # número de passos extras, como Game. Cria os processos dos shards.
+    def __init__(self, time_step, count, width, margin=4, scores=None,
+                 catch_up=0):
+        server.Game.__init__(self, time_step, scores=scores,
+                             catch_up=catch_up)
+        self.cluster = Cluster(count, width, margin)
+        self.locations = {}
+        self.commands = [[] for i in range(count)]
+        self.ghosts = [[] for i in range(count)]
+
+    # Envia um comando ao shard em que está o objeto de URN dado, no próximo
+    # passo.
+    def send(self, urn, command):
+        with self.lock:
+            shard = self.locations.get(urn)
+            if shard is not None:
+                self.commands[shard].append(command)
+
+    # Sobrescrito de Game. Pedras e jogadores novos são criados no shard que
+    # contém sua posição, e espelhados no front-end.
+    def add_child(self, resource, urn=None):
+        if not isinstance(resource, (server.Player, server.Rock)):
+            server.Game.add_child(self, resource, urn)
+            return
+
+        with self.lock:
+            urn = sys.intern(urn) if urn else self.generate_urn()
+        a = resource.copy()
+        password, extra = None, {}
+        if isinstance(resource, server.Player):
+            password = resource.password
+            extra = {'password': resource.password, 'script': resource.script}
+        server.Game.add_child(self, RemoteObject(self, a, password), urn)
+
+        shard = self.cluster.owner(a['posx'])
+        with self.lock:
+            self.locations[urn] = shard
+            self.commands[shard].append(('add', urn, a, extra))
+
+    # Retorna o espelho de URN dado, ou None.
+    def find(self, urn):
+        with self.lock:
+            obj = self.children.get(urn)
+        return obj if obj is not None else self.projectiles.get(urn)
+
+    # Atualiza um espelho, e sua posição no índice espacial. Envia ao placar
+    # os kills novos de um jogador.
+    def update(self, obj, attributes):
+        kills = attributes.get('kills', 0) - obj.attributes.get('kills', 0)
+        obj.update(attributes)
+        if 'posx' in attributes or 'posy' in attributes:
+            self.grid.move(obj, obj.attributes['posx'],
+                           obj.attributes['posy'])
+        if self.scores and kills > 0:
+            for i in range(kills):
+                self.scores.add_kill(obj.urn)
+
+    # Junta os resultados de um passo dos shards. Atualiza a localização dos
+    # objetos, cria, atualiza e remove os espelhos, e prepara os comandos do
+    # próximo passo: transferências, eventos e fantasmas. Retorna a lista dos
+    # espelhos modificados.
+    def merge(self, results):
+        added, removed, changed = [], [], []
+        with self.lock:
+            for i, r in enumerate(results):
+                for urn, attributes in r['delta']['added'].items():
+                    self.locations[urn] = i
+                    added.append((urn, attributes))
+
+            # Um objeto transferido é removido do shard de origem no mesmo
+            # passo em que é adicionado ao de destino. Se não foi adicionado,
+            # foi removido no destino no próprio passo em que chegou.
+            arrived = {urn for urn, attributes in added}
+            for i, r in enumerate(results):
+                for urn in r['delta']['removed']:
+                    if self.locations.get(urn) == i or urn not in arrived:
+                        self.locations.pop(urn, None)
+                        removed.append(urn)
+                changed += r['delta']['changed'].items()
+
+            for i, r in enumerate(results):
+                for urn, attributes, extra in r['leaving']:
+                    shard = self.cluster.owner(attributes['posx'])
+                    self.locations[urn] = shard
+                    self.commands[shard].append(('add', urn, attributes,
+                                                 extra))
+                    changed.append((urn, attributes))
+            for r in results:
+                for event in r['events']:
+                    shard = self.locations.get(event[1])
+                    if shard is not None:
+                        self.commands[shard].append(event)
+
+        count = len(results)
+        for i in range(count):
+            ghosts = []
+            if i > 0:
+                ghosts += results[i - 1]['right']
+            if i < count - 1:
+                ghosts += results[i + 1]['left']
+            self.ghosts[i] = [('ghost',) + g for g in ghosts]
+
+        modified = []
+        for urn, attributes in added:
+            obj = self.find(urn)
+            if obj is None:
+                obj = RemoteProjectile(urn, attributes)
+                self.projectiles[urn] = obj
+                self.grid.add(obj, attributes['posx'], attributes['posy'])
+            else:
+                self.update(obj, attributes)
+            modified.append(obj)
+        for urn, attributes in changed:
+            obj = self.find(urn)
+            if obj is not None:
+                self.update(obj, attributes)
+                modified.append(obj)
+        for urn in removed:
+            projectile = self.projectiles.pop(urn, None)
+            if projectile is not None:
+                self.grid.remove(projectile)
+            else:
+                self.delete_child(urn)
+        return modified
+
+    # Sobrescrito de Game. Aplica os comandos dos clientes, envia os comandos
+    # aos shards, junta os resultados e os publica.
+    def step(self):
+        with metrics.phases.time('commands'):
+            self.pending.apply()
+        with self.lock:
+            commands, self.commands = self.commands, [
+                    [] for i in range(self.cluster.count)]
+        commands = [g + c for g, c in zip(self.ghosts, commands)]
+
+        with metrics.phases.time('shards'):
+            results = self.cluster.exchange(commands)
+        with metrics.phases.time('merge'):
+            modified = self.merge(results)
+        self.finish([], modified)
+
+    # Sobrescrito de Game. Encerra também os processos dos shards.
+    def close(self):
+        server.Game.close(self)
+        self.cluster.close()
+
+
+# Main.
+if __name__ == '__main__':
+    # Cria argumentos de linha de comando.
+    parser = argparse.ArgumentParser(
+            description='Servidor do jogo, com o campo dividido em shards, '
+                        'cada um simulado por um processo.',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-p', '--port', type=int, default=8000,
+            help='A porta para hospedar o servidor.')
+    parser.add_argument('-s', '--step', type=float, default=0.1,
+            help='O intervalo de tempo em segundos entre atualizações.')
+    parser.add_argument('-c', '--catch-up', type=int, default=0,
+            help='O número máximo de passos extras executados em seguida '
+                 'quando o jogo atrasa (0 descarta os passos perdidos).')
+    parser.add_argument('-r', '--rocks', type=int, default=20,
+            help='O número de pedras no campo, assim como a distância máxima.')
+    parser.add_argument('-k', '--shards', type=int,
+            default=os.cpu_count() or 1,
+            help='O número de shards.')
+    parser.add_argument('-w', '--width', type=int, default=0,
+            help='A largura da faixa de cada shard (0 divide a distância '
+                 'máxima igualmente).')
+    parser.add_argument('-m', '--margin', type=int, default=4,
+            help='A distância até a fronteira em que objetos são copiados '
+                 'para o shard vizinho.')
+    parser.add_argument('-d', '--database', type=str,
+            default='script_battle.db', help='O banco de dados do placar.')
+    parser.add_argument('-a', '--asyncio', action='store_true',
+            help='Usa o servidor assíncrono, com keep-alive, ao invés de uma '
+                 'thread por requisição.')
+    parser.add_argument('--ids', choices=sorted(ids.GENERATORS),
+            default='counter',
+            help='A estratégia de geração dos URNs de recursos criados sem '
+                 'nome, como as pedras.')
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error('o número de shards deve ser positivo.')
+    width = args.width or max(1, -(-args.rocks // args.shards))
+
+    # Cria o servidor e o jogo. Os processos dos shards são criados antes de
+    # qualquer thread, e antes da conexão com o banco de dados.
+    ids.use(args.ids)
+    game = ShardedGame(args.step, args.shards, width, args.margin,
+                       catch_up=args.catch_up)
+    if args.asyncio:
+        httpd = server.AsyncServer('localhost', args.port)
+    else:
+        httpd = server.Server('localhost', args.port)
+    board = scores.Scores(args.database)
+    game.scores = board
+    httpd.root.add_child(game, 'game')
+    game.add_rocks(args.rocks)
+
+    # Inicia o placar, o jogo e o servidor. Ao terminar, por interrupção ou
+    # SIGTERM, grava os kills pendentes no placar e encerra os shards.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    board.start()
+    game.start()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        board.close()
+        game.cluster.close()
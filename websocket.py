@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import collections
+import hashlib
+import base64
+import socket
+import struct
+import os
+
+
+# Implementação mínima do protocolo WebSocket (RFC 6455), suficiente para o
+# servidor enviar o estado do jogo e para o cliente recebê-lo.
+
+# Identificador do protocolo, concatenado à chave do cliente no handshake.
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# Códigos de operação dos quadros.
+CONTINUATION = 0x0
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+# Código de estado do quadro de fechamento enviado quando o recurso
+# acompanhado deixa de existir.
+GOING_AWAY = 1001
+
+
+# Retorna o valor do campo Sec-WebSocket-Accept para a chave do cliente.
+def accept(key):
+    digest = hashlib.sha1(bytes(key + GUID, 'latin-1')).digest()
+    return base64.b64encode(digest).decode('latin-1')
+
+
+# Verifica se uma requisição HTTP pede a mudança para WebSocket.
+def requested(headers):
+    return (headers.get('Upgrade', '').lower() == 'websocket' and
+            'Sec-WebSocket-Key' in headers)
+
+
+# Retorna a resposta HTTP que aceita a mudança para WebSocket.
+def handshake(key):
+    return bytes('HTTP/1.1 101 Switching Protocols\r\n'
+                 'Upgrade: websocket\r\n'
+                 'Connection: Upgrade\r\n'
+                 'Sec-WebSocket-Accept: %s\r\n\r\n' % accept(key), 'latin-1')
+
+
+# Aplica (ou remove) a máscara de 4 bytes ao conteúdo de um quadro.
+def apply_mask(payload, mask):
+    n = len(payload)
+    if n == 0:
+        return payload
+    mask = (mask * (n // 4 + 1))[:n]
+    value = int.from_bytes(payload, 'big') ^ int.from_bytes(mask, 'big')
+    return value.to_bytes(n, 'big')
+
+
+# Codifica uma mensagem em um único quadro. Quadros enviados pelo cliente
+# devem ter máscara; os enviados pelo servidor não.
+def encode(payload, opcode=TEXT, mask=False):
+    n = len(payload)
+    head = bytearray([0x80 | opcode])
+    bit = 0x80 if mask else 0
+    if n < 126:
+        head.append(bit | n)
+    elif n < 1 << 16:
+        head.append(bit | 126)
+        head += struct.pack('!H', n)
+    else:
+        head.append(bit | 127)
+        head += struct.pack('!Q', n)
+
+    if mask:
+        key = os.urandom(4)
+        head += key
+        payload = apply_mask(payload, key)
+    return bytes(head) + payload
+
+
+# Decodificador incremental de quadros. Recebe os bytes na ordem em que chegam
+# e retorna as mensagens completas, juntando mensagens fragmentadas.
+class Decoder:
+
+    # Construtor.
+    def __init__(self):
+        self.buffer = bytearray()
+        self.opcode = None
+        self.fragments = []
+
+    # Adiciona bytes recebidos. Retorna uma lista de tuplas (código de
+    # operação, conteúdo) das mensagens completas.
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= 2:
+            b0, b1 = self.buffer[0], self.buffer[1]
+            n = b1 & 0x7f
+            offset = 2
+            if n == 126:
+                offset = 4
+            elif n == 127:
+                offset = 10
+            if b1 & 0x80:
+                offset += 4
+            if len(self.buffer) < offset:
+                break
+            if n == 126:
+                n = struct.unpack_from('!H', self.buffer, 2)[0]
+            elif n == 127:
+                n = struct.unpack_from('!Q', self.buffer, 2)[0]
+            if len(self.buffer) < offset + n:
+                break
+
+            payload = bytes(self.buffer[offset:offset + n])
+            if b1 & 0x80:
+                payload = apply_mask(payload, self.buffer[offset - 4:offset])
+            del self.buffer[:offset + n]
+
+            # Quadros de controle não são fragmentados, e podem chegar entre
+            # fragmentos de outra mensagem.
+            opcode = b0 & 0x0f
+            if opcode >= CLOSE:
+                messages.append((opcode, payload))
+                continue
+            if opcode != CONTINUATION:
+                self.opcode = opcode
+                self.fragments = []
+            self.fragments.append(payload)
+            if b0 & 0x80:
+                messages.append((self.opcode, b''.join(self.fragments)))
+                self.fragments = []
+        return messages
+
+
+# Cliente WebSocket sobre um socket bloqueante.
+class Client:
+
+    # Construtor. Recebe o endereço do servidor, no formato "host:porta", e o
+    # identificador do recurso, e faz o handshake.
+    def __init__(self, host, uri):
+        address, _, port = host.partition(':')
+        self.socket = socket.create_connection((address, int(port or 80)))
+        self.decoder = Decoder()
+        self.messages = collections.deque()
+
+        key = base64.b64encode(os.urandom(16)).decode('latin-1')
+        self.socket.sendall(bytes('GET %s HTTP/1.1\r\n'
+                                  'Host: %s\r\n'
+                                  'Upgrade: websocket\r\n'
+                                  'Connection: Upgrade\r\n'
+                                  'Sec-WebSocket-Key: %s\r\n'
+                                  'Sec-WebSocket-Version: 13\r\n\r\n'
+                                  % (uri, host, key), 'latin-1'))
+
+        response = b''
+        while b'\r\n\r\n' not in response:
+            data = self.socket.recv(4096)
+            if not data:
+                raise ConnectionError('conexão fechada no handshake')
+            response += data
+        head, _, rest = response.partition(b'\r\n\r\n')
+        if (b' 101 ' not in head.split(b'\r\n')[0] or
+                bytes(accept(key), 'latin-1') not in head):
+            raise ConnectionError('handshake recusado')
+        self.receive_data(rest)
+
+    # Trata bytes recebidos, respondendo a quadros de controle.
+    def receive_data(self, data):
+        for opcode, payload in self.decoder.feed(data):
+            if opcode == PING:
+                self.send(payload, PONG)
+            elif opcode == CLOSE:
+                raise ConnectionError('conexão fechada pelo servidor')
+            else:
+                self.messages.append(payload)
+
+    # Retorna a próxima mensagem recebida, bloqueando até que haja uma.
+    def receive(self):
+        while not self.messages:
+            data = self.socket.recv(1 << 16)
+            if not data:
+                raise ConnectionError('conexão fechada pelo servidor')
+            self.receive_data(data)
+        return self.messages.popleft()
+
+    # Envia uma mensagem.
+    def send(self, payload, opcode=TEXT):
+        self.socket.sendall(encode(payload, opcode, mask=True))
+
+    # Fecha a conexão.
+    def close(self):
+        try:
+            self.send(b'', CLOSE)
+        finally:
+            self.socket.close()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import signal
+import queue
+import time
+import os
+
+
+# Atributos que um script pode modificar.
+CONTROLS = ['movx', 'movy', 'lookx', 'looky', 'shooting']
+
+
+# Exceção levantada quando um script excede seu tempo. Não deriva de
+# Exception, para que scripts com "except Exception" não a capturem.
+class Timeout(BaseException):
+    pass
+
+
+# Tratador dos sinais de temporizador. Interrompe o script em execução.
+def expire(signum, frame):
+    raise Timeout()
+
+
+# Fila pela qual o processo trabalhador devolve o resultado de cada script, e
+# número do lote de scripts atual do jogo, compartilhado com o servidor.
+results = None
+current = None
+
+
+# Inicializa um processo trabalhador, recebendo a fila dos resultados e o
+# número do lote atual. Os temporizadores interrompem scripts que excedem o
+# tempo, e interrupções do teclado são tratadas pelo servidor.
+def initialize(queue, batch):
+    global results, current
+    results = queue
+    current = batch
+    signal.signal(signal.SIGPROF, expire)
+    signal.signal(signal.SIGALRM, expire)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# Objetos de código compilados neste processo, mapeados pela chave do script.
+codes = {}
+
+
+# Retorna o objeto de código de um script, compilando-o se necessário. Os
+# scripts já foram validados no envio, então a compilação não falha.
+def get_code(key, source):
+    if key not in codes:
+        if len(codes) >= 256:
+            codes.clear()
+        codes[key] = compile(source, '<script>', 'exec')
+    return codes[key]
+
+
+# Executa um script com um orçamento de tempo de CPU, em segundos. O tempo real
+# é limitado ao dobro, para que scripts bloqueados também sejam interrompidos.
+# Retorna um dicionário com os atributos de controle modificados, ou None se o
+# script excedeu o orçamento ou levantou uma exceção.
+def execute(code, attributes, players, budget):
+    copy = dict(attributes)
+    try:
+        try:
+            signal.setitimer(signal.ITIMER_PROF, budget)
+            signal.setitimer(signal.ITIMER_REAL, 2 * budget)
+            exec(code, {'attributes': copy,
+                        'players': [dict(p) for p in players]})
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except Exception:
+        return None
+    return {i: copy[i] for i in CONTROLS if copy.get(i) != attributes.get(i)}
+
+
+# Executa um lote de scripts em um processo trabalhador. Recebe o número do
+# lote de scripts do jogo, o orçamento de cada script, a cópia dos dados de
+# todos os objetos do jogo, e uma lista de tuplas (índice, chave,
+# código-fonte). Envia uma tupla (lote, índice, modificações) para a fila dos
+# resultados assim que cada script termina, de forma que um script lento não
+# atrasa os resultados dos outros. Lotes que o jogo já abandonou não são
+# executados, e a execução pára quando o lote é abandonado. O início e o fim
+# da execução são avisados com tuplas (lote, None, ocupado), e toda tupla
+# leva ainda o pid do processo e o instante do envio, para que o servidor
+# substitua um processo travado.
+def run(batch, budget, players, tasks):
+    if current.value != batch:
+        return
+    pid = os.getpid()
+    results.put((batch, None, True, pid, time.monotonic()))
+    for index, key, source in tasks:
+        if current.value != batch:
+            break
+        code = get_code(key, source)
+        try:
+            changes = execute(code, players[index], players, budget)
+        except Timeout:
+            changes = None
+        results.put((batch, index, changes, pid, time.monotonic()))
+    results.put((batch, None, False, pid, time.monotonic()))
+
+
+# Conjunto de processos que executam os scripts dos jogadores a cada passo.
+# Cada processo recebe uma cópia compacta do mundo e devolve somente os
+# atributos de controle modificados, a serem aplicados pelo jogo.
+class Pool:
+
+    # Tempo, em segundos, além do limite de tempo real de um script, após o
+    # qual o processo que o executa é considerado travado.
+    margin = 0.5
+
+    # Construtor. Recebe o número de processos, o orçamento de tempo de CPU de
+    # cada script por passo, e o tempo máximo de espera pelos resultados.
+    def __init__(self, processes, budget, timeout):
+        context = multiprocessing.get_context('fork')
+        self.results = context.Queue()
+        self.current = context.Value('q', 0, lock=False)
+        self.pool = context.Pool(processes, initialize,
+                                 (self.results, self.current))
+        self.processes = processes
+        self.budget = budget
+        self.timeout = timeout
+        self.batch = 0
+        self.busy = {}
+
+    # Executa os scripts. Recebe a cópia dos dados de todos os objetos e uma
+    # lista de tuplas (índice, chave, código-fonte), uma por jogador. Retorna
+    # um dicionário que mapeia cada índice para as modificações do script.
+    # Somente os scripts que não terminam a tempo são descartados; resultados
+    # atrasados de passos anteriores são ignorados.
+    def execute(self, players, tasks):
+        self.batch += 1
+        self.current.value = self.batch
+        chunks = [tasks[i::self.processes] for i in range(self.processes)]
+        for chunk in chunks:
+            if chunk:
+                self.pool.apply_async(run, (self.batch, self.budget, players,
+                                            chunk))
+
+        results = {}
+        received = 0
+        deadline = time.monotonic() + self.timeout
+        while received < len(tasks):
+            try:
+                batch, index, changes, pid, sent = self.results.get(
+                        timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            self.track(pid, sent, index is not None or changes)
+            if index is not None and batch == self.batch:
+                results[index] = changes
+                received += 1
+        self.recover()
+        return results
+
+    # Registra uma mensagem de um processo, enviada no instante dado. Um
+    # processo ocupado deve enviar a próxima em até o dobro do orçamento de
+    # um script, o seu limite de tempo real.
+    def track(self, pid, sent, busy):
+        if busy:
+            self.busy[pid] = sent + 2 * self.budget + self.margin
+        else:
+            self.busy.pop(pid, None)
+
+    # Encerra os processos ocupados que não enviaram mensagens dentro do
+    # limite, por exemplo, com um script que captura a interrupção. O
+    # conjunto de processos os substitui.
+    def recover(self):
+        now = time.monotonic()
+        for pid, limit in list(self.busy.items()):
+            if now > limit:
+                del self.busy[pid]
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+    # Encerra os processos.
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+import threading
+
+# NumPy é opcional. Sem ele, o jogo usa somente a representação por objetos.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Tipos de objeto, na ordem de seus códigos na coluna 'type'.
+TYPES = [None, 'rock', 'player', 'projectile']
+PROJECTILE = TYPES.index('projectile')
+
+# Colunas do mundo. Além dos atributos expostos pela API, guarda o alcance dos
+# projéteis.
+COLUMNS = ['hp', 'type', 'posx', 'posy', 'movx', 'movy', 'lookx', 'looky',
+           'shots', 'shooting', 'kills', 'range']
+
+
+# Verifica se NumPy está disponível.
+def available():
+    return numpy is not None
+
+
+# Combina coordenadas em uma única chave inteira, para comparar posições de
+# vários objetos de uma vez.
+def key(x, y):
+    return (x << 32) + (y + (1 << 31))
+
+
+# Visão dos atributos de um objeto armazenados no mundo. Comporta-se como o
+# dicionário de atributos que substitui, de forma que os métodos de Object
+# continuam funcionando sem modificação.
+class Row:
+
+    __slots__ = ('world', 'slot', 'keys')
+
+    # Construtor. Recebe o mundo, a posição do objeto nas colunas e os nomes
+    # dos atributos expostos.
+    def __init__(self, world, slot, keys):
+        self.world = world
+        self.slot = slot
+        self.keys = keys
+
+    def __getitem__(self, name):
+        value = self.world.columns[name][self.slot]
+        if name == 'type':
+            return TYPES[value]
+        if name == 'shooting':
+            return bool(value)
+        return int(value)
+
+    def __setitem__(self, name, value):
+        if name == 'type':
+            value = TYPES.index(value)
+        self.world.columns[name][self.slot] = value
+
+    def __contains__(self, name):
+        return name in self.keys
+
+    # Atualiza vários atributos.
+    def update(self, attributes):
+        for name, value in attributes.items():
+            self[name] = value
+
+    # Retorna uma cópia dos atributos em formato dicionário.
+    def copy(self):
+        return {name: self[name] for name in self.keys}
+
+
+# Mundo em colunas. Cada atributo de todos os objetos do jogo fica em um vetor
+# contíguo, e cada objeto ocupa uma posição (slot) em todos eles. O passo de
+# movimento, colisão, dano e alcance dos projéteis é computado com operações
+# sobre os vetores inteiros, ao invés de objeto por objeto. Os recursos da API
+# continuam existindo, com seus atributos sendo visões das colunas.
+class World:
+
+    # Construtor. Recebe a capacidade inicial, dobrada quando necessário.
+    def __init__(self, capacity=1024):
+        self.columns = {c: numpy.zeros(capacity, numpy.int64)
+                        for c in COLUMNS}
+        self.alive = numpy.zeros(capacity, bool)
+        self.objects = [None] * capacity
+        self.free = []
+        self.size = 0
+        self.lock = threading.RLock()
+
+    # Dobra a capacidade do mundo.
+    def grow(self):
+        capacity = 2 * len(self.alive)
+        for c, column in self.columns.items():
+            self.columns[c] = numpy.resize(column, capacity)
+            self.columns[c][len(column):] = 0
+        alive = numpy.zeros(capacity, bool)
+        alive[:len(self.alive)] = self.alive
+        self.alive = alive
+        self.objects.extend([None] * (capacity - len(self.objects)))
+
+    # Adiciona um objeto ao mundo, movendo seus atributos para as colunas e
+    # substituindo-os por uma visão.
+    def attach(self, obj):
+        with self.lock:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                if self.size == len(self.alive):
+                    self.grow()
+                slot = self.size
+                self.size += 1
+
+            for c in self.columns.values():
+                c[slot] = 0
+            row = Row(self, slot, list(obj.attributes))
+            row.update(obj.attributes)
+            self.columns['range'][slot] = getattr(obj, 'range', 0)
+
+            self.alive[slot] = True
+            self.objects[slot] = obj
+            obj.attributes = row
+
+    # Retira um objeto do mundo, devolvendo a ele seus atributos em formato
+    # dicionário.
+    def detach(self, obj):
+        with self.lock:
+            row = obj.attributes
+            if not isinstance(row, Row) or row.world is not self:
+                return
+            obj.attributes = row.copy()
+            if hasattr(obj, 'range'):
+                obj.range = int(self.columns['range'][row.slot])
+
+            self.alive[row.slot] = False
+            self.objects[row.slot] = None
+            self.free.append(row.slot)
+
+    # Retorna uma cópia dos dados dos objetos dados, na mesma ordem, lendo
+    # cada coluna uma única vez.
+    def snapshot(self, objects):
+        with self.lock:
+            rows = [o.attributes for o in objects]
+            slots = [r.slot if isinstance(r, Row) else 0 for r in rows]
+            values = {c: self.columns[c][slots].tolist() for c in COLUMNS}
+
+        values['type'] = [TYPES[t] for t in values['type']]
+        values['shooting'] = [bool(s) for s in values['shooting']]
+        return [{k: values[k][i] for k in r.keys} if isinstance(r, Row)
+                else r.copy() for i, r in enumerate(rows)]
+
+    # Retorna o alcance restante dos projéteis dados, na mesma ordem.
+    def ranges(self, objects):
+        with self.lock:
+            return [int(self.columns['range'][o.attributes.slot])
+                    if isinstance(o.attributes, Row) else o.range
+                    for o in objects]
+
+    # Executa um passo do jogo sobre os objetos dados, na ordem em que o jogo
+    # os percorre. Movimenta objetos, mantendo o índice espacial atualizado,
+    # trata colisões, aplica dano e reduz o alcance dos projéteis, com o
+    # mesmo resultado do passo objeto por objeto.
+    def step(self, grid, objects):
+        with self.lock:
+            grid.clear_trails()
+            contended, paths = self.move(grid)
+            self.resolve(grid, objects, contended, paths)
+            self.expire(contended)
+
+    # Movimenta os objetos cujo movimento não depende dos outros. Um
+    # movimento de duas posições em um eixo passa por uma posição
+    # intermediária, e o caminho do objeto são essa posição e o destino. Um
+    # objeto se move aqui se nenhuma posição do seu caminho estiver ocupada
+    # no início do passo ou no caminho de outro objeto, e se a sua posição
+    # não estiver no caminho de outro objeto: assim, ele se move sem colidir
+    # em qualquer ordem. Retorna os slots dos objetos restantes, incluindo os
+    # parados no caminho de outro objeto, e os caminhos dos que se movem,
+    # mapeados por slot.
+    def move(self, grid):
+        n = self.size
+        c = self.columns
+        alive = self.alive[:n]
+        posx, posy = c['posx'][:n], c['posy'][:n]
+        movx, movy = c['movx'][:n], c['movy'][:n]
+        lookx, looky = c['lookx'][:n], c['looky'][:n]
+
+        contended = numpy.zeros(n, bool)
+        movers = numpy.nonzero(alive & ((movx != 0) | (movy != 0)))[0]
+        if len(movers) == 0:
+            return contended, {}
+
+        # Se está olhando para onde está se movendo, ganha bônus.
+        x, y = posx[movers], posy[movers]
+        dx = movx[movers] + (lookx[movers] == movx[movers])
+        dy = movy[movers] + (looky[movers] == movy[movers])
+        tx, ty = x + dx, y + dy
+        mx, my = x + (dx + (dx < 0)) // 2, y + (dy + (dy < 0)) // 2
+
+        # Posições dos caminhos. who é o índice do objeto em movers. Um
+        # objeto com deslocamento nulo tem a própria posição como caminho.
+        middle = (numpy.abs(dx) == 2) | (numpy.abs(dy) == 2)
+        who = numpy.concatenate((numpy.nonzero(middle)[0],
+                                 numpy.arange(len(movers))))
+        cells = numpy.concatenate((key(mx[middle], my[middle]),
+                                   key(tx, ty)))
+        own = (cells == key(x, y)[who]).astype(numpy.int64)
+
+        # Posições ocupadas no início do passo por outro objeto, ou no
+        # caminho de mais de um objeto.
+        slots = numpy.nonzero(alive)[0]
+        starts = key(posx[slots], posy[slots])
+        keys = numpy.sort(starts)
+        found = numpy.searchsorted(keys, cells, 'right') - \
+                numpy.searchsorted(keys, cells, 'left')
+        unique, inverse, counts = numpy.unique(
+                cells, return_inverse=True, return_counts=True)
+        shared = counts[inverse.ravel()] > 1
+        contended[movers[who[(found > own) | shared]]] = True
+
+        # Objetos cuja posição está no caminho de outro.
+        path = numpy.sort(cells)
+        crossed = numpy.searchsorted(path, starts, 'right') - \
+                numpy.searchsorted(path, starts, 'left')
+        itself = numpy.zeros(n, numpy.int64)
+        itself[movers] = key(tx, ty) == key(x, y)
+        contended[slots[crossed > itself[slots]]] = True
+
+        # Caminhos dos objetos restantes.
+        waiting = contended[movers]
+        paths = {s: (x, y, (u, v) if m else None)
+                 for s, x, y, u, v, m in zip(
+                        movers[waiting].tolist(), tx[waiting].tolist(),
+                        ty[waiting].tolist(), mx[waiting].tolist(),
+                        my[waiting].tolist(), middle[waiting].tolist())}
+
+        # Movidos com sucesso.
+        moved = numpy.nonzero(~waiting)[0]
+        slots = movers[moved]
+        posx[slots] = tx[moved]
+        posy[slots] = ty[moved]
+        objects = [self.objects[s] for s in slots.tolist()]
+        grid.move_all(zip(objects, posx[slots].tolist(),
+                          posy[slots].tolist()))
+        for obj in objects:
+            obj.dirty = True
+        return contended, paths
+
+    # Movimenta os objetos dos slots dados, um a um na ordem do jogo, pelos
+    # caminhos dados, como Object.move: cada objeto colide com o primeiro
+    # objeto que encontrar no caminho, considerando os que já se moveram,
+    # pararam ou foram removidos, e os que o atravessaram. O alcance dos
+    # projéteis é reduzido no próprio movimento, como em Projectile.move.
+    def resolve(self, grid, objects, contended, paths):
+        if not contended.any():
+            return
+        c = self.columns
+        posx, posy = c['posx'], c['posy']
+        movx, movy = c['movx'], c['movy']
+        kinds, ranges = c['type'], c['range']
+        wanted = set(numpy.nonzero(contended)[0].tolist())
+        objects = [(o, o.attributes.slot) for o in objects
+                   if isinstance(o.attributes, Row) and
+                   o.attributes.world is self and o.attributes.slot in wanted]
+        for obj, slot in objects:
+            if self.objects[slot] is not obj:
+                continue
+            projectile = kinds[slot] == PROJECTILE
+            path = paths.get(slot)
+            if path is not None and obj in grid and \
+                    (movx[slot] != 0 or movy[slot] != 0):
+                x, y, middle = path
+                for px, py in [middle, (x, y)] if middle else [(x, y)]:
+                    other = grid.at(px, py, obj)
+                    if other is None:
+                        other = grid.crossed(px, py, obj)
+                    if other is not None:
+                        obj.collide(other)
+                        other.collide(obj)
+                        break
+                else:
+                    grid.move(obj, x, y)
+                    if middle:
+                        grid.cross(obj, *middle)
+                    obj.dirty = True
+                    posx[slot] = x
+                    posy[slot] = y
+
+            if projectile and self.objects[slot] is obj:
+                ranges[slot] -= 1
+                if ranges[slot] < 1:
+                    obj.delete()
+
+    # Reduz o alcance dos projéteis, exceto os dos slots dados, que já o
+    # reduziram ao se mover, removendo os que chegaram a zero.
+    def expire(self, contended):
+        n = self.size
+        c = self.columns
+        projectiles = self.alive[:n] & (c['type'][:n] == PROJECTILE) & \
+                ~contended
+        c['range'][:n][projectiles] -= 1
+        for s in numpy.nonzero(projectiles & (c['range'][:n] < 1))[0].tolist():
+            self.objects[s].delete()